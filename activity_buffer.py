@@ -0,0 +1,167 @@
+# =================== activity_buffer.py ===================
+# EMI智能教學助理系統 - 學生活動時間的延遲寫入緩衝
+# Student.update_activity() 原本每次都 save() 整列學生資料，一則訊息會寫好幾次；
+# 改為在記憶體中記錄每位學生最新的活動時間，每隔幾秒以一個批次 UPDATE 寫入，
+# worker 結束時（gunicorn worker_exit）與行程結束時再寫入一次
+
+import os
+import time
+import atexit
+import datetime
+import logging
+import threading
+
+from peewee import Case
+
+from models import db, Student
+
+logger = logging.getLogger(__name__)
+
+# =================== 緩衝配置 ===================
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', 5))
+
+# 每個 UPDATE 陳述式包含的學生數
+ACTIVITY_FLUSH_CHUNK_SIZE = 200
+
+# =================== 活動緩衝 ===================
+
+class ActivityBuffer:
+    """合併同一位學生的多次活動更新，由背景執行緒定期批次寫入"""
+
+    def __init__(self, flush_interval=ACTIVITY_FLUSH_INTERVAL, chunk_size=ACTIVITY_FLUSH_CHUNK_SIZE):
+        self.flush_interval = max(0.5, flush_interval)
+        self.chunk_size = max(1, chunk_size)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop_event = threading.Event()
+
+        # 統計資料（僅限本行程）
+        self._recorded = 0
+        self._flushes = 0
+        self._rows_written = 0
+        self._failed_flushes = 0
+        self._last_flush_at = None
+
+    def record(self, student_id, timestamp=None):
+        """記錄學生最新的活動時間（只保留較新的時間）"""
+        timestamp = timestamp or datetime.datetime.now()
+        self._ensure_flusher()
+        with self._lock:
+            current = self._pending.get(student_id)
+            if current is None or timestamp > current:
+                self._pending[student_id] = timestamp
+            self._recorded += 1
+
+    def _ensure_flusher(self):
+        """啟動本行程的寫入執行緒（分叉後重新啟動，不寫入父行程留下的資料）"""
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._pending = {}
+            self._pid = os.getpid()
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='activity-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """把緩衝中的活動時間寫入資料庫，回傳寫入的學生數"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            rows = list(pending.items())
+            try:
+                with db.connection_context():
+                    for start in range(0, len(rows), self.chunk_size):
+                        chunk = rows[start:start + self.chunk_size]
+                        new_activity = Case(Student.id, chunk)
+                        # 其他 worker 可能已寫入更新的時間，只往後推進
+                        Student.update(last_activity=new_activity).where(
+                            Student.id.in_([student_id for student_id, _ in chunk]) &
+                            (Student.last_activity.is_null() | (Student.last_activity < new_activity))
+                        ).execute()
+                    # 不遞增資料版本：活動時間總是伴隨新訊息（訊息ID已推進水位），
+                    # 每次寫入都遞增會讓所有快取頁面每隔幾秒就失效
+
+                self._flushes += 1
+                self._rows_written += len(rows)
+                self._last_flush_at = time.time()
+                logger.debug(f"🕒 寫入 {len(rows)} 位學生的活動時間")
+                return len(rows)
+
+            except Exception as e:
+                self._failed_flushes += 1
+                logger.error(f"❌ 寫入學生活動時間失敗，下次重試: {e}")
+                # 放回緩衝，保留較新的時間
+                with self._lock:
+                    for student_id, timestamp in rows:
+                        current = self._pending.get(student_id)
+                        if current is None or timestamp > current:
+                            self._pending[student_id] = timestamp
+                return 0
+
+    def stop(self):
+        """停止寫入執行緒並寫入剩餘資料"""
+        if self._pid == os.getpid():
+            self._stop_event.set()
+            if self._thread and self._thread.is_alive():
+                self._thread.join(timeout=self.flush_interval + 1)
+        return self.flush()
+
+    def get_metrics(self):
+        """取得緩衝統計"""
+        return {
+            'flush_interval': self.flush_interval,
+            'pending': len(self._pending),
+            'recorded': self._recorded,
+            'flushes': self._flushes,
+            'rows_written': self._rows_written,
+            'coalesced': max(0, self._recorded - self._rows_written - len(self._pending)),
+            'failed_flushes': self._failed_flushes,
+            'last_flush_at': self._last_flush_at
+        }
+
+# =================== 模組層級實例 ===================
+
+activity_buffer = ActivityBuffer()
+
+def record_activity(student_id, timestamp=None):
+    """記錄學生活動（延遲寫入）"""
+    activity_buffer.record(student_id, timestamp)
+
+def flush_activity_buffer():
+    """立即寫入緩衝中的活動時間"""
+    return activity_buffer.flush()
+
+def stop_activity_buffer():
+    """停止寫入執行緒並寫入剩餘資料"""
+    return activity_buffer.stop()
+
+def get_activity_buffer_metrics():
+    """取得活動緩衝統計"""
+    return activity_buffer.get_metrics()
+
+# 非 gunicorn 環境（腳本、開發伺服器）結束時也寫入剩餘資料
+atexit.register(lambda: activity_buffer.flush() if activity_buffer._pid == os.getpid() else None)
+
+__all__ = [
+    'ActivityBuffer',
+    'activity_buffer',
+    'record_activity',
+    'flush_activity_buffer',
+    'stop_activity_buffer',
+    'get_activity_buffer_metrics'
+]
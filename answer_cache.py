@@ -0,0 +1,321 @@
+# =================== answer_cache.py ===================
+# EMI智能教學助理系統 - 課程問答快取
+# 同一班學生常問幾乎相同的問題（"What is machine learning?"），
+# 以正規化後的問題為鍵快取 AI 回答：行程內 LRU 為前層，cached_answers 表為共用層，
+# 任何一個 gunicorn worker 產生的回答其他 worker 都能命中；
+# 問題指涉前文（"Can you explain that again?"）或學生最近仍在對話中時不使用快取。
+# 快取的回答必須以不含學生姓名、對話摘要與上下文的通用提示詞產生（見 app.py），
+# 否則某位學生的個人資料會出現在其他學生的回覆中
+
+import os
+import re
+import time
+import hashlib
+import datetime
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from models import db, CachedAnswer
+
+logger = logging.getLogger(__name__)
+
+# =================== 快取配置 ===================
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() != 'false'
+ANSWER_CACHE_TTL_HOURS = int(os.getenv('ANSWER_CACHE_TTL_HOURS', 24))
+ANSWER_CACHE_LRU_SIZE = int(os.getenv('ANSWER_CACHE_LRU_SIZE', 500))
+
+# 行程內前層的存活時間（秒）；其他 worker 的失效操作最晚在此時間後生效
+ANSWER_CACHE_LOCAL_TTL = int(os.getenv('ANSWER_CACHE_LOCAL_TTL', 300))
+
+# 太短或太長的問題不快取（太短多半是接續上文，太長幾乎不會重複）
+MIN_QUESTION_LENGTH = 8
+MAX_QUESTION_LENGTH = 300
+
+# 最近多久內有對話就視為仍在同一段脈絡中（分鐘），期間的問題以個人化提示詞回答且不快取
+CONTEXT_WINDOW_MINUTES = int(os.getenv('ANSWER_CACHE_CONTEXT_WINDOW_MINUTES', 30))
+
+# 指涉前文的詞彙：出現時代表問題需要上下文才能回答
+# 中文沒有詞界，「再」「還有」只在句首或接續要求（再說一次、還有呢）時才算，
+# 避免「再生能源」「機器學習還有哪些應用」這類獨立問題被誤判
+CONTEXT_REFERENCE_PATTERN = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|he|she|above|previous|earlier|again|"
+    r"more|another|same|last|also)\b|"
+    r"(這個|那個|這些|那些|剛剛|剛才|上面|前面|繼續|它|他們|同樣)|"
+    r"^(再|還有)|再(說|講|解釋|舉|給|一次|多)|還有(呢|嗎|沒有)",
+    re.IGNORECASE
+)
+
+# =================== 問題正規化 ===================
+
+def normalize_question(question):
+    """轉成小寫、全形轉半形、移除標點與多餘空白，讓措辭相同的問題得到同一個鍵"""
+    text = unicodedata.normalize('NFKC', question or '').lower()
+    text = re.sub(r"[^\w\s]", ' ', text)
+    return re.sub(r"\s+", ' ', text).strip()
+
+def make_question_key(normalized_question):
+    """正規化問題的雜湊鍵"""
+    return hashlib.sha256(normalized_question.encode('utf-8')).hexdigest()
+
+def has_recent_conversation(context):
+    """學生最近 CONTEXT_WINDOW_MINUTES 分鐘內是否有對話（仍在同一段脈絡中）"""
+    flow = (context or {}).get('conversation_flow') or []
+    timestamps = []
+    for item in flow:
+        try:
+            timestamps.append(datetime.datetime.strptime(item['timestamp'], '%Y-%m-%d %H:%M:%S'))
+        except (KeyError, TypeError, ValueError):
+            continue
+    if not timestamps:
+        return False
+    return datetime.datetime.now() - max(timestamps) <= datetime.timedelta(minutes=CONTEXT_WINDOW_MINUTES)
+
+def is_context_dependent(question, context=None):
+    """
+    判斷問題是否依賴學生的對話脈絡：過短、含有指涉前文的詞彙，
+    或（有提供上下文時）學生最近仍在對話中
+    """
+    normalized = normalize_question(question)
+    # 中日韓文字一個字就承載一個詞的資訊量，以兩倍長度計算
+    cjk_chars = sum(1 for char in normalized if '\u3040' <= char <= '\u9fff' or '\uac00' <= char <= '\ud7af')
+    if len(normalized) + cjk_chars < MIN_QUESTION_LENGTH:
+        return True
+
+    if CONTEXT_REFERENCE_PATTERN.search(normalized):
+        return True
+
+    return has_recent_conversation(context)
+
+def is_cacheable_question(question, context=None):
+    """
+    問題是否可使用快取：長度合理且不依賴脈絡
+    可快取的問題以不含學生資料的通用提示詞回答，其餘問題保留個人化提示詞
+    """
+    if len(normalize_question(question)) > MAX_QUESTION_LENGTH:
+        return False
+    return not is_context_dependent(question, context)
+
+# =================== 問答快取 ===================
+
+class AnswerCache:
+    """兩層問答快取：行程內 LRU（短 TTL）+ 資料庫共用表（長 TTL）"""
+
+    def __init__(self, lru_size=ANSWER_CACHE_LRU_SIZE, ttl_hours=ANSWER_CACHE_TTL_HOURS,
+                 local_ttl=ANSWER_CACHE_LOCAL_TTL, enabled=ANSWER_CACHE_ENABLED):
+        self.lru_size = max(1, lru_size)
+        self.ttl_hours = ttl_hours
+        self.local_ttl = local_ttl
+        self.enabled = enabled
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 統計資料（僅限本行程）
+        self._local_hits = 0
+        self._db_hits = 0
+        self._misses = 0
+        self._bypassed = 0
+        self._stored = 0
+        self._invalidated = 0
+
+    # =================== 查詢 ===================
+
+    def get(self, question):
+        """取得快取的回答；未命中、停用或問題依賴脈絡時回傳 None"""
+        if not self.enabled:
+            return None
+
+        if not is_cacheable_question(question):
+            self._bypassed += 1
+            return None
+
+        normalized = normalize_question(question)
+        key = make_question_key(normalized)
+
+        answer = self._get_local(key)
+        if answer is not None:
+            self._local_hits += 1
+            logger.info(f"💾 問答快取命中 (本地): {normalized[:50]}")
+            return answer
+
+        try:
+            cached = CachedAnswer.get_or_none(
+                (CachedAnswer.question_key == key) &
+                (CachedAnswer.expires_at > datetime.datetime.now())
+            )
+        except Exception as e:
+            logger.error(f"❌ 讀取問答快取失敗: {e}")
+            return None
+
+        if cached is None:
+            self._misses += 1
+            return None
+
+        self._db_hits += 1
+        self._put_local(key, cached.answer)
+        self._record_hit(key)
+        logger.info(f"💾 問答快取命中 (資料庫): {normalized[:50]}")
+        return cached.answer
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+
+            answer, stored_at = entry
+            if time.time() - stored_at > self.local_ttl:
+                del self._local[key]
+                return None
+
+            self._local.move_to_end(key)
+            return answer
+
+    def _put_local(self, key, answer):
+        with self._lock:
+            self._local[key] = (answer, time.time())
+            self._local.move_to_end(key)
+            while len(self._local) > self.lru_size:
+                self._local.popitem(last=False)
+
+    def _record_hit(self, key):
+        """以單一 UPDATE 累加命中次數"""
+        try:
+            CachedAnswer.update(
+                hits=CachedAnswer.hits + 1,
+                last_hit_at=datetime.datetime.now()
+            ).where(CachedAnswer.question_key == key).execute()
+        except Exception as e:
+            logger.warning(f"⚠️ 更新問答快取命中次數失敗: {e}")
+
+    # =================== 寫入 ===================
+
+    def put(self, question, answer, model_name=None):
+        """儲存以通用提示詞產生的 AI 回答；依賴脈絡的問題不儲存"""
+        if not self.enabled or not answer:
+            return False
+
+        if not is_cacheable_question(question):
+            return False
+
+        normalized = normalize_question(question)
+        key = make_question_key(normalized)
+        now = datetime.datetime.now()
+        expires_at = now + datetime.timedelta(hours=self.ttl_hours)
+
+        try:
+            with db.atomic():
+                CachedAnswer.insert(
+                    question_key=key,
+                    question=normalized,
+                    answer=answer,
+                    model_name=model_name,
+                    created_at=now,
+                    expires_at=expires_at
+                ).on_conflict(
+                    conflict_target=[CachedAnswer.question_key],
+                    update={
+                        CachedAnswer.answer: answer,
+                        CachedAnswer.model_name: model_name,
+                        CachedAnswer.created_at: now,
+                        CachedAnswer.expires_at: expires_at
+                    }
+                ).execute()
+        except Exception as e:
+            logger.error(f"❌ 寫入問答快取失敗: {e}")
+            return False
+
+        self._put_local(key, answer)
+        self._stored += 1
+        return True
+
+    # =================== 管理 ===================
+
+    def invalidate(self, question=None):
+        """
+        使快取失效：指定問題時只移除該問題，否則清空全部
+        其他 worker 的本地前層會在 ANSWER_CACHE_LOCAL_TTL 秒內過期
+        """
+        try:
+            if question:
+                key = make_question_key(normalize_question(question))
+                deleted = CachedAnswer.delete().where(CachedAnswer.question_key == key).execute()
+                with self._lock:
+                    self._local.pop(key, None)
+            else:
+                deleted = CachedAnswer.delete().execute()
+                with self._lock:
+                    self._local.clear()
+
+            self._invalidated += deleted
+            logger.info(f"🗑️ 問答快取已失效 {deleted} 筆")
+            return deleted
+
+        except Exception as e:
+            logger.error(f"❌ 問答快取失效操作失敗: {e}")
+            return 0
+
+    def get_metrics(self):
+        """取得命中率等統計"""
+        hits = self._local_hits + self._db_hits
+        lookups = hits + self._misses
+
+        try:
+            stored_total = CachedAnswer.select().where(
+                CachedAnswer.expires_at > datetime.datetime.now()
+            ).count()
+        except Exception:
+            stored_total = None
+
+        return {
+            'enabled': self.enabled,
+            'local_hits': self._local_hits,
+            'db_hits': self._db_hits,
+            'misses': self._misses,
+            'bypassed_context_dependent': self._bypassed,
+            'stored': self._stored,
+            'invalidated': self._invalidated,
+            'hit_rate': round(hits / lookups * 100, 1) if lookups else 0.0,
+            'local_entries': len(self._local),
+            'shared_entries': stored_total,
+            'ttl_hours': self.ttl_hours
+        }
+
+# =================== 模組層級實例 ===================
+
+answer_cache = AnswerCache()
+
+def is_answer_cache_enabled():
+    """問答快取是否啟用"""
+    return answer_cache.enabled
+
+def get_cached_answer(question):
+    """取得快取的回答"""
+    return answer_cache.get(question)
+
+def store_answer(question, answer, model_name=None):
+    """儲存以通用提示詞產生的 AI 回答到快取"""
+    return answer_cache.put(question, answer, model_name)
+
+def invalidate_answer_cache(question=None):
+    """使快取失效（不指定問題時清空全部）"""
+    return answer_cache.invalidate(question)
+
+def get_answer_cache_metrics():
+    """取得問答快取統計"""
+    return answer_cache.get_metrics()
+
+__all__ = [
+    'AnswerCache',
+    'answer_cache',
+    'normalize_question',
+    'is_context_dependent',
+    'is_cacheable_question',
+    'is_answer_cache_enabled',
+    'get_cached_answer',
+    'store_answer',
+    'invalidate_answer_cache',
+    'get_answer_cache_metrics'
+]
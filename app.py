@@ -21,6 +21,7 @@ from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 import google.generativeai as genai
 from urllib.parse import quote
+from html import escape as html_escape
 
 # =================== 日誌配置 ===================
 logging.basicConfig(
@@ -39,6 +40,13 @@ PORT = int(os.getenv('PORT', 8080))
 HOST = os.getenv('HOST', '0.0.0.0')
 DEBUG_MODE = os.getenv('FLASK_ENV') == 'development'
 
+# LINE reply token 有效時間(秒)，AI 回應(含備用模型重試)必須在此時間內完成
+LINE_REPLY_TOKEN_TTL = int(os.getenv('LINE_REPLY_TOKEN_TTL', 60))
+AI_DEADLINE_MARGIN = float(os.getenv('AI_DEADLINE_MARGIN', 5))
+
+# 訊息處理時資料庫就緒檢查的間隔(秒)，避免每則訊息都查詢一次
+DATABASE_READY_CHECK_INTERVAL = int(os.getenv('DATABASE_READY_CHECK_INTERVAL', 30))
+
 # 記錄環境變數狀態
 logger.info("檢查環境變數...")
 for var_name, var_value in [
@@ -58,8 +66,37 @@ app.secret_key = SECRET_KEY
 
 # =================== 導入修改版模型(使用優化的記憶功能)===================
 from models import (
-    db, Student, ConversationSession, Message, LearningProgress,
-    initialize_database, get_database_stats, run_maintenance_tasks
+    db, Student, ConversationSession, Message, LearningProgress, Topic,
+    initialize_database, get_database_stats, run_maintenance_tasks,
+    get_database_pool_stats, read_replica, get_replica_lag
+)
+from webhook_queue import (
+    enqueue_webhook_events, start_webhook_workers, stop_webhook_workers,
+    get_webhook_queue_metrics
+)
+from event_dedup import filter_duplicate_events, remember_accepted_events, get_event_dedup_metrics
+from model_registry import model_registry
+from model_router import ai_router, background_router, AllModelsUnavailableError
+from answer_cache import (
+    is_cacheable_question, is_answer_cache_enabled, get_cached_answer, store_answer,
+    invalidate_answer_cache, get_answer_cache_metrics
+)
+from topic_tagger import schedule_topic_tagging, get_topic_tagger_metrics
+from conversation_memory import get_memory_context, record_exchange, get_conversation_memory_metrics
+from student_cache import get_cached_student, cache_student, invalidate_student_cache, get_student_cache_metrics
+from activity_buffer import get_activity_buffer_metrics
+from student_list import (
+    get_student_page, get_student_summary, serialize_student_row, normalize_sort, STUDENT_PAGE_SIZE
+)
+from response_cache import (
+    cached_response, clear_response_cache, get_response_cache_metrics, RUNTIME_METRICS_MAX_AGE
+)
+from maintenance_scheduler import (
+    start_maintenance_scheduler, get_maintenance_metrics, get_last_maintenance_runs
+)
+from semantic_cache import (
+    is_semantic_cache_enabled, load_semantic_cache, find_similar_answer, add_semantic_answer,
+    invalidate_semantic_cache, get_semantic_cache_metrics
 )
 
 # =================== Railway 修復：強制資料庫初始化 ===================
@@ -102,30 +139,47 @@ try:
 except Exception as init_error:
     logger.error(f"[ERROR] Railway 資料庫初始化失敗: {init_error}")
     DATABASE_INITIALIZED = False
+finally:
+    # 初始化用的連線歸還連線池；gunicorn 分叉前 pre_fork 也會關閉所有連線
+    if not db.is_closed():
+        db.close()
+
+# =================== 請求範圍資料庫連線 ===================
+@app.before_request
+def open_database_connection():
+    """每個請求從連線池取得連線(背景執行緒各自使用 connection_context)"""
+    try:
+        db.connect(reuse_if_open=True)
+    except Exception as e:
+        logger.error(f"[DB] 取得資料庫連線失敗: {e}")
 
-# =================== 資料庫管理函數 ===================
-def manage_conversation_sessions():
-    """清理舊會話"""
+@app.teardown_request
+def close_database_connection(exception=None):
+    """請求結束時把連線歸還連線池"""
     try:
-        # 使用修改版模型的自動清理功能
-        ended_count = ConversationSession.auto_end_inactive_sessions(timeout_minutes=30)
-        
-        return {
-            'cleaned_sessions': ended_count,
-            'status': 'success'
-        }
-        
+        if not db.is_closed():
+            db.close()
     except Exception as e:
-        logger.error(f"會話清理錯誤: {e}")
-        return {'cleaned_sessions': 0, 'status': 'error', 'error': str(e)}
+        logger.error(f"[DB] 歸還資料庫連線失敗: {e}")
+
+# =================== 資料庫管理函數 ===================
+_last_database_ready_check = 0.0
 
-def check_database_ready():
-    """檢查資料庫是否就緒"""
+def check_database_ready(max_age=0):
+    """
+    檢查資料庫是否就緒
+    max_age 秒內已確認就緒時不再查詢（訊息處理熱路徑使用）
+    """
+    global _last_database_ready_check
+    if max_age and time.time() - _last_database_ready_check < max_age:
+        return True
     try:
         # 嘗試執行簡單查詢
         Student.select().count()
+        _last_database_ready_check = time.time()
         return True
     except Exception as e:
+        _last_database_ready_check = 0.0
         logger.error(f"資料庫未就緒: {e}")
         return False
 
@@ -143,86 +197,70 @@ if CHANNEL_ACCESS_TOKEN and CHANNEL_SECRET:
 else:
     logger.error("[ERROR] LINE Bot 初始化失敗：缺少必要的環境變數")
 
-# =================== Gemini AI 初始化(備用AI機制)===================
-model = None
-CURRENT_MODEL = None
-backup_models = []
+# =================== Gemini AI 初始化(統一模型路由器)===================
+# 所有模型用戶端、延遲統計與斷路器都由 model_router 管理
+models_priority = ai_router.candidates
 
 if GEMINI_API_KEY:
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        # 按優先順序嘗試模型(備用AI機制)
-        models_priority = [
-            'gemini-2.5-flash',
-            'gemini-2.0-flash-exp', 
-            'gemini-1.5-flash',
-            'gemini-1.5-pro',
-            'gemini-pro'
-        ]
-        
-        for model_name in models_priority:
-            try:
-                test_model = genai.GenerativeModel(model_name)
-                test_response = test_model.generate_content("Test")
-                if test_response and test_response.text:
-                    if not model:  # 設置主要模型
-                        model = test_model
-                        CURRENT_MODEL = model_name
-                        logger.info(f"[OK] 主要 Gemini AI 已配置: {model_name}")
-                    else:  # 添加到備用模型列表
-                        backup_models.append((model_name, test_model))
-                        logger.info(f"[BACKUP] 備用模型可用: {model_name}")
-            except Exception as e:
-                logger.warning(f"[WARNING] 模型 {model_name} 無法使用: {e}")
-                continue
-        
-        if not model:
-            logger.error("[ERROR] 所有 Gemini 模型都無法使用")
-        else:
-            logger.info(f"[AI] 主要模型: {CURRENT_MODEL}, 備用模型: {len(backup_models)} 個")
-            
+        ai_router.configure(GEMINI_API_KEY)
+        logger.info(f"[AI] 主要模型: {ai_router.primary_model_name()}, 備用模型: {len(ai_router.get_backup_models())} 個")
     except Exception as e:
         logger.error(f"[ERROR] Gemini AI 配置失敗: {e}")
 else:
     logger.error("[ERROR] Gemini AI 初始化失敗：缺少 GEMINI_API_KEY")
 
 # =================== AI 失效處理機制 ===================
-def handle_ai_failure(error, student_name="Student"):
+def get_reply_deadline(event=None):
+    """
+    依 LINE reply token 的有效時間計算 AI 回應的截止時間(time.time() 絕對時間)
+    以事件發生時間起算，佇列等待時間也會計入預算
+    """
+    event_timestamp = getattr(event, 'timestamp', None) if event is not None else None
+    started = event_timestamp / 1000.0 if event_timestamp else time.time()
+    return started + LINE_REPLY_TOKEN_TTL - AI_DEADLINE_MARGIN
+
+def handle_ai_failure(error, student_name="Student", prompt=None, generation_config=None,
+                      deadline=None, tried_models=()):
     """
     AI 失效處理機制
-    詳細記錄 AI 失效原因，實作備用 AI 模型，即時通知系統
+    詳細記錄 AI 失效原因，把原本的提示詞改送給尚未嘗試的健康模型；
+    只有在所有模型都失敗或時間預算用盡時才回覆預設訊息
     """
     try:
         # 詳細記錄失效原因
+        backup_names = [name for name in ai_router.get_routable_models() if name not in tried_models]
         error_details = {
             'timestamp': datetime.datetime.now().isoformat(),
             'error_type': type(error).__name__,
             'error_message': str(error),
             'student': student_name,
-            'current_model': CURRENT_MODEL,
-            'backup_models_available': len(backup_models)
+            'tried_models': list(tried_models),
+            'backup_models_available': len(backup_names),
+            'seconds_left': round(deadline - time.time(), 1) if deadline else None
         }
         
         logger.error(f"[AI_FAILURE] 詳細錯誤記錄: {json.dumps(error_details, ensure_ascii=False)}")
         
-        # 嘗試使用備用模型
-        for backup_name, backup_model in backup_models:
+        # 以原本的提示詞重試備用模型(斷路器開啟的模型已被路由器排除)
+        if prompt and backup_names:
             try:
-                logger.info(f"[BACKUP_ATTEMPT] 嘗試使用備用模型: {backup_name}")
-                
-                # 使用簡單的測試提示詞
-                test_response = backup_model.generate_content("Please say 'AI service restored'")
-                
-                if test_response and test_response.text:
-                    logger.info(f"[BACKUP_SUCCESS] 備用模型 {backup_name} 可用")
-                    
-                    # 返回使用備用模型的訊息
-                    return f"I temporarily switched to backup AI system. How can I help you with your EMI course? (Using {backup_name})"
+                logger.info(f"[BACKUP_ATTEMPT] 以原提示詞嘗試備用模型: {', '.join(backup_names)}")
+                ai_response, backup_name = ai_router.generate(
+                    prompt,
+                    generation_config=generation_config,
+                    models=backup_names,
+                    deadline=deadline
+                )
+                logger.info(f"[BACKUP_SUCCESS] 備用模型 {backup_name} 回應成功")
+                return ai_response
                 
-            except Exception as backup_error:
-                logger.warning(f"[BACKUP_FAILED] 備用模型 {backup_name} 失敗: {backup_error}")
-                continue
+            except AllModelsUnavailableError as backup_error:
+                if backup_error.deadline_exceeded:
+                    logger.warning(f"[BACKUP_DEADLINE] 時間預算用盡: {backup_error}")
+                else:
+                    logger.warning(f"[BACKUP_FAILED] 備用模型都失敗: {backup_error}")
+                error = backup_error.last_error or error
         
         # 所有模型都失敗時的處理
         logger.critical("[CRITICAL] 所有AI模型都無法使用")
@@ -243,27 +281,64 @@ def handle_ai_failure(error, student_name="Student"):
         return "I'm experiencing severe technical difficulties. Please contact your instructor immediately. 🆘"
 
 # =================== 修改版AI回應生成(移除備用回應系統)===================
-def generate_ai_response_with_context(message_text, student):
+def generate_ai_response_with_context(message_text, student, deadline=None, result_info=None):
     """
     生成帶記憶功能的AI回應(修改版)
     主要修改：
     1. 移除備用回應系統，所有問題直接給Gemini處理
     2. 簡化提示詞，只加入"Please answer in brief."
     3. 使用備用AI機制處理失效情況
+    4. deadline 內依序改用其他健康模型(預設為 reply token 有效時間)
+    5. 快取啟用且問題不依賴脈絡(不指涉前文、學生最近沒有對話)時先查問答快取與語意快取，
+       未命中時以不含學生資料的通用提示詞回答，result_info['cacheable'] 標記此回答可在回覆後寫入快取；
+       其餘問題(包含快取停用時)一律使用個人化提示詞，且不快取
+    6. 上下文讀取學生的滾動對話記憶(一列 StudentMemory)，不再每次查詢歷史訊息
     """
+    if result_info is None:
+        result_info = {}
+    result_info['source'] = 'fallback'
+
     try:
-        if not model:
-            logger.warning("[AI警告] 主要模型未配置，嘗試備用模型...")
+        if not ai_router.is_configured():
+            logger.warning("[AI警告] 沒有可用的模型，嘗試備用模型...")
             return handle_ai_failure(Exception("主要模型未配置"), student.name)
         
         logger.info(f"[AI開始] 為 {student.name} 生成回應...")
         
-        # 取得對話上下文(使用優化版記憶功能)
-        context = Message.get_conversation_context(student, limit=5)
+        if deadline is None:
+            deadline = get_reply_deadline()
+        
+        # 登錄檔過期時於背景更新，不影響本次回應
+        model_registry.refresh_in_background(models_priority)
+        
+        # 取得對話上下文(每位學生一列的滾動記憶，對話後增量更新)
+        context = get_memory_context(student)
+        
+        # 同班學生重複的課程問題直接使用快取回答(依賴上下文或仍在對話中的問題不使用快取)
+        cacheable = ((is_answer_cache_enabled() or is_semantic_cache_enabled()) and
+                     is_cacheable_question(message_text, context))
+        if cacheable:
+            cached_answer = get_cached_answer(message_text)
+            if cached_answer:
+                logger.info(f"[快取命中] 為 {student.name} 使用快取回答")
+                result_info['source'] = 'answer_cache'
+                return cached_answer
+            
+            # 換句話說的相近問題使用語意快取
+            similar_answer = find_similar_answer(message_text)
+            if similar_answer:
+                logger.info(f"[語意快取命中] 為 {student.name} 使用相近問題的回答")
+                result_info['source'] = 'semantic_cache'
+                return similar_answer
+        
+        # 構建包含記憶的提示詞(簡化版)；可快取的問題使用通用提示詞，
+        # 回答會提供給其他學生，不能帶入這位學生的姓名、摘要、上下文與主題
+        summary_str = ""
+        if not cacheable and context.get('summary'):
+            summary_str = f"Conversation summary: {context['summary']}\n\n"
         
-        # 構建包含記憶的提示詞(簡化版)
         context_str = ""
-        if context['conversation_flow']:
+        if not cacheable and context['conversation_flow']:
             context_str = "Previous conversation context:\n"
             for i, conv in enumerate(context['conversation_flow'][-3:], 1):
                 content_preview = conv['content'][:100] + "..." if len(conv['content']) > 100 else conv['content']
@@ -276,18 +351,16 @@ def generate_ai_response_with_context(message_text, student):
         
         # 整理最近討論的主題(使用AI生成的主題)
         topics_str = ""
-        if context.get('recent_topics'):
+        if not cacheable and context.get('recent_topics'):
             recent_topics = ", ".join(context['recent_topics'][-5:])
             topics_str = f"Recent topics discussed: {recent_topics}\n"
         
         # 建構簡化的提示詞
-        student_name = student.name or "Student"
+        student_str = "" if cacheable else f"Student: {student.name or 'Student'}\n\n"
         
         prompt = f"""You are an EMI teaching assistant for the course "Practical Applications of AI in Life and Learning."
 
-Student: {student_name}
-
-{context_str}{topics_str}Current question: {message_text}
+{student_str}{summary_str}{context_str}{topics_str}Current question: {message_text}
 
 Please answer in brief."""
 
@@ -301,21 +374,27 @@ Please answer in brief."""
             max_output_tokens=400
         )
         
-        response = model.generate_content(prompt, generation_config=generation_config)
+        # 路由器依延遲挑選最快的健康模型，失敗時依序改用其他模型
+        try:
+            ai_response, model_name = ai_router.generate(
+                prompt, generation_config=generation_config, deadline=deadline
+            )
+        except AllModelsUnavailableError as routing_error:
+            return handle_ai_failure(routing_error.last_error or routing_error, student.name)
+        
+        logger.info(f"[AI成功] {model_name} 回應長度: {len(ai_response)} 字元")
+        
+        # 基本品質檢查
+        if len(ai_response) < 10:
+            logger.warning("[品質警告] 回應過短，嘗試備用模型")
+            return handle_ai_failure(
+                Exception("回應過短"), student.name,
+                prompt=prompt, generation_config=generation_config,
+                deadline=deadline, tried_models=(model_name,)
+            )
         
-        if response and response.text:
-            ai_response = response.text.strip()
-            logger.info(f"[AI成功] 回應長度: {len(ai_response)} 字元")
-            
-            # 基本品質檢查
-            if len(ai_response) < 10:
-                logger.warning("[品質警告] 回應過短，嘗試備用模型")
-                return handle_ai_failure(Exception("回應過短"), student.name)
-            
-            return ai_response
-        else:
-            logger.error(f"[API錯誤] 無效回應: {response}")
-            return handle_ai_failure(Exception("無效API回應"), student.name)
+        result_info.update({'source': 'model', 'model_name': model_name, 'cacheable': cacheable})
+        return ai_response
         
     except Exception as e:
         logger.error(f"[AI異常] {type(e).__name__}: {str(e)}")
@@ -462,16 +541,72 @@ def callback():
     signature = request.headers.get('X-Line-Signature', '')
     body = request.get_data(as_text=True)
     
+    # 只做簽名驗證，事件寫入佇列後立即回應，避免 LINE 逾時重送
+    if not handler.parser.signature_validator.validate(body, signature):
+        logger.error("[ERROR] LINE Webhook 簽名驗證失敗")
+        abort(400)
+    
     try:
         logger.debug("[LINE] 收到 LINE Webhook 請求")
-        handler.handle(body, signature)
+        events = json.loads(body).get('events', [])
+        
+        # 去重與入列在同一個交易中完成，入列失敗時事件ID也不會被記錄
+        with db.atomic():
+            new_events = filter_duplicate_events(events)
+            queued_count = enqueue_webhook_events(new_events)
+        # 交易提交後才記入行程內 LRU，回滾時 LINE 重送的事件仍會被接受
+        remember_accepted_events(new_events)
+        
+        start_background_workers()
+        logger.debug(f"[QUEUE] 已入列 {queued_count} 個事件，丟棄重複 {len(events) - len(new_events)} 個")
         return 'OK'
-    except InvalidSignatureError:
-        logger.error("[ERROR] LINE Webhook 簽名驗證失敗")
-        abort(400)
+    except Exception as queue_error:
+        # 佇列無法寫入時退回同步處理，確保訊息不會遺失
+        logger.error(f"[ERROR] Webhook 入列失敗，改為同步處理: {queue_error}")
+        try:
+            handler.handle(body, signature)
+            return 'OK'
+        except Exception as e:
+            logger.error(f"[ERROR] LINE Webhook 處理錯誤: {e}")
+            return 'Error', 500
+
+# =================== Webhook 佇列事件派送 ===================
+def dispatch_webhook_event(event_data):
+    """由佇列 worker 呼叫：把原始事件還原為 LINE 事件物件並交給對應的處理函數"""
+    event_type = event_data.get('type')
+    message_type = (event_data.get('message') or {}).get('type')
+    
+    if event_type == 'message' and message_type == 'text':
+        handle_message(MessageEvent.new_from_json_dict(event_data))
+    else:
+        logger.debug(f"[QUEUE] 略過不處理的事件類型: {event_type}/{message_type}")
+
+def start_background_workers():
+    """啟動本行程的背景工作執行緒(gunicorn 分叉後或第一個請求時呼叫)"""
+    try:
+        if start_webhook_workers(dispatch_webhook_event):
+            # 本行程剛啟動工作執行緒(gunicorn 分叉後)：以 memmap 載入語意快取
+            load_semantic_cache()
+        if GEMINI_API_KEY:
+            model_registry.refresh_in_background(models_priority)
+        # 會話清理等維護任務改由背景排程執行，各 worker 以資料庫租約協調
+        start_maintenance_scheduler()
     except Exception as e:
-        logger.error(f"[ERROR] LINE Webhook 處理錯誤: {e}")
-        return 'Error', 500
+        logger.error(f"[ERROR] 背景工作執行緒啟動失敗: {e}")
+
+def send_reply(event, text):
+    """
+    回覆學生訊息
+    事件在佇列中等待過久時 reply token 可能已失效，此時改用 push 訊息送達
+    """
+    try:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text))
+    except LineBotApiError as reply_error:
+        user_id = getattr(event.source, 'user_id', None)
+        if not user_id:
+            raise
+        logger.warning(f"[REPLY] reply token 無法使用，改用 push 訊息: {reply_error}")
+        line_bot_api.push_message(user_id, TextSendMessage(text=text))
 
 # =================== 修改版訊息處理函數(移除會話管理)===================
 @handler.add(MessageEvent, message=TextMessage)
@@ -490,19 +625,16 @@ def handle_message(event):
     
     try:
         # 檢查資料庫狀態
-        if not DATABASE_INITIALIZED or not check_database_ready():
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="System is initializing. Please try again shortly.")
-            )
+        if not DATABASE_INITIALIZED or not check_database_ready(max_age=DATABASE_READY_CHECK_INTERVAL):
+            send_reply(event, "System is initializing. Please try again shortly.")
             return
         
-        # 檢查學生是否存在
+        # 檢查學生是否存在(本行程快取優先，跨 worker 以版本計數失效)
         student = None
         is_new_user = False
         
         try:
-            student = Student.get(Student.line_user_id == user_id)
+            student = get_cached_student(user_id)
             student.update_activity()
             logger.info(f"[現有學生] {student.name}, 註冊步驟: {student.registration_step}")
         except Student.DoesNotExist:
@@ -516,13 +648,11 @@ def handle_message(event):
                 created_at=datetime.datetime.now(),
                 last_activity=datetime.datetime.now()
             )
+            cache_student(student)
             logger.info(f"[新用戶] 創建學生記錄: {user_id}")
         except Exception as e:
             logger.error(f"[學生記錄錯誤] {e}")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="System error occurred. Please try again later.")
-            )
+            send_reply(event, "System error occurred. Please try again later.")
             return
         
         # 新用戶處理邏輯(英文歡迎訊息)
@@ -534,10 +664,7 @@ I'm your AI learning companion for the course "Practical Applications of AI in L
 **Registration Step 1/3: Please provide your Student ID**
 Format example: A1234567"""
             
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=welcome_message)
-            )
+            send_reply(event, welcome_message)
             logger.info(f"[歡迎訊息] 已發送給新用戶")
             return
         
@@ -546,19 +673,15 @@ Format example: A1234567"""
             logger.info(f"[註冊流程] 步驟: {student.registration_step}")
             try:
                 registration_response = handle_student_registration_continuing(student, message_text)
+                # 註冊步驟已寫入資料庫，讓所有 worker 重新載入此學生
+                invalidate_student_cache(student.id)
                 if registration_response:
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text=registration_response)
-                    )
+                    send_reply(event, registration_response)
                     logger.info(f"[註冊回應] 已送出")
                     return
             except Exception as e:
                 logger.error(f"[註冊處理錯誤] {e}")
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="An error occurred during registration. Please restart.")
-                )
+                send_reply(event, "An error occurred during registration. Please restart.")
                 return
         
         # AI對話處理(已註冊學生的正常對話)
@@ -567,9 +690,12 @@ Format example: A1234567"""
             
             # 生成 AI 回應(移除會話管理)
             ai_response = None
+            ai_result = {}
             try:
                 logger.info(f"[AI生成] 開始生成回應...")
-                ai_response = generate_ai_response_with_context(message_text, student)
+                ai_response = generate_ai_response_with_context(
+                    message_text, student, deadline=get_reply_deadline(event), result_info=ai_result
+                )
                 logger.info(f"[AI完成] 回應長度: {len(ai_response)}")
             except Exception as ai_error:
                 logger.error(f"[AI錯誤] {ai_error}")
@@ -578,10 +704,7 @@ Format example: A1234567"""
             
             # 先發送回應給用戶，再處理資料庫記錄
             try:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text=ai_response)
-                )
+                send_reply(event, ai_response)
                 logger.info(f"[回應成功] 已送達用戶")
             except Exception as send_error:
                 logger.error(f"[送信失敗] {send_error}")
@@ -599,73 +722,100 @@ Format example: A1234567"""
                 )
                 logger.info(f"[記錄完成] 訊息 ID: {message_record.id}")
                 
+                # 增量更新學生的對話記憶並寫入快取；主題標籤在背景產生，不佔用回覆時間
+                record_exchange(student, message_record)
+                schedule_topic_tagging(message_record.id)
+                
             except Exception as record_error:
                 logger.error(f"[記錄錯誤] {record_error}")
                 # 記錄失敗不影響用戶，因為回應已經送出了
+            
+            # 以通用提示詞新產生的回答寫入問答快取與語意快取(回覆之後才做，不影響回應時間)
+            if ai_result.get('source') == 'model' and ai_result.get('cacheable'):
+                try:
+                    store_answer(message_text, ai_response, model_name=ai_result.get('model_name'))
+                    add_semantic_answer(message_text, ai_response, model_name=ai_result.get('model_name'))
+                except Exception as cache_error:
+                    logger.error(f"[快取錯誤] {cache_error}")
         
     except Exception as critical_error:
         logger.error(f"[嚴重錯誤] handle_message 發生未捕獲的錯誤: {critical_error}")
         try:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="System temporarily unavailable. Please try again. Sorry! 😅")
-            )
+            send_reply(event, "System temporarily unavailable. Please try again. Sorry! 😅")
         except Exception as final_error:
             logger.error(f"[致命錯誤] 連錯誤回應都無法送出: {final_error}")
 
 # =================== 學生管理頁面(新增匯出功能)===================
+STUDENT_STATUS_BADGES = {
+    0: '<span style="background: #28a745; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[OK] Registered</span>',
+    1: '<span style="background: #ffc107; color: #212529; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[WAIT] Student ID</span>',
+    2: '<span style="background: #17a2b8; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[WAIT] Name</span>',
+    3: '<span style="background: #6f42c1; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[WAIT] Confirm</span>',
+}
+STUDENT_STATUS_ERROR_BADGE = '<span style="background: #dc3545; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[ERROR] Reset Needed</span>'
+
+def render_student_rows(students):
+    """學生列表的表格列(頁面首屏與 /api/students 載入更多共用)"""
+    student_rows = ""
+    for student in students:
+        # 註冊狀態
+        status_badge = STUDENT_STATUS_BADGES.get(student['registration_step'], STUDENT_STATUS_ERROR_BADGE)
+        
+        # 最後活動時間
+        last_active = student['last_activity'].strftime('%m/%d %H:%M') if student['last_activity'] else 'None'
+        
+        student_rows += f"""
+            <tr>
+                <td>{student['id']}</td>
+                <td><strong>{html_escape(student['name'] or 'Not Set')}</strong></td>
+                <td><code>{html_escape(student['student_id'] or 'Not Set')}</code></td>
+                <td>{status_badge}</td>
+                <td style="text-align: center;">{student['message_count']}</td>
+                <td>{last_active}</td>
+                <td>
+                    <a href="/student/{student['id']}" style="background: #007bff; color: white; padding: 5px 10px; border-radius: 3px; text-decoration: none; font-size: 0.8em;">
+                        Details
+                    </a>
+                </td>
+            </tr>
+            """
+    return student_rows
+
 @app.route('/students')
+@read_replica()
+@cached_response()
 def students_list():
-    """學生管理頁面(含新增的匯出對話記錄功能)"""
+    """學生管理頁面(含新增的匯出對話記錄功能)；每頁一個查詢，以 keyset 分頁"""
     try:
         # 檢查資料庫是否就緒
         if not DATABASE_INITIALIZED or not check_database_ready():
             return redirect('/database-status')
         
-        # 取得所有學生
-        students = list(Student.select().order_by(Student.created_at.desc()))
+        sort, direction = normalize_sort(request.args.get('sort'), request.args.get('dir'))
+        search = (request.args.get('q') or '').strip()
         
-        # 統計資料
-        total_students = len(students)
-        registered_students = len([s for s in students if s.registration_step == 0])
-        pending_students = len([s for s in students if s.registration_step > 0])
+        # 第一頁與統計資料
+        page = get_student_page(sort=sort, direction=direction, search=search,
+                                after=request.args.get('after'))
+        summary = get_student_summary(search=search)
+        total_students = summary['total']
+        registered_students = summary['registered']
+        pending_students = summary['pending']
         
         # 生成學生列表 HTML
-        student_rows = ""
-        for student in students:
-            # 計算統計
-            msg_count = Message.select().where(Message.student == student).count()
-            
-            # 註冊狀態
-            if student.registration_step == 0:
-                status_badge = '<span style="background: #28a745; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[OK] Registered</span>'
-            elif student.registration_step == 1:
-                status_badge = '<span style="background: #ffc107; color: #212529; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[WAIT] Student ID</span>'
-            elif student.registration_step == 2:
-                status_badge = '<span style="background: #17a2b8; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[WAIT] Name</span>'
-            elif student.registration_step == 3:
-                status_badge = '<span style="background: #6f42c1; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[WAIT] Confirm</span>'
-            else:
-                status_badge = '<span style="background: #dc3545; color: white; padding: 3px 8px; border-radius: 10px; font-size: 0.8em;">[ERROR] Reset Needed</span>'
-            
-            # 最後活動時間
-            last_active = student.last_activity.strftime('%m/%d %H:%M') if student.last_activity else 'None'
-            
-            student_rows += f"""
-            <tr>
-                <td>{student.id}</td>
-                <td><strong>{student.name or 'Not Set'}</strong></td>
-                <td><code>{student.student_id or 'Not Set'}</code></td>
-                <td>{status_badge}</td>
-                <td style="text-align: center;">{msg_count}</td>
-                <td>{last_active}</td>
-                <td>
-                    <a href="/student/{student.id}" style="background: #007bff; color: white; padding: 5px 10px; border-radius: 3px; text-decoration: none; font-size: 0.8em;">
-                        Details
-                    </a>
-                </td>
-            </tr>
-            """
+        student_rows = render_student_rows(page['students'])
+        
+        # 排序連結：點選目前的欄位時切換方向
+        def sort_header(label, key):
+            next_direction = 'asc' if (key == sort and direction == 'desc') else 'desc'
+            arrow = (' ▼' if direction == 'desc' else ' ▲') if key == sort else ''
+            href = f"/students?sort={key}&dir={next_direction}&q={quote(search)}"
+            return f'<a href="{href}" style="color: #2c3e50; text-decoration: none;">{label}{arrow}</a>'
+        
+        next_page_url = ''
+        if page['next_cursor']:
+            next_page_url = f"/api/students?sort={sort}&dir={direction}&q={quote(search)}&after={page['next_cursor']}"
+        search_value = html_escape(search)
         
         return f"""
 <!DOCTYPE html>
@@ -832,24 +982,56 @@ def students_list():
             </div>
         </div>
         
+        <!-- 搜尋 -->
+        <form method="get" action="/students" style="display: flex; gap: 10px; margin-bottom: 20px;">
+            <input type="hidden" name="sort" value="{sort}">
+            <input type="hidden" name="dir" value="{direction}">
+            <input type="text" name="q" value="{search_value}" placeholder="Search by name or student ID"
+                   style="flex: 1; padding: 10px; border: 1px solid #ced4da; border-radius: 5px;">
+            <button type="submit" class="btn btn-primary" style="border: none; margin: 0;">Search</button>
+            <a href="/students" class="btn btn-secondary" style="margin: 0;">Clear</a>
+        </form>
+        
         <!-- 學生列表 -->
         <table>
             <thead>
                 <tr>
-                    <th>ID</th>
-                    <th>Name</th>
-                    <th>Student ID</th>
-                    <th>Status</th>
-                    <th>Messages</th>
-                    <th>Last Active</th>
+                    <th>{sort_header('ID', 'id')}</th>
+                    <th>{sort_header('Name', 'name')}</th>
+                    <th>{sort_header('Student ID', 'student_id')}</th>
+                    <th>{sort_header('Status', 'status')}</th>
+                    <th>{sort_header('Messages', 'messages')}</th>
+                    <th>{sort_header('Last Active', 'last_active')}</th>
                     <th>Actions</th>
                 </tr>
             </thead>
-            <tbody>
+            <tbody id="student-rows">
                 {student_rows or '<tr><td colspan="7" style="text-align: center; color: #999; padding: 40px;">No student data available</td></tr>'}
             </tbody>
         </table>
         
+        <!-- 載入更多(以 /api/students 取得下一頁) -->
+        <div style="text-align: center; margin-top: 20px;">
+            <button id="load-more" class="btn btn-info" style="border: none; cursor: pointer; {'' if next_page_url else 'display: none;'}"
+                    data-next="{next_page_url}">Load More</button>
+        </div>
+        <script>
+            document.getElementById('load-more').addEventListener('click', function () {{
+                var button = this;
+                if (!button.dataset.next) {{ return; }}
+                button.disabled = true;
+                fetch(button.dataset.next + '&format=html')
+                    .then(function (response) {{ return response.json(); }})
+                    .then(function (data) {{
+                        document.getElementById('student-rows').insertAdjacentHTML('beforeend', data.rows_html || '');
+                        button.dataset.next = data.next_url || '';
+                        button.style.display = data.next_url ? '' : 'none';
+                        button.disabled = false;
+                    }})
+                    .catch(function () {{ button.disabled = false; }});
+            }});
+        </script>
+        
         <!-- 操作說明 -->
         <div style="margin-top: 30px; padding: 20px; background: #e3f2fd; border-radius: 10px;">
             <h4 style="color: #1976d2; margin-bottom: 10px;">Student Management Guide - Updated Version</h4>
@@ -875,8 +1057,52 @@ def students_list():
         <a href="/">Back to Home</a>
         """
 
+@app.route('/api/students')
+@read_replica()
+@cached_response()
+def students_api():
+    """
+    學生列表 JSON(keyset 分頁)
+    參數：sort、dir(asc/desc)、q(姓名或學號)、after(上一頁的 next_cursor)、limit；
+    format=html 時另外回傳表格列 HTML，供學生管理頁面載入更多
+    """
+    try:
+        if not DATABASE_INITIALIZED or not check_database_ready():
+            return jsonify({"error": "Database not ready"}), 500
+        
+        page = get_student_page(
+            sort=request.args.get('sort'),
+            direction=request.args.get('dir'),
+            search=request.args.get('q'),
+            after=request.args.get('after'),
+            limit=request.args.get('limit', STUDENT_PAGE_SIZE, type=int)
+        )
+        
+        next_url = None
+        if page['next_cursor']:
+            next_url = (f"/api/students?sort={page['sort']}&dir={page['direction']}"
+                        f"&q={quote(page['search'])}&after={page['next_cursor']}")
+        
+        result = {
+            "students": [serialize_student_row(row) for row in page['students']],
+            "next_cursor": page['next_cursor'],
+            "next_url": next_url,
+            "sort": page['sort'],
+            "direction": page['direction'],
+            "search": page['search']
+        }
+        if request.args.get('format') == 'html':
+            result["rows_html"] = render_student_rows(page['students'])
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        logger.error(f"[ERROR] 學生列表 API 錯誤: {e}")
+        return jsonify({"error": f"Failed to load students: {str(e)}"}), 500
+
 # =================== 新增：匯出所有學生對話記錄功能 ===================
 @app.route('/students/export/conversations')
+@read_replica()
 def export_student_conversations():
     """
     新增功能：匯出所有學生送出的對話記錄(AI回應不用)。TSV格式。
@@ -1096,6 +1322,7 @@ def setup_database_force():
         
         # 使用修改版模型初始化
         success = initialize_database()
+        clear_response_cache()
         
         # 驗證表格存在
         def check_table_exists(model_class):
@@ -1229,6 +1456,7 @@ def setup_database_force():
 
 # =================== 系統首頁(修改版)===================
 @app.route('/')
+@cached_response()
 def index():
     """系統首頁(含修改狀態顯示)"""
     try:
@@ -1245,19 +1473,27 @@ def index():
         total_messages = Message.select().count()
         
         # 系統狀態
-        ai_status = "[OK] Normal" if model else "[ERROR] Not Configured"
+        if not ai_router.is_configured():
+            ai_status = "[ERROR] Not Configured"
+        elif ai_router.get_circuit_summary()['all_open']:
+            ai_status = "[WARNING] All model circuits open"
+        else:
+            ai_status = "[OK] Normal"
         line_status = "[OK] Normal" if (line_bot_api and handler) else "[ERROR] Not Configured"
         db_status = "[OK] Normal" if DATABASE_INITIALIZED else "[ERROR] Initialization Failed"
         
-        # 執行會話清理
-        cleanup_result = manage_conversation_sessions()
-        cleanup_count = cleanup_result.get('cleaned_sessions', 0)
+        # 會話清理由背景維護排程執行，這裡只顯示最後一次執行時間
+        session_expiry = get_last_maintenance_runs().get('session_expiry') or {}
+        last_cleanup = session_expiry.get('last_finished_at')
         
         # 預先生成 HTML 內容避免巢狀 f-string
-        ai_service_text = f"AI Service ({CURRENT_MODEL or 'None'})"
+        ai_service_text = f"AI Service ({ai_router.primary_model_name() or 'None'})"
         
         current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cleanup_message = f"[OK] Session auto-cleanup completed: cleaned {cleanup_count} old sessions"
+        if last_cleanup:
+            cleanup_message = f"[OK] Session auto-cleanup runs in background: last run {last_cleanup.strftime('%Y-%m-%d %H:%M:%S')}"
+        else:
+            cleanup_message = "[OK] Session auto-cleanup runs in background: waiting for first run"
         
         return f"""
 <!DOCTYPE html>
@@ -1446,7 +1682,7 @@ def index():
                 <div class="stat-label">Total Messages</div>
             </div>
             <div class="stat-card">
-                <div class="stat-number">{len(backup_models)}</div>
+                <div class="stat-number">{len(ai_router.get_backup_models())}</div>
                 <div class="stat-label">Backup AI Models</div>
             </div>
             <div class="stat-card">
@@ -1568,6 +1804,7 @@ def index():
 
 # =================== 修改版API端點(TSV格式)===================
 @app.route('/api/student/<int:student_id>/conversations')
+@cached_response()
 def get_student_conversations(student_id):
     """
     取得特定學生的對話記錄 API(修改版：TSV格式輸出)
@@ -1623,6 +1860,7 @@ def get_student_conversations(student_id):
 
 # =================== 系統統計 API ===================
 @app.route('/api/stats')
+@cached_response(max_age=RUNTIME_METRICS_MAX_AGE)
 def get_stats():
     """系統統計 API(修改版)"""
     try:
@@ -1643,10 +1881,25 @@ def get_stats():
         # 系統狀態
         system_status = {
             "database": "healthy" if DATABASE_INITIALIZED else "error",
-            "ai_service": "healthy" if model else "unavailable",
+            "ai_service": ("unavailable" if not ai_router.is_configured()
+                           else "degraded" if ai_router.get_circuit_summary()['all_open'] else "healthy"),
             "line_bot": "healthy" if (line_bot_api and handler) else "unavailable",
-            "backup_models": len(backup_models),
-            "memory_function": "ai_generated_topics" if DATABASE_INITIALIZED else "disabled"
+            "backup_models": len(ai_router.get_backup_models()),
+            "memory_function": "ai_generated_topics" if DATABASE_INITIALIZED else "disabled",
+            "webhook_queue": get_webhook_queue_metrics(),
+            "event_dedup": get_event_dedup_metrics(),
+            "model_registry": model_registry.get_snapshot(),
+            "model_router": ai_router.get_stats(),
+            "background_model_router": background_router.get_stats(),
+            "answer_cache": get_answer_cache_metrics(),
+            "semantic_cache": get_semantic_cache_metrics(),
+            "topic_tagger": get_topic_tagger_metrics(),
+            "conversation_memory": get_conversation_memory_metrics(),
+            "student_cache": get_student_cache_metrics(),
+            "activity_buffer": get_activity_buffer_metrics(),
+            "maintenance_scheduler": get_maintenance_metrics(),
+            "response_cache": get_response_cache_metrics(),
+            "database_pool": get_database_pool_stats()
         }
         
         return jsonify({
@@ -1656,7 +1909,12 @@ def get_stats():
             },
             "conversations": {
                 "total_messages": total_messages,
-                "today_messages": today_messages
+                "today_messages": today_messages,
+                # 由主題索引表計數，不掃描 topic_tags 字串
+                "top_topics": [
+                    {"topic": name, "messages": count}
+                    for name, count in Topic.get_topic_counts(limit=10)
+                ]
             },
             "system": system_status,
             "modifications": {
@@ -1674,6 +1932,44 @@ def get_stats():
         logger.error(f"[ERROR] 統計 API 錯誤: {e}")
         return jsonify({"error": f"Failed to load statistics: {str(e)}"}), 500
 
+# =================== 問答快取管理 API ===================
+@app.route('/api/answer-cache/invalidate', methods=['POST'])
+def invalidate_answer_cache_api():
+    """
+    使問答快取失效(課程內容更新或回答有誤時使用)
+    JSON 參數: {"question": "..."} 只移除該問題，{"all": true} 清空全部
+    需在 X-Admin-Token 標頭帶入 ADMIN_TOKEN；未設定 ADMIN_TOKEN 時此 API 停用
+    """
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token:
+        return jsonify({"error": "ADMIN_TOKEN is not configured"}), 403
+    if request.headers.get('X-Admin-Token') != admin_token:
+        return jsonify({"error": "Forbidden"}), 403
+    
+    try:
+        payload = request.get_json(silent=True) or {}
+        question = (payload.get('question') or request.form.get('question') or '').strip()
+        invalidate_all = bool(payload.get('all')) or request.form.get('all') == 'true'
+        
+        if not question and not invalidate_all:
+            return jsonify({"error": "Provide 'question' or 'all': true"}), 400
+        
+        deleted = invalidate_answer_cache(None if invalidate_all else question)
+        semantic_deleted = invalidate_semantic_cache(None if invalidate_all else question)
+        logger.info(f"[CACHE] 問答快取失效: {'全部' if invalidate_all else question[:50]} ({deleted} 筆, 語意快取 {semantic_deleted} 筆)")
+        
+        return jsonify({
+            "invalidated": deleted,
+            "semantic_invalidated": semantic_deleted,
+            "metrics": get_answer_cache_metrics(),
+            "semantic_metrics": get_semantic_cache_metrics(),
+            "timestamp": datetime.datetime.now().isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"[ERROR] 問答快取失效 API 錯誤: {e}")
+        return jsonify({"error": str(e)}), 500
+
 # =================== 第3段結束標記 ===================
 
 # =================== app.py 修改版 - 第4段-A開始 ===================
@@ -1681,6 +1977,7 @@ def get_stats():
 
 # =================== 匯出功能(單一定義版本)===================
 @app.route('/students/export')
+@read_replica()
 def export_students():
     """匯出學生清單為 TSV"""
     try:
@@ -1696,8 +1993,8 @@ def export_students():
         tsv_lines.append("Student_ID\tName\tStudent_Number\tLINE_User_ID\tRegistration_Step\tMessage_Count\tCreated_Time\tLast_Active_Time")
         
         for student in students:
-            # 計算統計
-            msg_count = Message.select().where(Message.student == student).count()
+            # 計算統計（Message.create 維護的計數欄位）
+            msg_count = student.message_count
             
             # 格式化時間
             created_str = student.created_at.strftime('%Y-%m-%d %H:%M:%S') if student.created_at else "N/A"
@@ -1730,6 +2027,7 @@ def export_students():
         return f"Export failed: {str(e)}", 500
 
 @app.route('/export/tsv')
+@read_replica()
 def export_tsv():
     """匯出完整對話資料為 TSV 格式(包含AI回應)"""
     try:
@@ -1784,6 +2082,7 @@ def export_tsv():
 
 # =================== 學生詳細頁面(簡化版)===================
 @app.route('/student/<int:student_id>')
+@cached_response()
 def student_detail(student_id):
     """學生詳細頁面(簡化版，移除會話相關資訊)"""
     try:
@@ -1800,7 +2099,7 @@ def student_detail(student_id):
             return "Student not found", 404
         
         # 獲取學生統計
-        total_messages = Message.select().where(Message.student == student).count()
+        total_messages = student.message_count
         
         # 獲取最近的對話
         recent_messages = list(Message.select().where(
@@ -2061,6 +2360,7 @@ def student_detail(student_id):
 
 # =================== 修改版健康檢查 ===================
 @app.route('/health')
+@cached_response(max_age=RUNTIME_METRICS_MAX_AGE)
 def health_check():
     """系統健康檢查 - 修改版(顯示精確修改狀態)"""
     try:
@@ -2081,13 +2381,60 @@ def health_check():
             db_details = f"[ERROR] Error: {str(e)}"
         
         # AI 服務檢查
-        ai_status = "healthy" if model and GEMINI_API_KEY else "unavailable"
-        ai_details = f"[OK] Gemini {CURRENT_MODEL}, Backup: {len(backup_models)} models" if model else "[ERROR] Not configured or invalid API key"
+        # 未配置與斷路器全部開啟分開回報：後者只是暫時無法呼叫，冷卻後會自動試探
+        router_stats = ai_router.get_stats()
+        circuits = router_stats['circuits']
+        if not (ai_router.is_configured() and GEMINI_API_KEY):
+            ai_status = "unavailable"
+            ai_details = "[ERROR] Not configured or invalid API key"
+        elif circuits['all_open']:
+            ai_status = "degraded"
+            ai_details = f"[WARNING] All model circuits open ({circuits['open']} open, {circuits['half_open']} half-open), using fallback replies"
+        else:
+            ai_status = "healthy"
+            ai_details = f"[OK] Gemini {ai_router.primary_model_name()}, Backup: {len(ai_router.get_backup_models())} models"
+        
+        # 各模型的斷路器狀態與延遲(只列出已呼叫過或斷路器開啟的模型)
+        model_summaries = [
+            f"{name}: {stats['state']}, p50 {stats['p50_ms'] or 0:.0f}ms, p95 {stats['p95_ms'] or 0:.0f}ms, errors {stats['error_rate']}%"
+            for name, stats in router_stats['models'].items()
+            if stats['calls'] or stats['state'] != 'closed'
+        ]
+        if model_summaries:
+            ai_details += " | " + "; ".join(model_summaries)
         
         # LINE Bot 檢查
         line_status = "healthy" if (line_bot_api and handler) else "unavailable"
         line_details = "[OK] Connected" if (line_bot_api and handler) else "[ERROR] Not configured or connection failed"
         
+        # Webhook 佇列檢查
+        queue_metrics = get_webhook_queue_metrics()
+        if 'error' in queue_metrics:
+            queue_status = "error"
+            queue_details = f"[ERROR] Error: {queue_metrics['error']}"
+        else:
+            queue_status = "healthy" if queue_metrics['running'] or queue_metrics['queue_depth'] == 0 else "unavailable"
+            queue_details = (
+                f"[OK] Depth: {queue_metrics['queue_depth']}, Processing: {queue_metrics['processing']}, "
+                f"Avg wait: {queue_metrics['avg_wait_seconds']}s, P95 wait: {queue_metrics['p95_wait_seconds']}s, "
+                f"Oldest pending: {queue_metrics['oldest_pending_seconds']}s"
+            )
+        
+        # 唯讀副本檢查(未設定時不顯示為錯誤)
+        replica = get_replica_lag()
+        if not replica['configured']:
+            replica_status = "not_configured"
+            replica_details = "[INFO] DATABASE_READ_URL not set, all reads use the primary"
+        elif replica['healthy']:
+            replica_status = "healthy"
+            replica_details = f"[OK] Lag: {replica['lag_seconds']}s (max {replica['max_lag_seconds']}s)"
+        else:
+            replica_status = "degraded"
+            replica_details = (
+                f"[WARNING] Lag: {replica['lag_seconds']}s, error: {replica['error']} "
+                f"- reads fall back to the primary"
+            )
+        
         # 修改狀態檢查
         modification_status = "completed"
         modification_details = "[COMPLETED] All precise modifications implemented successfully"
@@ -2099,7 +2446,7 @@ def health_check():
         # 整體健康狀態
         overall_status = "healthy" if all([
             db_status == "healthy",
-            ai_status in ["healthy", "unavailable"],  # AI 可以是未配置狀態
+            ai_status in ["healthy", "degraded", "unavailable"],  # AI 可以是未配置或暫時斷路狀態
             line_status in ["healthy", "unavailable"]  # LINE Bot 可以是未配置狀態
         ]) else "error"
         
@@ -2123,6 +2470,15 @@ def health_check():
                     "status": memory_status,
                     "details": memory_details
                 },
+                "webhook_queue": {
+                    "status": queue_status,
+                    "details": queue_details
+                },
+                "read_replica": {
+                    "status": replica_status,
+                    "details": replica_details,
+                    "lag_seconds": replica.get('lag_seconds')
+                },
                 "precise_modifications": {
                     "status": modification_status,
                     "details": modification_details
@@ -2157,6 +2513,8 @@ def health_check():
                 "ai_service": "AI Service",
                 "line_bot": "LINE Bot",
                 "memory_function": "Memory Function",
+                "webhook_queue": "Webhook Queue",
+                "read_replica": "Read Replica",
                 "precise_modifications": "Precise Modifications"
             }.get(service_name, service_name)
             
@@ -2614,16 +2972,12 @@ if __name__ == '__main__':
         # 啟動前的最終檢查
         logger.info("[STARTUP] 啟動 EMI 智能教學助理系統...")
         logger.info(f"[DATABASE] 資料庫狀態: {'[OK] 已初始化' if DATABASE_INITIALIZED else '[ERROR] 未初始化'}")
-        logger.info(f"[AI] 主要模型: {CURRENT_MODEL or '未配置'}")
-        logger.info(f"[AI] 備用模型: {len(backup_models)} 個")
+        logger.info(f"[AI] 主要模型: {ai_router.primary_model_name() or '未配置'}")
+        logger.info(f"[AI] 備用模型: {len(ai_router.get_backup_models())} 個")
         logger.info(f"[LINE] LINE Bot: {'[OK] 已配置' if (line_bot_api and handler) else '[ERROR] 未配置'}")
         
-        # 執行會話清理
-        try:
-            cleanup_result = manage_conversation_sessions()
-            logger.info(f"[CLEANUP] 啟動時會話清理: 清理了 {cleanup_result.get('cleaned_sessions', 0)} 個舊會話")
-        except Exception as cleanup_error:
-            logger.warning(f"[WARNING] 會話清理失敗: {cleanup_error}")
+        # 啟動背景工作（含會話清理等維護排程）
+        start_background_workers()
         
         # 精確修改狀態確認
         logger.info("[MODIFICATION] 精確修改狀態確認:")
@@ -2663,20 +3017,14 @@ if not DATABASE_INITIALIZED:
     except Exception as e:
         logger.error(f"[ERROR] Gunicorn 環境下緊急初始化失敗: {e}")
 
-# Gunicorn 環境下的會話清理
-try:
-    if DATABASE_INITIALIZED:
-        cleanup_result = manage_conversation_sessions()
-        logger.info(f"[CLEANUP] Gunicorn 啟動時會話清理: 清理了 {cleanup_result.get('cleaned_sessions', 0)} 個舊會話")
-except Exception as cleanup_error:
-    logger.warning(f"[WARNING] Gunicorn 環境下會話清理失敗: {cleanup_error}")
+# Gunicorn 環境下的會話清理由各 worker 分叉後啟動的背景維護排程執行（gunicorn.conf.py post_fork）
 
 # 輸出最終狀態
 logger.info("=" * 60)
 logger.info("EMI 智能教學助理系統 - 語法錯誤修復版 v4.3.1")
 logger.info(f"[DATABASE] 資料庫: {'[OK] 就緒' if DATABASE_INITIALIZED else '[ERROR] 未就緒'}")
-logger.info(f"[AI] 主要AI: {'[OK] 就緒' if model else '[ERROR] 未配置'}")
-logger.info(f"[AI] 備用AI: {len(backup_models)} 個模型可用")
+logger.info(f"[AI] 主要AI: {'[OK] 就緒' if ai_router.is_configured() else '[ERROR] 未配置'}")
+logger.info(f"[AI] 備用AI: {len(ai_router.get_backup_models())} 個模型可用")
 logger.info(f"[LINE] LINE: {'[OK] 就緒' if (line_bot_api and handler) else '[ERROR] 未配置'}")
 logger.info(f"[MEMORY] 記憶功能: {'[OK] AI生成主題已啟用' if DATABASE_INITIALIZED else '[ERROR] 無法使用'}")
 logger.info("[MODIFICATION] 精確修改: [COMPLETED] 所有修改已完成")
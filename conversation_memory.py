@@ -0,0 +1,438 @@
+# =================== conversation_memory.py ===================
+# EMI智能教學助理系統 - 每位學生的滾動對話記憶
+# 原本每則訊息都重新查詢最近五則 Message、重新截斷並組出上下文；
+# 改為每位學生一列 StudentMemory（滾動摘要 + 最近對話環形緩衝 + 主題集合），
+# 每次對話後增量更新，組提示詞只需以學生ID讀取一列小資料；
+# 摘要每 MEMORY_SUMMARY_EVERY 輪才在背景執行緒重新整理一次
+
+import os
+import json
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from models import db, Message, StudentMemory
+from student_cache import student_cache
+
+logger = logging.getLogger(__name__)
+
+# =================== 記憶配置 ===================
+
+# 環形緩衝保留的對話輪數
+MEMORY_RECENT_TURNS = int(os.getenv('MEMORY_RECENT_TURNS', 5))
+
+# 每累積幾輪對話重新整理一次摘要（不超過環形緩衝大小，避免未摘要的對話被擠出）
+MEMORY_SUMMARY_EVERY = min(int(os.getenv('MEMORY_SUMMARY_EVERY', 5)), MEMORY_RECENT_TURNS)
+
+MEMORY_SUMMARY_WORKERS = int(os.getenv('MEMORY_SUMMARY_WORKERS', 1))
+
+# 主題集合大小與每輪對話保留的字元數
+MEMORY_MAX_TOPICS = 10
+MEMORY_TURN_CHARS = 300
+MEMORY_SUMMARY_CHARS = 600
+
+# 樂觀更新衝突時的重試次數
+MEMORY_UPDATE_RETRIES = 3
+
+# =================== 對話記憶 ===================
+
+class ConversationMemory:
+    """讀取與增量更新 StudentMemory；摘要整理在本行程的背景執行緒中進行"""
+
+    def __init__(self, recent_turns=MEMORY_RECENT_TURNS, summary_every=MEMORY_SUMMARY_EVERY,
+                 max_workers=MEMORY_SUMMARY_WORKERS):
+        self.recent_turns = max(1, recent_turns)
+        self.summary_every = max(1, summary_every)
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._summarizing = set()
+
+        # 統計資料（僅限本行程）
+        self._reads = 0
+        self._bootstrapped = 0
+        self._updates = 0
+        self._conflicts = 0
+        self._summaries = 0
+        self._summary_fallbacks = 0
+        self._failed = 0
+
+    # =================== 讀取 ===================
+
+    def get_context(self, student):
+        """
+        取得組提示詞用的上下文，格式與 Message.get_conversation_context 相同，
+        另外多一個 'summary' 欄位；先查本行程的學生快取
+        """
+        cached = student_cache.get_context(student.id)
+        if cached is not None:
+            return cached
+
+        try:
+            memory = StudentMemory.get_or_none(StudentMemory.student == student.id)
+            if memory is None:
+                memory = self._bootstrap(student)
+            self._reads += 1
+            context = self._to_context(memory)
+            student_cache.put_context(student.id, context)
+            return context
+
+        except Exception as e:
+            self._failed += 1
+            logger.error(f"❌ 讀取對話記憶失敗，改為查詢歷史訊息: {e}")
+            context = Message.get_conversation_context(student, limit=self.recent_turns)
+            context['summary'] = ''
+            return context
+
+    def _bootstrap(self, student):
+        """第一次使用時由最近的歷史訊息建立記憶（每位學生只做一次）"""
+        recent_messages = list(Message.select().where(
+            Message.student == student
+        ).order_by(Message.timestamp.desc()).limit(self.recent_turns))
+
+        turns = []
+        topics = []
+        for msg in reversed(recent_messages):
+            turns.append(self._make_turn(msg.id, msg.content, msg.ai_response,
+                                         msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'), msg.source_type))
+            topics = self._merge_topics(topics, self._message_topics(msg))
+
+        last_message_at = None
+        if turns:
+            last_message_at = datetime.datetime.strptime(turns[-1]['timestamp'], '%Y-%m-%d %H:%M:%S')
+
+        StudentMemory.insert(
+            student=student.id,
+            recent_turns=json.dumps(turns, ensure_ascii=False),
+            topics=json.dumps(topics, ensure_ascii=False),
+            turn_count=len(turns),
+            summarized_turns=len(turns),
+            last_message_at=last_message_at
+        ).on_conflict_ignore().execute()
+
+        self._bootstrapped += 1
+        return StudentMemory.get(StudentMemory.student == student.id)
+
+    def _to_context(self, memory):
+        conversation_flow = [
+            {key: value for key, value in turn.items() if key != 'id'}
+            for turn in memory.get_recent_turns()
+        ]
+        recent_topics = memory.get_topics()[-5:]
+        return {
+            'conversation_flow': conversation_flow,
+            'recent_topics': recent_topics,
+            'context_summary': Message._build_context_summary(conversation_flow, recent_topics),
+            'summary': memory.summary or ''
+        }
+
+    @staticmethod
+    def _make_turn(message_id, content, ai_response, timestamp, source_type):
+        turn = {
+            'id': message_id,
+            'content': (content or '')[:MEMORY_TURN_CHARS],
+            'timestamp': timestamp,
+            'source_type': source_type
+        }
+        if ai_response:
+            turn['ai_response'] = ai_response[:MEMORY_TURN_CHARS]
+        return turn
+
+    @staticmethod
+    def _message_topics(message):
+        """已標記的訊息用儲存的標籤，否則用關鍵詞備用方法"""
+        if message.topic_tags:
+            return [tag.strip() for tag in message.topic_tags.split(',') if tag.strip()]
+        return Message._extract_topics_fallback(f"{message.content or ''} {message.ai_response or ''}")
+
+    # =================== 增量更新 ===================
+
+    def record_exchange(self, student, message):
+        """
+        把剛寫入的一則對話加入記憶，並把新的上下文與學生資料寫入快取；
+        同一則訊息重複呼叫不會重複加入。成功時回傳新的上下文，失敗時回傳 None
+        """
+        try:
+            timestamp = message.timestamp or datetime.datetime.now()
+            turn = self._make_turn(message.id, message.content, message.ai_response,
+                                   timestamp.strftime('%Y-%m-%d %H:%M:%S'), message.source_type)
+
+            topics = self._message_topics(message)
+
+            for attempt in range(MEMORY_UPDATE_RETRIES):
+                memory = StudentMemory.get_or_none(StudentMemory.student == student.id)
+                if memory is None:
+                    # 建立時已包含剛寫入的訊息
+                    memory = self._bootstrap(student)
+                    return self._write_through(student, memory)
+
+                turns = memory.get_recent_turns()
+                if any(existing.get('id') == message.id for existing in turns):
+                    return self._write_through(student, memory)
+                turns = (turns + [turn])[-self.recent_turns:]
+
+                # 以輪數作為版本號：其他 worker 同時更新時重新讀取再套用
+                memory.recent_turns = json.dumps(turns, ensure_ascii=False)
+                memory.topics = json.dumps(self._merge_topics(memory.get_topics(), topics), ensure_ascii=False)
+                updated = StudentMemory.update(
+                    recent_turns=memory.recent_turns,
+                    topics=memory.topics,
+                    turn_count=memory.turn_count + 1,
+                    last_message_at=timestamp,
+                    updated_at=datetime.datetime.now()
+                ).where(
+                    (StudentMemory.id == memory.id) &
+                    (StudentMemory.turn_count == memory.turn_count)
+                ).execute()
+
+                if updated:
+                    self._updates += 1
+                    memory.turn_count += 1
+                    if memory.turn_count - memory.summarized_turns >= self.summary_every:
+                        self._schedule_summary(memory.id, student.id)
+                    return self._write_through(student, memory)
+
+                self._conflicts += 1
+
+            logger.warning(f"⚠️ 對話記憶更新衝突過多，略過本輪 (學生 {student.id})")
+            student_cache.invalidate(student.id)
+            return None
+
+        except Exception as e:
+            self._failed += 1
+            logger.error(f"❌ 更新對話記憶失敗: {e}")
+            student_cache.invalidate(student.id)
+            return None
+
+    def _write_through(self, student, memory):
+        """Message.create 已更新學生統計，學生資料與新上下文一起寫入快取"""
+        context = self._to_context(memory)
+        student_cache.write_through(student=student, context=context)
+        return context
+
+    def merge_topics(self, student_id, topics):
+        """併入背景標記器產生的主題標籤"""
+        if not topics:
+            return False
+
+        try:
+            for attempt in range(MEMORY_UPDATE_RETRIES):
+                memory = StudentMemory.get_or_none(StudentMemory.student == student_id)
+                if memory is None:
+                    return False
+
+                current = memory.get_topics()
+                merged = self._merge_topics(current, topics)
+                if merged == current:
+                    return True
+
+                updated = StudentMemory.update(
+                    topics=json.dumps(merged, ensure_ascii=False)
+                ).where(
+                    (StudentMemory.id == memory.id) &
+                    (StudentMemory.topics == memory.topics)
+                ).execute()
+                if updated:
+                    student_cache.invalidate(student_id, context_only=True)
+                    return True
+
+                self._conflicts += 1
+            return False
+
+        except Exception as e:
+            self._failed += 1
+            logger.error(f"❌ 併入記憶主題失敗: {e}")
+            return False
+
+    @staticmethod
+    def _merge_topics(current, new_topics):
+        """新主題移到最後，保留最近的 MEMORY_MAX_TOPICS 個"""
+        merged = [topic for topic in current if topic not in new_topics]
+        merged.extend(topic for topic in dict.fromkeys(new_topics))
+        return merged[-MEMORY_MAX_TOPICS:]
+
+    # =================== 背景摘要 ===================
+
+    def _get_executor(self):
+        """取得本行程的執行緒池（分叉後重新建立）"""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='memory-summary'
+                )
+                self._pid = os.getpid()
+                self._summarizing = set()
+            return self._executor
+
+    def _schedule_summary(self, memory_id, student_id):
+        executor = self._get_executor()
+        with self._lock:
+            if memory_id in self._summarizing:
+                return
+            self._summarizing.add(memory_id)
+        try:
+            executor.submit(self._refresh_summary, memory_id, student_id)
+        except Exception as e:
+            with self._lock:
+                self._summarizing.discard(memory_id)
+            logger.error(f"❌ 排入摘要整理失敗: {e}")
+
+    def _refresh_summary(self, memory_id, student_id):
+        """把尚未納入摘要的對話併進滾動摘要"""
+        try:
+            with db.connection_context():
+                memory = StudentMemory.get_or_none(StudentMemory.id == memory_id)
+                if memory is None:
+                    return
+
+                pending = memory.turn_count - memory.summarized_turns
+                if pending <= 0:
+                    return
+
+                # 摘要落後超過環形緩衝大小時（先前摘要失敗或仍在進行），
+                # 已被擠出緩衝的對話從歷史訊息補回，避免沒摘要到卻被記為已摘要
+                turns = memory.get_recent_turns()[-pending:]
+                if len(turns) < pending:
+                    before_id = turns[0]['id'] if turns else None
+                    turns = self._load_turns_before(student_id, before_id, pending - len(turns)) + turns
+
+                summary = self._summarize_with_ai(memory.summary, turns)
+                if not summary:
+                    summary = self._summarize_fallback(memory)
+                    self._summary_fallbacks += 1
+
+                # 只更新摘要欄位，不覆蓋同時寫入的對話與主題；已摘要輪數只累加實際納入的對話，
+                # 以原本的已摘要輪數為條件，避免其他 worker 同時整理時重複累加
+                updated = StudentMemory.update(
+                    summary=summary[:MEMORY_SUMMARY_CHARS],
+                    summarized_turns=memory.summarized_turns + len(turns)
+                ).where(
+                    (StudentMemory.id == memory_id) &
+                    (StudentMemory.summarized_turns == memory.summarized_turns)
+                ).execute()
+                if not updated:
+                    self._conflicts += 1
+                    return
+                student_cache.invalidate(student_id, context_only=True)
+
+                self._summaries += 1
+                logger.debug(f"🧠 更新對話摘要 (記憶 {memory_id})：{summary[:50]}")
+
+        except Exception as e:
+            self._failed += 1
+            logger.error(f"❌ 整理對話摘要失敗 (記憶 {memory_id}): {e}")
+        finally:
+            with self._lock:
+                self._summarizing.discard(memory_id)
+
+    def _load_turns_before(self, student_id, before_id, count):
+        """讀取某則訊息之前的 count 則歷史訊息（舊到新），格式與環形緩衝相同"""
+        query = Message.select().where(Message.student == student_id)
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        messages = list(query.order_by(Message.id.desc()).limit(count))
+        return [
+            self._make_turn(msg.id, msg.content, msg.ai_response,
+                            msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'), msg.source_type)
+            for msg in reversed(messages)
+        ]
+
+    @staticmethod
+    def _summarize_with_ai(previous_summary, turns):
+        try:
+            from model_router import background_router
+
+            # 背景摘要使用獨立的路由器，失敗不會開啟回覆路徑的斷路器
+            if not background_router.is_configured() and not background_router.configure():
+                return ''
+
+            lines = []
+            for turn in turns:
+                lines.append(f"Student: {turn['content'][:200]}")
+                if turn.get('ai_response'):
+                    lines.append(f"AI: {turn['ai_response'][:200]}")
+
+            prompt = f"""Update the running summary of a student's conversation with a teaching assistant.
+Keep it under 80 words, focused on what the student is learning and still asking about.
+
+Previous summary: {previous_summary or '(none)'}
+
+New conversation:
+{chr(10).join(lines)}
+
+Updated summary:"""
+
+            response_text, _ = background_router.generate(prompt)
+            return (response_text or '').strip()
+
+        except Exception as e:
+            logger.warning(f"⚠️ AI摘要失敗，使用備用方法: {e}")
+            return ''
+
+    @staticmethod
+    def _summarize_fallback(memory):
+        topics = memory.get_topics()
+        if not topics:
+            return memory.summary or ''
+        return f"Discussed over {memory.turn_count} turns: {', '.join(topics[-5:])}."
+
+    # =================== 管理 ===================
+
+    def shutdown(self, wait=True):
+        """停止本行程的摘要執行緒"""
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+        if executor:
+            executor.shutdown(wait=wait)
+
+    def get_metrics(self):
+        """取得記憶讀寫統計"""
+        return {
+            'recent_turns': self.recent_turns,
+            'summary_every': self.summary_every,
+            'reads': self._reads,
+            'bootstrapped': self._bootstrapped,
+            'updates': self._updates,
+            'update_conflicts': self._conflicts,
+            'summaries': self._summaries,
+            'summary_fallbacks': self._summary_fallbacks,
+            'pending_summaries': len(self._summarizing),
+            'failed': self._failed
+        }
+
+# =================== 模組層級實例 ===================
+
+conversation_memory = ConversationMemory()
+
+def get_memory_context(student):
+    """取得學生的對話記憶上下文"""
+    return conversation_memory.get_context(student)
+
+def record_exchange(student, message):
+    """對話寫入後增量更新記憶"""
+    return conversation_memory.record_exchange(student, message)
+
+def merge_memory_topics(student_id, topics):
+    """併入主題標籤"""
+    return conversation_memory.merge_topics(student_id, topics)
+
+def stop_conversation_memory(wait=True):
+    """停止摘要執行緒"""
+    conversation_memory.shutdown(wait=wait)
+
+def get_conversation_memory_metrics():
+    """取得對話記憶統計"""
+    return conversation_memory.get_metrics()
+
+__all__ = [
+    'ConversationMemory',
+    'conversation_memory',
+    'get_memory_context',
+    'record_exchange',
+    'merge_memory_topics',
+    'stop_conversation_memory',
+    'get_conversation_memory_metrics'
+]
@@ -9,7 +9,7 @@ import zipfile
 import logging
 from io import StringIO
 from collections import defaultdict, Counter
-from models import Student, Message, Analysis, db
+from models import Student, Message, Analysis, db, read_replica
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +37,7 @@ def perform_data_export(export_type, export_format='json', date_range=None):
         logger.error(f"資料匯出錯誤: {e}")
         return {'success': False, 'error': str(e)}
 
+@read_replica()
 def export_comprehensive_data(timestamp, format_type, date_range=None):
     """匯出完整教學研究資料"""
     try:
@@ -312,7 +313,7 @@ def export_progress_data(timestamp, format_type, date_range=None):
     try:
         filename = f'student_progress_report_{timestamp}'
         
-        students = list(Student.select().where(~Student.name.startswith('[DEMO]')))
+        students = list(Student.select().where(Student.is_demo == False))
         progress_data = []
         
         for student in students:
@@ -488,8 +489,8 @@ def monitor_storage_usage():
                 'students': student_count,
                 'messages': message_count,
                 'analyses': analysis_count,
-                'real_students': Student.select().where(~Student.name.startswith('[DEMO]')).count(),
-                'demo_students': Student.select().where(Student.name.startswith('[DEMO]')).count()
+                'real_students': Student.select().where(Student.is_demo == False).count(),
+                'demo_students': Student.select().where(Student.is_demo == True).count()
             },
             'recommendation': recommendation,
             'last_check': datetime.datetime.now().isoformat(),
@@ -620,8 +621,7 @@ def cleanup_demo_data():
     try:
         # 找出演示學生
         demo_students = list(Student.select().where(
-            (Student.name.startswith('[DEMO]')) |
-            (Student.line_user_id.startswith('demo_'))
+            (Student.is_demo == True)
         ))
         
         deleted_count = 0
@@ -827,7 +827,7 @@ def get_recent_exports():
 def generate_class_statistics():
     """生成班級統計資料"""
     try:
-        students = list(Student.select().where(~Student.name.startswith('[DEMO]')))
+        students = list(Student.select().where(Student.is_demo == False))
         
         if not students:
             return {'status': 'no_data'}
@@ -897,7 +897,7 @@ def analyze_engagement_patterns():
     try:
         # 取得所有真實學生的訊息
         messages = list(Message.select().join(Student).where(
-            ~Student.name.startswith('[DEMO]')
+            Student.is_demo == False
         ))
         
         if not messages:
@@ -0,0 +1,157 @@
+# =================== event_dedup.py ===================
+# EMI智能教學助理系統 - LINE Webhook 事件去重
+# LINE 在 /callback 回應過慢時會重送相同事件（deliveryContext.isRedelivery），
+# 以 webhookEventId 做冪等檢查：先查行程內 LRU，再以 processed_events 唯一索引認領，
+# 重複事件在入列前就被丟棄，不會再觸發資料庫寫入或 Gemini 呼叫
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from peewee import IntegrityError
+
+from models import db, ProcessedEvent
+
+logger = logging.getLogger(__name__)
+
+# =================== 去重配置 ===================
+
+EVENT_DEDUP_TTL_HOURS = int(os.getenv('EVENT_DEDUP_TTL_HOURS', 24))
+EVENT_DEDUP_LRU_SIZE = int(os.getenv('EVENT_DEDUP_LRU_SIZE', 2048))
+
+# =================== 事件去重器 ===================
+
+class EventDeduplicator:
+    """以 webhookEventId 為鍵的兩層去重：行程內 LRU + 資料庫唯一索引"""
+
+    def __init__(self, lru_size=EVENT_DEDUP_LRU_SIZE, ttl_hours=EVENT_DEDUP_TTL_HOURS):
+        self.lru_size = max(1, lru_size)
+        self.ttl_seconds = ttl_hours * 3600
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 統計資料（僅限本行程）
+        self._accepted = 0
+        self._lru_hits = 0
+        self._db_hits = 0
+        self._redeliveries = 0
+
+    def filter_new_events(self, events):
+        """
+        回傳尚未處理過的事件，重複事件直接丟棄
+        呼叫端通常在交易中認領事件ID，接受的事件要等交易提交後再以 remember_events 記入 LRU，
+        否則交易回滾時 LRU 仍記得事件ID，LINE 重送的事件會被誤判為重複而遺失
+        """
+        new_events = []
+
+        for event in events:
+            event_id = event.get('webhookEventId')
+            is_redelivery = bool((event.get('deliveryContext') or {}).get('isRedelivery'))
+
+            if is_redelivery:
+                self._redeliveries += 1
+
+            # 沒有事件ID（舊版格式）無法去重，直接放行
+            if not event_id:
+                new_events.append(event)
+                continue
+
+            if self._seen_recently(event_id):
+                self._lru_hits += 1
+                logger.info(f"🔁 丟棄重複事件 (LRU): {event_id}")
+                continue
+
+            if not self._claim(event_id, is_redelivery):
+                self._db_hits += 1
+                self._remember(event_id)
+                logger.info(f"🔁 丟棄重複事件 (DB): {event_id}")
+                continue
+
+            self._accepted += 1
+            new_events.append(event)
+
+        return new_events
+
+    def remember_events(self, events):
+        """認領事件ID的交易提交後，把接受的事件記入行程內 LRU"""
+        for event in events:
+            event_id = event.get('webhookEventId')
+            if event_id:
+                self._remember(event_id)
+
+    def _seen_recently(self, event_id):
+        """檢查行程內 LRU，過期的項目視為未見過"""
+        with self._lock:
+            seen_at = self._recent.get(event_id)
+            if seen_at is None:
+                return False
+
+            if time.time() - seen_at > self.ttl_seconds:
+                del self._recent[event_id]
+                return False
+
+            self._recent.move_to_end(event_id)
+            return True
+
+    def _remember(self, event_id):
+        """記錄到行程內 LRU"""
+        with self._lock:
+            self._recent[event_id] = time.time()
+            self._recent.move_to_end(event_id)
+            while len(self._recent) > self.lru_size:
+                self._recent.popitem(last=False)
+
+    def _claim(self, event_id, is_redelivery):
+        """以唯一索引認領事件ID，已存在代表其他請求或 worker 已接收過"""
+        try:
+            with db.atomic():
+                ProcessedEvent.create(event_id=event_id, is_redelivery=is_redelivery)
+            return True
+        except IntegrityError:
+            return False
+
+    def cleanup_expired(self):
+        """清理資料庫中超過保留期限的事件ID"""
+        return ProcessedEvent.cleanup_expired(hours_old=self.ttl_seconds // 3600)
+
+    def get_metrics(self):
+        """取得去重統計"""
+        return {
+            'accepted': self._accepted,
+            'duplicates_lru': self._lru_hits,
+            'duplicates_db': self._db_hits,
+            'redeliveries_seen': self._redeliveries,
+            'lru_size': len(self._recent),
+            'ttl_hours': self.ttl_seconds // 3600
+        }
+
+# =================== 模組層級實例 ===================
+
+event_deduplicator = EventDeduplicator()
+
+def filter_duplicate_events(events):
+    """過濾掉已處理過的 LINE 事件"""
+    return event_deduplicator.filter_new_events(events)
+
+def remember_accepted_events(events):
+    """交易提交後記錄已接受的事件ID"""
+    event_deduplicator.remember_events(events)
+
+def cleanup_expired_events():
+    """清理過期的事件ID"""
+    return event_deduplicator.cleanup_expired()
+
+def get_event_dedup_metrics():
+    """取得事件去重統計"""
+    return event_deduplicator.get_metrics()
+
+__all__ = [
+    'EventDeduplicator',
+    'event_deduplicator',
+    'filter_duplicate_events',
+    'remember_accepted_events',
+    'cleanup_expired_events',
+    'get_event_dedup_metrics'
+]
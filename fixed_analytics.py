@@ -6,7 +6,7 @@ import json
 import datetime
 import logging
 from collections import defaultdict, Counter
-from models import Student, Message, Analysis, db
+from models import Student, Message, Analysis, db, read_replica
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +16,7 @@ class RealDataAnalytics:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         
+    @read_replica()
     def get_real_teaching_insights_data(self):
         """Get real teaching insights data from database"""
         try:
@@ -99,7 +100,7 @@ class RealDataAnalytics:
         try:
             # Get real students (exclude demo data)
             real_students = list(Student.select().where(
-                ~Student.name.startswith('[DEMO]')
+                Student.is_demo == False
             ))
             
             if not real_students:
@@ -187,7 +188,7 @@ class RealDataAnalytics:
         """Get real student performance data"""
         try:
             real_students = list(Student.select().where(
-                ~Student.name.startswith('[DEMO]')
+                Student.is_demo == False
             ))
             
             students_data = []
@@ -249,7 +250,7 @@ class RealDataAnalytics:
         """Get real system statistics"""
         try:
             total_students = Student.select().count()
-            real_students = Student.select().where(~Student.name.startswith('[DEMO]')).count()
+            real_students = Student.select().where(Student.is_demo == False).count()
             demo_students = total_students - real_students
             
             total_messages = Message.select().count()
@@ -257,7 +258,7 @@ class RealDataAnalytics:
             
             # Calculate average engagement from real students only
             real_student_records = list(Student.select().where(
-                ~Student.name.startswith('[DEMO]')
+                Student.is_demo == False
             ))
             
             if real_student_records:
@@ -270,7 +271,7 @@ class RealDataAnalytics:
             yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
             active_students = Student.select().where(
                 (Student.last_active > yesterday) & 
-                (~Student.name.startswith('[DEMO]'))
+                (Student.is_demo == False)
             ).count()
             
             return {
@@ -340,7 +341,7 @@ class RealDataAnalytics:
         try:
             # Get real students with actual messages
             real_students = list(Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
+                (Student.is_demo == False) &
                 (Student.message_count > 0)
             ))
             
@@ -552,8 +553,8 @@ class RealDataAnalytics:
                     'students': student_count,
                     'messages': message_count,
                     'analyses': analysis_count,
-                    'real_students': Student.select().where(~Student.name.startswith('[DEMO]')).count(),
-                    'demo_students': Student.select().where(Student.name.startswith('[DEMO]')).count()
+                    'real_students': Student.select().where(Student.is_demo == False).count(),
+                    'demo_students': Student.select().where(Student.is_demo == True).count()
                 },
                 'recommendation': self._get_storage_recommendation(usage_percentage),
                 'last_check': datetime.datetime.now().isoformat(),
@@ -651,7 +652,7 @@ def get_real_student_recommendations():
     """Get real student recommendations based on actual data"""
     try:
         real_students = list(Student.select().where(
-            ~Student.name.startswith('[DEMO]')
+            Student.is_demo == False
         ))
         
         if not real_students:
@@ -76,13 +76,54 @@ def worker_int(worker):
 def post_fork(server, worker):
     """Worker 進程分叉後執行"""
     server.log.info(f"🔧 Worker {worker.pid} 已啟動")
+    
+    # 丟棄從 master 繼承的資料庫連線狀態，本 worker 第一次查詢時才建立自己的連線
+    try:
+        from models import reset_database_after_fork
+        reset_database_after_fork()
+    except Exception as e:
+        server.log.error(f"❌ Worker {worker.pid} 資料庫連線重設失敗: {e}")
+    
+    # 背景執行緒無法跨越 fork，必須在每個 worker 內重新啟動
+    try:
+        from app import start_background_workers
+        start_background_workers()
+    except Exception as e:
+        server.log.error(f"❌ Worker {worker.pid} 背景工作啟動失敗: {e}")
 
 def pre_fork(server, worker):
     """Worker 進程分叉前執行"""
-    pass
+    # preload_app 時 master 在匯入 app 時連過資料庫，分叉前關閉，worker 不共用同一個 socket
+    try:
+        from models import prepare_database_for_fork
+        prepare_database_for_fork()
+    except Exception as e:
+        server.log.error(f"❌ 分叉前資料庫連線關閉失敗: {e}")
 
 def worker_exit(server, worker):
     """Worker 退出時執行"""
+    # 等待進行中的 Webhook 工作完成，未認領的工作留在佇列由其他 worker 處理
+    try:
+        from webhook_queue import stop_webhook_workers
+        from topic_tagger import stop_topic_tagger
+        from conversation_memory import stop_conversation_memory
+        from maintenance_scheduler import stop_maintenance_scheduler
+        stop_maintenance_scheduler()
+        stop_webhook_workers(timeout=graceful_timeout)
+        # Webhook 工作可能剛排入主題標記與摘要整理，等它們寫完
+        stop_topic_tagger(wait=True)
+        stop_conversation_memory(wait=True)
+    except Exception as e:
+        server.log.error(f"❌ Worker {worker.pid} 背景工作停止失敗: {e}")
+    
+    # 寫入延遲緩衝中的學生活動時間
+    try:
+        from activity_buffer import stop_activity_buffer
+        flushed = stop_activity_buffer()
+        server.log.info(f"🕒 Worker {worker.pid} 已寫入 {flushed} 位學生的活動時間")
+    except Exception as e:
+        server.log.error(f"❌ Worker {worker.pid} 活動時間寫入失敗: {e}")
+    
     server.log.info(f"🔻 Worker {worker.pid} 已退出")
 
 # 健康檢查和資源清理
@@ -21,15 +21,13 @@ class PureRealDataAnalytics:
         try:
             # 只檢查真實學生
             real_students = Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ).count()
             
             # 檢查是否有真實對話
             if real_students > 0:
                 real_messages = Message.select().join(Student).where(
-                    (~Student.name.startswith('[DEMO]')) &
-                    (~Student.line_user_id.startswith('demo_')) &
+                    (Student.is_demo == False) &
                     (Message.source_type != 'demo')
                 ).count()
                 return real_messages > 0
@@ -44,8 +42,7 @@ class PureRealDataAnalytics:
         """取得真實學生數量"""
         try:
             return Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ).count()
         except Exception as e:
             self.logger.error(f"取得真實學生數量錯誤: {e}")
@@ -55,8 +52,7 @@ class PureRealDataAnalytics:
         """取得真實訊息數量"""
         try:
             return Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.source_type != 'demo')
             ).count()
         except Exception as e:
@@ -112,8 +108,7 @@ class PureRealDataAnalytics:
             
             # 取得真實對話摘要
             real_students = list(Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Student.message_count > 0)
             ))
             
@@ -188,8 +183,7 @@ class PureRealDataAnalytics:
                 }
             
             real_students = list(Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ))
             
             recommendations = []
@@ -335,8 +329,7 @@ class PureRealDataAnalytics:
             
             # 計算演示資料量（用於清理參考）
             demo_student_count = Student.select().where(
-                (Student.name.startswith('[DEMO]')) |
-                (Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == True)
             ).count()
             
             demo_message_count = Message.select().where(
@@ -345,14 +338,12 @@ class PureRealDataAnalytics:
             
             # 真實分析記錄
             real_analysis_count = Analysis.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ).count()
             
             # 演示分析記錄
             demo_analysis_count = Analysis.select().join(Student).where(
-                (Student.name.startswith('[DEMO]')) |
-                (Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == True)
             ).count()
             
             # 估算儲存大小
@@ -377,8 +368,7 @@ class PureRealDataAnalytics:
             
             # 計算每日增長（只計算真實資料）
             recent_real_messages = Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.source_type != 'demo') &
                 (Message.timestamp > datetime.datetime.now() - datetime.timedelta(days=1))
             ).count()
@@ -482,8 +472,7 @@ class PureRealDataAnalytics:
         """取得真實問題分類"""
         try:
             real_messages = list(Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.message_type == 'question') &
                 (Message.source_type != 'demo')
             ))
@@ -530,8 +519,7 @@ class PureRealDataAnalytics:
         """取得真實參與度分析"""
         try:
             real_students = list(Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ))
             
             if not real_students:
@@ -552,15 +540,13 @@ class PureRealDataAnalytics:
             previous_week = datetime.datetime.now() - datetime.timedelta(days=14)
             
             recent_messages = Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.source_type != 'demo') &
                 (Message.timestamp > recent_week)
             ).count()
             
             previous_messages = Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.source_type != 'demo') &
                 (Message.timestamp.between(previous_week, recent_week))
             ).count()
@@ -594,8 +580,7 @@ class PureRealDataAnalytics:
         try:
             thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
             real_messages = list(Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.source_type != 'demo') &
                 (Message.timestamp > thirty_days_ago)
             ))
@@ -627,8 +612,7 @@ class PureRealDataAnalytics:
         """取得真實學生表現資料"""
         try:
             real_students = list(Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ))
             
             students_data = []
@@ -687,16 +671,14 @@ class PureRealDataAnalytics:
             real_message_count = self.get_real_message_count()
             
             real_questions = Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.message_type == 'question') &
                 (Message.source_type != 'demo')
             ).count()
             
             # 計算平均參與度（只基於真實學生）
             real_student_records = list(Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == False)
             ))
             
             if real_student_records:
@@ -708,8 +690,7 @@ class PureRealDataAnalytics:
             # 計算活躍學生（24小時內有活動）
             yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
             active_students = Student.select().where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Student.last_active > yesterday)
             ).count()
             
@@ -749,8 +730,7 @@ class PureRealDataAnalytics:
         """取得最近的真實訊息"""
         try:
             return list(Message.select().join(Student).where(
-                (~Student.name.startswith('[DEMO]')) &
-                (~Student.line_user_id.startswith('demo_')) &
+                (Student.is_demo == False) &
                 (Message.source_type != 'demo')
             ).order_by(Message.timestamp.desc()).limit(10))
         except Exception as e:
@@ -978,8 +958,7 @@ class RealDataHealthChecker:
         """檢查資料清潔度"""
         try:
             demo_students = Student.select().where(
-                (Student.name.startswith('[DEMO]')) |
-                (Student.line_user_id.startswith('demo_'))
+                (Student.is_demo == True)
             ).count()
             
             demo_messages = Message.select().where(
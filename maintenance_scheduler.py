@@ -0,0 +1,304 @@
+# =================== maintenance_scheduler.py ===================
+# EMI智能教學助理系統 - 背景維護排程
+# 會話清理原本在首頁每次瀏覽時執行，且每個 gunicorn worker 匯入 app 時再執行一次；
+# run_maintenance_tasks 則沒有任何排程。這裡在每個 worker 分叉後啟動一個排程執行緒，
+# 各任務以加上抖動的間隔觸發，透過資料庫協調讓同一時間只有一個 worker 執行：
+#   - 所有資料庫：maintenance_leases 表的條件式 UPDATE（租約＋最短間隔），worker 中途結束時租約逾時釋放
+#   - PostgreSQL：執行期間另外持有 pg_try_advisory_lock，連線中斷時由資料庫自動釋放
+
+import os
+import time
+import zlib
+import random
+import socket
+import logging
+import threading
+
+from peewee import PostgresqlDatabase
+
+from models import (
+    db, Student, ConversationSession, WebhookJob, ProcessedEvent, CachedAnswer,
+    MessageTopic, MaintenanceLease, DataVersion, reconcile_student_counters
+)
+from sessionizer import sessionize_messages
+
+logger = logging.getLogger(__name__)
+
+# =================== 排程配置 ===================
+
+MAINTENANCE_SCHEDULER_ENABLED = os.getenv('MAINTENANCE_SCHEDULER_ENABLED', 'true').lower() != 'false'
+
+# 間隔的隨機抖動比例，避免各 worker 同時醒來競爭
+MAINTENANCE_JITTER = float(os.getenv('MAINTENANCE_JITTER', 0.1))
+
+# worker 啟動後第一次嘗試前的等待秒數
+MAINTENANCE_STARTUP_DELAY = float(os.getenv('MAINTENANCE_STARTUP_DELAY', 30))
+
+# 租約時間：執行中的 worker 異常結束時，超過此時間（秒）其他 worker 才能接手
+MAINTENANCE_LEASE_SECONDS = int(os.getenv('MAINTENANCE_LEASE_SECONDS', 600))
+
+SESSION_TIMEOUT_MINUTES = int(os.getenv('SESSION_TIMEOUT_MINUTES', 30))
+
+def _task_interval(name, default):
+    """讀取任務間隔（秒），例如 MAINTENANCE_SESSION_EXPIRY_INTERVAL"""
+    return float(os.getenv(f'MAINTENANCE_{name.upper()}_INTERVAL', default))
+
+# =================== 維護任務 ===================
+
+def expire_inactive_sessions():
+    """結束非活躍會話"""
+    return ConversationSession.auto_end_inactive_sessions(timeout_minutes=SESSION_TIMEOUT_MINUTES)
+
+def cleanup_incomplete_registrations():
+    """清理超過7天的未完成註冊"""
+    return Student.cleanup_incomplete_registrations(days_old=7)
+
+def rollup_counters():
+    """修復反正規化的計數與主題對應"""
+    return {
+        'student_counters_fixed': reconcile_student_counters(),
+        'topic_links_cleanup': MessageTopic.cleanup_orphans()
+    }
+
+def refresh_caches():
+    """清理已到期的快取回答、事件去重紀錄與已完成的 Webhook 工作"""
+    return {
+        'cached_answers_cleanup': CachedAnswer.cleanup_expired(),
+        'expired_events_cleanup': ProcessedEvent.cleanup_expired(hours_old=24),
+        'webhook_jobs_cleanup': WebhookJob.cleanup_finished_jobs(hours_old=24)
+    }
+
+def count_changed_rows(result):
+    """任務結果中的變更列數：整數直接使用，字典加總其中的數值（錯誤訊息等非數值略過）"""
+    if isinstance(result, bool):
+        return 0
+    if isinstance(result, (int, float)):
+        return max(0, int(result))
+    if isinstance(result, dict):
+        return sum(count_changed_rows(value) for value in result.values())
+    return 0
+
+class MaintenanceTask:
+    """一個定期任務與其本行程的執行統計"""
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = max(1.0, interval)
+        self.next_run = 0.0
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_run_at = None
+        self.last_duration_ms = None
+        self.max_duration_ms = 0.0
+        self.total_duration_ms = 0.0
+        self.last_result = None
+        self.last_error = None
+
+    def schedule_next(self, now, delay=None):
+        """以抖動後的間隔排定下一次嘗試"""
+        if delay is None:
+            delay = self.interval * random.uniform(1 - MAINTENANCE_JITTER, 1 + MAINTENANCE_JITTER)
+        self.next_run = now + delay
+
+    @property
+    def advisory_key(self):
+        """PostgreSQL advisory lock 使用的固定整數鍵"""
+        return zlib.crc32(f"emi-maintenance:{self.name}".encode('utf-8'))
+
+    def get_metrics(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'last_run_at': self.last_run_at,
+            'last_duration_ms': self.last_duration_ms,
+            'max_duration_ms': round(self.max_duration_ms, 1),
+            'avg_duration_ms': round(self.total_duration_ms / self.runs, 1) if self.runs else None,
+            'last_result': self.last_result,
+            'last_error': self.last_error
+        }
+
+def build_default_tasks():
+    return [
+        MaintenanceTask('sessionize', sessionize_messages, _task_interval('sessionize', 600)),
+        MaintenanceTask('session_expiry', expire_inactive_sessions, _task_interval('session_expiry', 300)),
+        MaintenanceTask('registration_cleanup', cleanup_incomplete_registrations, _task_interval('registration_cleanup', 3600)),
+        MaintenanceTask('counter_rollup', rollup_counters, _task_interval('counter_rollup', 6 * 3600)),
+        MaintenanceTask('cache_refresh', refresh_caches, _task_interval('cache_refresh', 3600)),
+    ]
+
+# =================== 排程器 ===================
+
+class MaintenanceScheduler:
+    """每個行程一個排程執行緒；到期時先取得資料庫租約，取得者才執行任務"""
+
+    def __init__(self, tasks=None, enabled=MAINTENANCE_SCHEDULER_ENABLED,
+                 lease_seconds=MAINTENANCE_LEASE_SECONDS, startup_delay=MAINTENANCE_STARTUP_DELAY):
+        self.tasks = tasks if tasks is not None else build_default_tasks()
+        self.enabled = enabled
+        self.lease_seconds = lease_seconds
+        self.startup_delay = startup_delay
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._leases_ready = False
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        """啟動本行程的排程執行緒（分叉後重新啟動），回傳是否剛啟動"""
+        if not self.enabled:
+            return False
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return False
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return False
+            self._pid = os.getpid()
+            self._leases_ready = False
+            self._stop_event = threading.Event()
+
+            now = time.time()
+            for task in self.tasks:
+                task.schedule_next(now, self.startup_delay + random.uniform(0, task.interval * MAINTENANCE_JITTER))
+
+            self._thread = threading.Thread(target=self._run, name='maintenance-scheduler', daemon=True)
+            self._thread.start()
+            logger.info(f"🗓️ 背景維護排程已啟動 (PID: {self._pid}, 任務: {[task.name for task in self.tasks]})")
+            return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            now = time.time()
+            for task in self.tasks:
+                if self._stop_event.is_set():
+                    break
+                if task.next_run <= now:
+                    self.run_task(task)
+                    task.schedule_next(time.time())
+
+            wait = min(task.next_run for task in self.tasks) - time.time() if self.tasks else 60
+            self._stop_event.wait(max(1.0, wait))
+
+    def run_task(self, task):
+        """嘗試取得租約並執行任務，回傳是否由本行程執行"""
+        owner = self.owner
+        advisory = isinstance(db, PostgresqlDatabase)
+        try:
+            # 整個任務使用同一條連線，advisory lock 才會在同一個工作階段取得與釋放
+            with db.connection_context():
+                if not self._leases_ready:
+                    MaintenanceLease.ensure([t.name for t in self.tasks])
+                    self._leases_ready = True
+
+                if advisory and not db.execute_sql('SELECT pg_try_advisory_lock(%s)', (task.advisory_key,)).fetchone()[0]:
+                    task.skipped += 1
+                    return False
+                try:
+                    min_interval = task.interval * (1 - MAINTENANCE_JITTER)
+                    if not MaintenanceLease.claim(task.name, owner, min_interval, self.lease_seconds):
+                        task.skipped += 1
+                        return False
+                    self._execute(task, owner)
+                    return True
+                finally:
+                    if advisory:
+                        db.execute_sql('SELECT pg_advisory_unlock(%s)', (task.advisory_key,))
+
+        except Exception as e:
+            task.failures += 1
+            task.last_error = str(e)
+            logger.error(f"❌ 維護任務 {task.name} 排程失敗: {e}")
+            return False
+
+    def _execute(self, task, owner):
+        started = time.perf_counter()
+        error = None
+        task.last_result = None
+        try:
+            task.last_result = task.func()
+        except Exception as e:
+            error = str(e)
+            task.failures += 1
+            logger.error(f"❌ 維護任務 {task.name} 執行失敗: {e}")
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        task.runs += 1
+        task.last_run_at = time.time()
+        task.last_duration_ms = duration_ms
+        task.max_duration_ms = max(task.max_duration_ms, duration_ms)
+        task.total_duration_ms += duration_ms
+        task.last_error = error
+
+        MaintenanceLease.release(task.name, owner, duration_ms, error)
+        # 有實際變更時才讓依資料水位快取的頁面失效；沒有變更的例行執行不影響快取
+        if count_changed_rows(task.last_result):
+            DataVersion.bump('maintenance')
+        logger.info(f"🧹 維護任務 {task.name} 完成 ({duration_ms}ms): {task.last_result}")
+
+    def stop(self, timeout=5):
+        """停止本行程的排程執行緒（執行中的任務會跑完）"""
+        if self._pid != os.getpid():
+            return
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=timeout)
+
+    def get_metrics(self):
+        """取得本行程的排程統計（各任務只有取得租約的 worker 會有執行紀錄）"""
+        return {
+            'enabled': self.enabled,
+            'running': bool(self._pid == os.getpid() and self._thread and self._thread.is_alive()),
+            'tasks': {task.name: task.get_metrics() for task in self.tasks}
+        }
+
+# =================== 模組層級實例 ===================
+
+maintenance_scheduler = MaintenanceScheduler()
+
+def start_maintenance_scheduler():
+    """啟動本行程的背景維護排程"""
+    return maintenance_scheduler.start()
+
+def stop_maintenance_scheduler(timeout=5):
+    """停止本行程的背景維護排程"""
+    maintenance_scheduler.stop(timeout=timeout)
+
+def get_maintenance_metrics():
+    """取得背景維護排程統計"""
+    return maintenance_scheduler.get_metrics()
+
+def get_last_maintenance_runs():
+    """從資料庫讀取各任務最後一次執行（不論由哪個 worker 執行）"""
+    try:
+        return {
+            lease.task: {
+                'owner': lease.owner,
+                'last_started_at': lease.last_started_at,
+                'last_finished_at': lease.last_finished_at,
+                'last_duration_ms': lease.last_duration_ms,
+                'last_error': lease.last_error
+            }
+            for lease in MaintenanceLease.select()
+        }
+    except Exception as e:
+        logger.error(f"❌ 讀取維護任務紀錄失敗: {e}")
+        return {}
+
+__all__ = [
+    'MaintenanceTask',
+    'MaintenanceScheduler',
+    'count_changed_rows',
+    'maintenance_scheduler',
+    'start_maintenance_scheduler',
+    'stop_maintenance_scheduler',
+    'get_maintenance_metrics',
+    'get_last_maintenance_runs'
+]
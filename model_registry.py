@@ -0,0 +1,230 @@
+# =================== model_registry.py ===================
+# EMI智能教學助理系統 - Gemini 模型可用性登錄檔
+# 取代啟動時逐一呼叫 generate_content("Test") 探測模型的做法：
+# 可用性與延遲結果持久化到磁碟並設有 TTL，啟動時直接載入（不呼叫任何 API），
+# 過期時由背景執行緒以 genai.list_models()（不消耗生成配額）重新整理
+
+import os
+import json
+import time
+import logging
+import threading
+
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+# =================== 登錄檔配置 ===================
+
+MODEL_REGISTRY_PATH = os.getenv('MODEL_REGISTRY_PATH', 'model_registry.json')
+MODEL_REGISTRY_TTL = int(os.getenv('MODEL_REGISTRY_TTL', 6 * 3600))  # 秒
+
+# 延遲採用指數移動平均，避免單次尖峰影響排序
+LATENCY_EMA_ALPHA = 0.2
+
+# 實際呼叫結果最多每隔多久寫回磁碟一次（秒）
+SAVE_INTERVAL = 60
+
+# =================== 模型登錄檔 ===================
+
+class ModelRegistry:
+    """模型可用性與延遲的持久化紀錄（每個行程一份，透過檔案在行程間共享）"""
+
+    def __init__(self, path=MODEL_REGISTRY_PATH, ttl_seconds=MODEL_REGISTRY_TTL):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._models = {}
+        self._refreshed_at = 0.0
+        self._last_saved = 0.0
+        self._refresh_thread = None
+        self._listeners = []
+        self.load()
+
+    # =================== 讀寫 ===================
+
+    def load(self):
+        """
+        從磁碟載入登錄檔並與記憶體中的紀錄合併；檔案不存在或損毀時視為空白
+        記憶體中較新（尚未寫回）的呼叫結果與延遲不會被檔案內容覆蓋
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            with self._lock:
+                self._models = self._merge_models(data.get('models', {}), self._models)
+                self._refreshed_at = max(self._refreshed_at, data.get('refreshed_at', 0.0))
+            logger.info(f"✅ 已載入模型登錄檔: {len(self._models)} 個模型")
+            return True
+        except FileNotFoundError:
+            logger.info("ℹ️ 尚無模型登錄檔，啟動後將於背景建立")
+            return False
+        except Exception as e:
+            logger.warning(f"⚠️ 模型登錄檔讀取失敗，將重新建立: {e}")
+            return False
+
+    @staticmethod
+    def _merge_models(stored, current):
+        """每個模型取 last_checked 較新的紀錄；較新的紀錄沒有延遲時沿用另一份的延遲"""
+        merged = {name: dict(entry) for name, entry in stored.items()}
+        for name, entry in current.items():
+            other = merged.get(name)
+            if other is None or entry.get('last_checked', 0) >= other.get('last_checked', 0):
+                newer, older = dict(entry), other or {}
+            else:
+                newer, older = other, entry
+            if newer.get('latency_ms') is None:
+                newer['latency_ms'] = older.get('latency_ms')
+            merged[name] = newer
+        return merged
+
+    def save(self):
+        """以暫存檔加原子替換寫入，避免其他行程讀到寫一半的檔案"""
+        try:
+            with self._lock:
+                data = {
+                    'refreshed_at': self._refreshed_at,
+                    'models': self._models
+                }
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self._last_saved = time.time()
+        except Exception as e:
+            logger.error(f"❌ 模型登錄檔寫入失敗: {e}")
+
+    # =================== 查詢 ===================
+
+    def is_stale(self):
+        """登錄檔是否超過 TTL"""
+        return time.time() - self._refreshed_at > self.ttl_seconds
+
+    def is_available(self, model_name):
+        """模型是否可用；沒有紀錄的模型先樂觀視為可用"""
+        with self._lock:
+            entry = self._models.get(model_name)
+        return entry is None or entry.get('available', True)
+
+    def get_available_models(self, candidates):
+        """依原本的優先順序回傳可用的候選模型"""
+        return [name for name in candidates if self.is_available(name)]
+
+    def get_latency_ms(self, model_name):
+        """取得模型的平均延遲（毫秒），沒有紀錄時回傳 None"""
+        with self._lock:
+            return (self._models.get(model_name) or {}).get('latency_ms')
+
+    def get_snapshot(self):
+        """取得登錄檔內容（供健康檢查與統計使用）"""
+        with self._lock:
+            return {
+                'refreshed_at': self._refreshed_at,
+                'stale': self.is_stale(),
+                'models': {name: dict(entry) for name, entry in self._models.items()}
+            }
+
+    # =================== 更新 ===================
+
+    def record_result(self, model_name, success, latency_ms=None, error=None):
+        """記錄實際呼叫的結果，延遲以指數移動平均累積"""
+        with self._lock:
+            entry = self._models.setdefault(model_name, {'available': True, 'latency_ms': None})
+            entry['last_checked'] = time.time()
+            if success:
+                entry['available'] = True
+                entry['error'] = None
+                if latency_ms is not None:
+                    previous = entry.get('latency_ms')
+                    entry['latency_ms'] = round(latency_ms if previous is None else
+                                                previous + LATENCY_EMA_ALPHA * (latency_ms - previous), 1)
+            elif error:
+                entry['error'] = str(error)[:200]
+
+        if time.time() - self._last_saved > SAVE_INTERVAL:
+            self.save()
+
+    def mark_unavailable(self, model_name, error=None):
+        """標記模型不可用（例如 404 模型不存在）"""
+        with self._lock:
+            entry = self._models.setdefault(model_name, {'latency_ms': None})
+            entry['available'] = False
+            entry['error'] = str(error)[:200] if error else None
+            entry['last_checked'] = time.time()
+        self.save()
+
+    def refresh(self, candidates):
+        """以 list_models() 重新確認哪些候選模型存在且支援 generateContent"""
+        api_key = os.environ.get('GEMINI_API_KEY')
+        if not api_key:
+            logger.warning("⚠️ 沒有 GEMINI_API_KEY，略過模型登錄檔更新")
+            return False
+
+        # 其他行程可能剛更新過，先讀回最新的檔案
+        self.load()
+        if not self.is_stale():
+            self._notify_listeners()
+            return True
+
+        try:
+            genai.configure(api_key=api_key)
+            started = time.time()
+            listed = {
+                m.name.replace('models/', ''): m
+                for m in genai.list_models()
+                if 'generateContent' in getattr(m, 'supported_generation_methods', [])
+            }
+            list_latency = (time.time() - started) * 1000
+
+            with self._lock:
+                for name in candidates:
+                    entry = self._models.setdefault(name, {'latency_ms': None})
+                    entry['available'] = name in listed
+                    entry['error'] = None if name in listed else 'not listed for this API key'
+                    entry['last_checked'] = time.time()
+                self._refreshed_at = time.time()
+
+            self.save()
+            available_count = len(self.get_available_models(candidates))
+            logger.info(f"✅ 模型登錄檔已更新: {available_count}/{len(candidates)} 個可用 ({list_latency:.0f}ms)")
+            self._notify_listeners()
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ 模型登錄檔更新失敗: {e}")
+            return False
+
+    def refresh_in_background(self, candidates):
+        """登錄檔過期時在背景執行緒更新，不阻塞啟動與請求"""
+        if not self.is_stale():
+            return False
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return False
+
+        self._refresh_thread = threading.Thread(
+            target=self.refresh, args=(list(candidates),),
+            name='model-registry-refresh', daemon=True
+        )
+        self._refresh_thread.start()
+        return True
+
+    def add_listener(self, callback):
+        """註冊登錄檔更新後的回呼（用於重新挑選主要模型）"""
+        self._listeners.append(callback)
+
+    def _notify_listeners(self):
+        for callback in self._listeners:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"❌ 模型登錄檔回呼失敗: {e}")
+
+# =================== 模組層級實例 ===================
+
+model_registry = ModelRegistry()
+
+__all__ = [
+    'ModelRegistry',
+    'model_registry',
+    'MODEL_REGISTRY_TTL'
+]
@@ -0,0 +1,434 @@
+# =================== model_router.py ===================
+# EMI智能教學助理系統 - 統一的 Gemini 模型路由器
+# 取代 app.py 的 model/backup_models/CURRENT_MODEL、utils.py 的 model_usage_stats/
+# switch_to_available_model，以及 models.py 每次呼叫都新建 GenerativeModel 的做法：
+# 單一路由器持有所有模型用戶端，追蹤每個模型的 p50/p95 延遲與錯誤率，
+# 連續 429/5xx 時開啟斷路器，每次呼叫都送往最快的健康模型
+# 回覆學生使用 ai_router；主題標籤、對話摘要與分析等背景工作使用 background_router，
+# 兩者的延遲統計與斷路器分開，背景工作的失敗不會讓回覆路徑的模型斷路
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import google.generativeai as genai
+
+from model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+# =================== 路由器配置 ===================
+
+# 按優先順序排列的模型（沒有延遲資料時依此順序）
+DEFAULT_MODEL_PRIORITY = [
+    'gemini-2.5-flash',
+    'gemini-2.0-flash-exp',
+    'gemini-1.5-flash',
+    'gemini-1.5-pro',
+    'gemini-pro'
+]
+
+# 背景工作的候選模型（沿用 utils.AVAILABLE_MODELS 原有的完整清單與順序）
+BACKGROUND_MODEL_PRIORITY = [
+    # === 2025年最新穩定版本（正式發布）===
+    "gemini-2.5-flash",              # 🥇 首選：2025年6月GA，最佳性價比，支援thinking
+    "gemini-2.5-pro",                # 🥇 高級：2025年6月GA，最智能模型，適合複雜任務
+    
+    # === 2025年預覽版本（功能測試）===
+    "gemini-2.5-flash-lite",         # 💰 經濟：2025年6月預覽，最經濟高效，高吞吐量
+    
+    # === 2.0系列（穩定可靠）===
+    "gemini-2.0-flash",              # 🔄 備用：2025年2月GA，多模態支援
+    "gemini-2.0-flash-lite",         # 🔄 輕量：成本優化版本
+    "gemini-2.0-pro-experimental",   # 🧪 實驗：最佳編碼性能（實驗版）
+    
+    # === 1.5系列（舊版，2025年4月後新專案不可用）===
+    "gemini-1.5-flash",              # 📦 舊版：僅限已有使用記錄的專案
+    "gemini-1.5-pro",                # 📦 舊版：僅限已有使用記錄的專案
+    
+    # === 最後備案 ===
+    "gemini-pro"                     # 📦 最後備案：舊版相容性
+]
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('AI_CIRCUIT_FAILURE_THRESHOLD', 3))
+CIRCUIT_COOLDOWN_SECONDS = int(os.getenv('AI_CIRCUIT_COOLDOWN_SECONDS', 60))
+CIRCUIT_MAX_COOLDOWN_SECONDS = 15 * 60
+LATENCY_WINDOW = 100
+MIN_LATENCY_SAMPLES = 3
+
+# 剩餘時間預算少於此秒數時不再嘗試下一個模型
+MIN_ATTEMPT_SECONDS = float(os.getenv('AI_MIN_ATTEMPT_SECONDS', 2))
+
+# 斷路器狀態
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+# =================== 錯誤分類 ===================
+
+class CircuitOpenError(Exception):
+    """斷路器未放行這次呼叫（開啟中，或 half_open 的試探呼叫已被其他請求取走）"""
+
+class AllModelsUnavailableError(Exception):
+    """所有候選模型都無法產生回應"""
+
+    def __init__(self, message, last_error=None, attempted=None, deadline_exceeded=False):
+        super().__init__(message)
+        self.last_error = last_error
+        self.attempted = attempted or []
+        self.deadline_exceeded = deadline_exceeded
+
+def classify_error(error):
+    """把 Gemini API 錯誤分類為 rate_limit / server / not_found / other"""
+    error_msg = str(error).lower()
+    if '429' in error_msg or 'quota' in error_msg or 'resource exhausted' in error_msg or 'resource_exhausted' in error_msg:
+        return 'rate_limit'
+    if '404' in error_msg or 'not found' in error_msg:
+        return 'not_found'
+    if any(code in error_msg for code in ('500', '502', '503', '504', 'internal', 'unavailable', 'deadline', 'timeout', 'timed out')):
+        return 'server'
+    return 'other'
+
+# =================== 單一模型健康狀態 ===================
+
+class ModelHealth:
+    """單一模型的延遲視窗、錯誤率與斷路器"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+        self.cooldown = CIRCUIT_COOLDOWN_SECONDS
+        self.trial_in_progress = False
+        self.last_error = None
+        self.last_used = None
+
+    def percentile(self, pct):
+        """取得延遲百分位數（毫秒）"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+        return ordered[index]
+
+    def error_rate(self):
+        """最近視窗內的錯誤率"""
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - (sum(self.outcomes) / len(self.outcomes))
+
+    def current_state(self, now):
+        """目前的斷路器狀態（不改變狀態）：冷卻結束的 open 視為 half_open"""
+        if self.state == CIRCUIT_OPEN and now - self.opened_at >= self.cooldown:
+            return CIRCUIT_HALF_OPEN
+        return self.state
+
+    def allow_request(self, now):
+        """斷路器是否允許呼叫（只讀取狀態，供路由排序與狀態回報使用）"""
+        state = self.current_state(now)
+        if state == CIRCUIT_CLOSED:
+            return True
+        if state == CIRCUIT_HALF_OPEN:
+            # 冷卻剛結束的 open 還沒有試探呼叫；half_open 則看試探是否已被取走
+            return self.state == CIRCUIT_OPEN or not self.trial_in_progress
+        return False
+
+    def try_acquire(self, now):
+        """
+        實際呼叫前取得通行權（呼叫端須持有路由器的鎖）：
+        關閉狀態直接放行；冷卻結束後由第一個取得者轉為 half_open 並佔用唯一的試探呼叫
+        """
+        state = self.current_state(now)
+        if state == CIRCUIT_CLOSED:
+            return True
+        if state != CIRCUIT_HALF_OPEN:
+            return False
+        if self.state == CIRCUIT_OPEN:
+            self.state = CIRCUIT_HALF_OPEN
+            self.trial_in_progress = False
+        if self.trial_in_progress:
+            return False
+        self.trial_in_progress = True
+        return True
+
+    def record_success(self, latency_ms):
+        self.calls += 1
+        self.latencies.append(latency_ms)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_used = time.time()
+        if self.state != CIRCUIT_CLOSED:
+            logger.info(f"✅ 模型 {self.name} 恢復正常，關閉斷路器")
+        self.state = CIRCUIT_CLOSED
+        self.cooldown = CIRCUIT_COOLDOWN_SECONDS
+        self.trial_in_progress = False
+
+    def record_failure(self, error, kind):
+        self.calls += 1
+        self.errors += 1
+        self.outcomes.append(False)
+        self.last_error = str(error)[:200]
+        self.last_used = time.time()
+        self.trial_in_progress = False
+
+        # 只有 429/5xx/模型不存在會累積斷路器失敗次數
+        if kind not in ('rate_limit', 'server', 'not_found'):
+            return
+
+        self.consecutive_failures += 1
+        if self.state == CIRCUIT_HALF_OPEN:
+            # 試探失敗：重新開啟並加長冷卻時間
+            self.cooldown = min(self.cooldown * 2, CIRCUIT_MAX_COOLDOWN_SECONDS)
+            self._open()
+        elif kind == 'not_found' or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if kind == 'not_found':
+                self.cooldown = CIRCUIT_MAX_COOLDOWN_SECONDS
+            self._open()
+
+    def _open(self):
+        self.state = CIRCUIT_OPEN
+        self.opened_at = time.time()
+        logger.warning(f"⚡ 模型 {self.name} 斷路器開啟，{self.cooldown} 秒內不再呼叫")
+
+    def to_dict(self, now=None):
+        return {
+            'state': self.current_state(now if now is not None else time.time()),
+            'calls': self.calls,
+            'errors': self.errors,
+            'error_rate': round(self.error_rate() * 100, 1),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'consecutive_failures': self.consecutive_failures,
+            'last_error': self.last_error,
+            'last_used': self.last_used
+        }
+
+# =================== 模型路由器 ===================
+
+class ModelRouter:
+    """持有所有 Gemini 用戶端並依健康狀態與延遲路由每次呼叫"""
+
+    def __init__(self, candidates=None, registry=model_registry):
+        self.candidates = list(candidates or DEFAULT_MODEL_PRIORITY)
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._health = {name: ModelHealth(name) for name in self.candidates}
+        self._configured = False
+
+    # =================== 初始化 ===================
+
+    def configure(self, api_key=None):
+        """設定 API 金鑰（整個行程只需一次）"""
+        api_key = api_key or os.environ.get('GEMINI_API_KEY')
+        if not api_key:
+            logger.warning("⚠️ GEMINI_API_KEY 未設定，模型路由器停用")
+            self._configured = False
+            return False
+
+        genai.configure(api_key=api_key)
+        self._configured = True
+        logger.info(f"✅ 模型路由器已配置，候選模型: {len(self.candidates)} 個")
+        return True
+
+    def is_configured(self):
+        """API 金鑰與路由器是否已配置（不含斷路器狀態，見 get_circuit_summary）"""
+        return self._configured
+
+    def get_client(self, model_name):
+        """取得（或建立並快取）模型用戶端"""
+        with self._lock:
+            client = self._clients.get(model_name)
+            if client is None:
+                client = genai.GenerativeModel(model_name)
+                self._clients[model_name] = client
+                self._health.setdefault(model_name, ModelHealth(model_name))
+            return client
+
+    # =================== 路由 ===================
+
+    def get_routable_models(self):
+        """
+        取得目前可路由的模型，依延遲（p50）由快到慢排序，沒有資料的依優先順序排在後面
+        只讀取斷路器狀態；half_open 的試探呼叫在 call_model 實際呼叫前才取得
+        """
+        if not self._configured:
+            return []
+
+        now = time.time()
+        routable = []
+        with self._lock:
+            for priority, name in enumerate(self.candidates):
+                if not self.registry.is_available(name):
+                    continue
+                health = self._health[name]
+                if not health.allow_request(now):
+                    continue
+                latency = health.percentile(50) if len(health.latencies) >= MIN_LATENCY_SAMPLES else None
+                routable.append((latency is None, latency or 0, priority, name))
+
+        routable.sort()
+        return [name for _, _, _, name in routable]
+
+    def primary_model_name(self):
+        """目前會優先使用的模型"""
+        models = self.get_routable_models()
+        return models[0] if models else None
+
+    def get_backup_models(self):
+        """除了主要模型以外的可路由模型"""
+        return self.get_routable_models()[1:]
+
+    def call_model(self, model_name, prompt, generation_config=None, request_options=None):
+        """
+        呼叫指定模型並記錄結果，回傳回應文字；失敗時拋出原始例外
+        斷路器未放行（開啟中或試探呼叫已被取走）時拋出 CircuitOpenError，不呼叫模型
+        """
+        client = self.get_client(model_name)
+        health = self._health[model_name]
+
+        with self._lock:
+            if not health.try_acquire(time.time()):
+                raise CircuitOpenError(f"模型 {model_name} 斷路器未放行")
+
+        started = time.time()
+        try:
+            kwargs = {}
+            if generation_config is not None:
+                kwargs['generation_config'] = generation_config
+            if request_options is not None:
+                kwargs['request_options'] = request_options
+
+            response = client.generate_content(prompt, **kwargs)
+            text = response.text.strip() if response and response.text else ''
+            if not text:
+                raise ValueError("empty response")
+
+        except Exception as e:
+            kind = classify_error(e)
+            with self._lock:
+                health.record_failure(e, kind)
+            if kind == 'not_found':
+                self.registry.mark_unavailable(model_name, e)
+            else:
+                self.registry.record_result(model_name, False, error=e)
+            logger.warning(f"⚠️ 模型 {model_name} 呼叫失敗 ({kind}): {str(e)[:100]}")
+            raise
+
+        latency_ms = (time.time() - started) * 1000
+        with self._lock:
+            health.record_success(latency_ms)
+        self.registry.record_result(model_name, True, latency_ms=latency_ms)
+        return text
+
+    def generate(self, prompt, generation_config=None, models=None, max_attempts=None,
+                 deadline=None, exclude=()):
+        """
+        依路由順序把同一個提示詞送給模型直到成功，回傳 (回應文字, 模型名稱)
+        deadline 為絕對時間（time.time()），每次呼叫的逾時取剩餘的時間預算；
+        exclude 中的模型（例如已經失敗過的）不再嘗試
+        所有模型都失敗或時間預算用盡時拋出 AllModelsUnavailableError
+        """
+        if not self._configured:
+            raise AllModelsUnavailableError("模型路由器未配置")
+
+        # 指定模型清單時仍要經過可用性與斷路器篩選
+        routable = self.get_routable_models()
+        order = [name for name in models if name in routable] if models is not None else routable
+        order = [name for name in order if name not in exclude]
+        if max_attempts:
+            order = order[:max_attempts]
+
+        if not order:
+            raise AllModelsUnavailableError("沒有可用的健康模型")
+
+        last_error = None
+        attempted = []
+        for model_name in order:
+            request_options = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining < MIN_ATTEMPT_SECONDS:
+                    logger.warning(f"⏱️ 時間預算剩餘 {max(remaining, 0):.1f} 秒，停止嘗試其他模型")
+                    raise AllModelsUnavailableError(
+                        f"時間預算用盡（已嘗試: {', '.join(attempted) or '無'}）",
+                        last_error, attempted, deadline_exceeded=True
+                    )
+                request_options = {'timeout': remaining}
+
+            try:
+                return self.call_model(model_name, prompt, generation_config, request_options), model_name
+            except CircuitOpenError:
+                # 排序後到呼叫前，試探呼叫被其他請求取走：略過，不算一次嘗試
+                continue
+            except Exception as e:
+                attempted.append(model_name)
+                last_error = e
+                continue
+
+        if not attempted:
+            raise AllModelsUnavailableError("沒有可用的健康模型")
+        raise AllModelsUnavailableError(f"所有模型都失敗: {last_error}", last_error, attempted)
+
+    # =================== 統計 ===================
+
+    def get_circuit_summary(self):
+        """各斷路器狀態的彙總（與 is_configured 分開回報，斷路只是暫時無法呼叫）"""
+        now = time.time()
+        with self._lock:
+            states = [self._health[name].current_state(now) for name in self.candidates]
+        routable = self.get_routable_models()
+        return {
+            'closed': states.count(CIRCUIT_CLOSED),
+            'open': states.count(CIRCUIT_OPEN),
+            'half_open': states.count(CIRCUIT_HALF_OPEN),
+            'routable': len(routable),
+            'all_open': self._configured and not routable
+        }
+
+    def get_stats(self):
+        """取得每個模型的延遲、錯誤率與斷路器狀態"""
+        now = time.time()
+        with self._lock:
+            models = {name: health.to_dict(now) for name, health in self._health.items()}
+
+        for name, stats in models.items():
+            stats['available'] = self.registry.is_available(name)
+
+        return {
+            'configured': self._configured,
+            'primary_model': self.primary_model_name(),
+            'routable_models': self.get_routable_models(),
+            'circuits': self.get_circuit_summary(),
+            'total_calls': sum(m['calls'] for m in models.values()),
+            'total_errors': sum(m['errors'] for m in models.values()),
+            'models': models
+        }
+
+# =================== 模組層級實例 ===================
+
+ai_router = ModelRouter()
+
+# 背景工作專用：與回覆路徑共用模型登錄檔（模型是否存在），但延遲與斷路器各自獨立
+background_router = ModelRouter(BACKGROUND_MODEL_PRIORITY)
+
+__all__ = [
+    'ModelRouter',
+    'ModelHealth',
+    'AllModelsUnavailableError',
+    'CircuitOpenError',
+    'classify_error',
+    'ai_router',
+    'background_router',
+    'DEFAULT_MODEL_PRIORITY',
+    'BACKGROUND_MODEL_PRIORITY',
+    'MIN_ATTEMPT_SECONDS'
+]
@@ -4,34 +4,198 @@
 # 修正日期：2025年6月30日 - 解決AI回應問題
 
 import os
+import time
 import datetime
 import logging
 import json
+import threading
 from peewee import *
+from playhouse.pool import PooledPostgresqlDatabase, MaxConnectionsExceeded
+from playhouse.shortcuts import ThreadSafeDatabaseMetadata
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 # =================== 資料庫配置 ===================
 
+# PostgreSQL 連線池設定（每個 gunicorn worker 各自一個連線池）
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 10))
+DB_STALE_TIMEOUT = int(os.environ.get('DB_STALE_TIMEOUT', 300))
+DB_POOL_WAIT_TIMEOUT = int(os.environ.get('DB_POOL_WAIT_TIMEOUT', 10))
+
+class MonitoredPooledPostgresqlDatabase(PooledPostgresqlDatabase):
+    """記錄取用次數、等待時間與尖峰使用量的 PostgreSQL 連線池"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_stats = {
+            'checkouts': 0,
+            'wait_timeouts': 0,
+            'peak_in_use': 0,
+            'max_wait_ms': 0.0
+        }
+    
+    def connect(self, reuse_if_open=False):
+        started = time.time()
+        try:
+            result = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            self.pool_stats['wait_timeouts'] += 1
+            raise
+        
+        waited_ms = (time.time() - started) * 1000
+        self.pool_stats['checkouts'] += 1
+        self.pool_stats['peak_in_use'] = max(self.pool_stats['peak_in_use'], len(self._in_use))
+        self.pool_stats['max_wait_ms'] = max(self.pool_stats['max_wait_ms'], round(waited_ms, 1))
+        return result
+
+# SQLite 模式設定（沒有 DATABASE_URL 時；小型部署單機即可運作）
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'emi_teaching_assistant.db')
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 15))
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',                 # 讀取不被寫入阻擋
+    'synchronous': 'normal',               # WAL 模式下安全且少一次 fsync
+    'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'temp_store': 'memory',
+    'busy_timeout': int(SQLITE_BUSY_TIMEOUT * 1000),
+}
+
+SQLITE_WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+class SerializedWriteSqliteDatabase(SqliteDatabase):
+    """
+    WAL 模式的 SQLite：讀取可以並行，寫入在本行程內由單一寫入鎖依序執行
+    交易以 BEGIN IMMEDIATE 開始並在整個交易期間持有寫入鎖，
+    避免多個執行緒同時升級為寫入而互相等到 "database is locked"；
+    不同 worker 行程之間則由 busy_timeout 等待
+    """
+    
+    def __init__(self, database, **kwargs):
+        kwargs.setdefault('pragmas', SQLITE_PRAGMAS)
+        kwargs.setdefault('timeout', SQLITE_BUSY_TIMEOUT)
+        super().__init__(database, **kwargs)
+        self._reset_writer()
+        self.writer_stats = {
+            'writes': 0,
+            'transactions': 0,
+            'lock_timeouts': 0,
+            'max_wait_ms': 0.0
+        }
+        # 分叉後的子行程重新建立寫入鎖（父行程的鎖狀態不可沿用）
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_writer)
+    
+    def _reset_writer(self):
+        self._writer_lock = threading.RLock()
+        self._writer_local = threading.local()
+    
+    def _acquire_writer(self):
+        started = time.time()
+        if not self._writer_lock.acquire(timeout=SQLITE_BUSY_TIMEOUT):
+            self.writer_stats['lock_timeouts'] += 1
+            raise OperationalError('database is locked (等待寫入鎖逾時)')
+        self._writer_local.held = getattr(self._writer_local, 'held', 0) + 1
+        self.writer_stats['max_wait_ms'] = max(self.writer_stats['max_wait_ms'],
+                                                round((time.time() - started) * 1000, 1))
+    
+    def _release_writer(self):
+        if getattr(self._writer_local, 'held', 0) > 0:
+            self._writer_local.held -= 1
+            self._writer_lock.release()
+    
+    def execute_sql(self, sql, params=None, commit=None):
+        # 交易內的寫入已持有寫入鎖；交易外的單一寫入陳述式在這裡取得
+        if not self.in_transaction() and sql.lstrip()[:7].upper().startswith(SQLITE_WRITE_PREFIXES):
+            self._acquire_writer()
+            try:
+                self.writer_stats['writes'] += 1
+                return super().execute_sql(sql, params)
+            finally:
+                self._release_writer()
+        return super().execute_sql(sql, params)
+    
+    def begin(self, lock_type=None):
+        self._acquire_writer()
+        try:
+            self.writer_stats['transactions'] += 1
+            super().begin(lock_type or 'IMMEDIATE')
+        except Exception:
+            self._release_writer()
+            raise
+    
+    def commit(self):
+        try:
+            return super().commit()
+        finally:
+            self._release_writer()
+    
+    def rollback(self):
+        try:
+            return super().rollback()
+        finally:
+            self._release_writer()
+
 # 從環境變數或預設值設定資料庫
 database_url = os.environ.get('DATABASE_URL')
 if database_url:
-    # 生產環境：使用 PostgreSQL
+    # 生產環境：使用 PostgreSQL 連線池（第一次查詢時才建立連線）
     import dj_database_url
     db_config = dj_database_url.parse(database_url)
     
-    db = PostgresqlDatabase(
+    db = MonitoredPooledPostgresqlDatabase(
         db_config['NAME'],
         user=db_config['USER'],
         password=db_config['PASSWORD'],
         host=db_config['HOST'],
         port=db_config['PORT'],
+        max_connections=DB_MAX_CONNECTIONS,
+        stale_timeout=DB_STALE_TIMEOUT,
+        timeout=DB_POOL_WAIT_TIMEOUT,
     )
-    logger.info("✅ 使用 PostgreSQL 資料庫")
+    logger.info(f"✅ 使用 PostgreSQL 資料庫（連線池上限 {DB_MAX_CONNECTIONS}）")
 else:
-    # 開發環境：使用 SQLite
-    db = SqliteDatabase('emi_teaching_assistant.db')
-    logger.info("✅ 使用 SQLite 資料庫")
+    # 單機部署或開發環境：使用 WAL 模式的 SQLite
+    db = SerializedWriteSqliteDatabase(SQLITE_PATH)
+    logger.info(f"✅ 使用 SQLite 資料庫 (WAL，{SQLITE_PATH})")
+
+# 唯讀副本（選用）：報表、匯出與分析頁面改讀副本，Webhook 寫入與需要讀到剛寫入資料的路徑仍用主資料庫
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 30))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_LAG_CHECK_INTERVAL', 10))
+
+read_db = None
+if database_url and DATABASE_READ_URL:
+    read_config = dj_database_url.parse(DATABASE_READ_URL)
+    read_db = MonitoredPooledPostgresqlDatabase(
+        read_config['NAME'],
+        user=read_config['USER'],
+        password=read_config['PASSWORD'],
+        host=read_config['HOST'],
+        port=read_config['PORT'],
+        max_connections=DB_MAX_CONNECTIONS,
+        stale_timeout=DB_STALE_TIMEOUT,
+        timeout=DB_POOL_WAIT_TIMEOUT,
+    )
+    logger.info("✅ 已設定唯讀副本資料庫")
+
+# =================== 演示資料判斷 ===================
+
+# 演示學生的識別規則（唯一的判斷來源）；結果存入 Student.is_demo，查詢時使用索引欄位
+DEMO_LINE_USER_PREFIX = 'demo_'
+DEMO_NAME_PREFIXES = ('[DEMO]', '學生_')
+
+def is_demo_identity(line_user_id, name):
+    """依 LINE 用戶ID與姓名判斷是否為演示學生"""
+    return bool(
+        (line_user_id or '').startswith(DEMO_LINE_USER_PREFIX) or
+        (name or '').startswith(DEMO_NAME_PREFIXES)
+    )
+
+# =================== 會話配置 ===================
+
+# 每個自動結束會話的 UPDATE 最多處理的會話數
+SESSION_EXPIRY_BATCH_SIZE = int(os.environ.get('SESSION_EXPIRY_BATCH_SIZE', 500))
 
 # =================== 基礎模型 ===================
 
@@ -39,9 +203,19 @@ class BaseModel(Model):
     """所有模型的基礎類別"""
     class Meta:
         database = db
+        # 資料庫綁定以執行緒為單位，read_replica() 只影響目前的執行緒
+        model_metadata_class = ThreadSafeDatabaseMetadata
 
 # =================== 學生模型（增強版，支援完整的學習歷程） ===================
 
+def _invalidate_cached_student(student_id):
+    """使所有 worker 的學生快取失效（student_cache 匯入本模組，這裡延遲匯入避免循環匯入）"""
+    try:
+        from student_cache import student_cache
+        student_cache.invalidate(student_id)
+    except Exception as e:
+        logger.warning(f"⚠️ 學生快取失效失敗 (學生 {student_id}): {e}")
+
 class Student(BaseModel):
     """學生模型 - 增強版，支援完整的學習歷程和優化的註冊"""
     
@@ -64,27 +238,50 @@ class Student(BaseModel):
     total_questions = IntegerField(default=0, verbose_name="總提問數")
     total_sessions = IntegerField(default=0, verbose_name="總會話數")
     
+    # ✨ 新增：反正規化的訊息統計（寫入訊息時原子更新，reconcile_student_counters 可修復）
+    message_count = IntegerField(default=0, verbose_name="訊息總數")
+    last_message_at = DateTimeField(null=True, verbose_name="最後訊息時間")
+    
+    # ✨ 新增：演示學生標記（儲存時依 is_demo_identity 設定，分析查詢以索引過濾）
+    is_demo = BooleanField(default=False, verbose_name="演示學生")
+    
     class Meta:
         table_name = 'students'
         indexes = (
             (('line_user_id',), True),
             (('student_id',), False),
             (('last_activity',), False),
+            (('is_demo',), False),
         )
     
     def __str__(self):
         return f"Student({self.name}, {self.student_id})"
     
+    def save(self, *args, **kwargs):
+        """
+        儲存前依姓名與 LINE 用戶ID 同步演示標記（註冊流程會修改姓名），
+        儲存後遞增學生資料版本，並使各 worker 快取的這位學生失效（管理編輯、清理工作等非 Webhook 路徑）
+        """
+        self.is_demo = is_demo_identity(self.line_user_id, self.name)
+        result = super().save(*args, **kwargs)
+        DataVersion.bump('students')
+        _invalidate_cached_student(self.id)
+        return result
+    
+    def delete_instance(self, *args, **kwargs):
+        """刪除學生、遞增學生資料版本，並使各 worker 快取的這位學生失效"""
+        student_id = self.id
+        result = super().delete_instance(*args, **kwargs)
+        DataVersion.bump('students')
+        _invalidate_cached_student(student_id)
+        return result
+    
     # =================== 演示學生相關屬性 ===================
     
     @property
     def is_demo_student(self):
         """檢查是否為演示學生"""
-        return (
-            self.line_user_id.startswith('demo_') or 
-            self.name.startswith('[DEMO]') or 
-            self.name.startswith('學生_')
-        )
+        return bool(self.is_demo)
     
     @property
     def is_real_student(self):
@@ -134,19 +331,27 @@ class Student(BaseModel):
     # =================== 學習歷程和統計（增強版） ===================
     
     def update_activity(self):
-        """更新最後活動時間"""
+        """
+        更新最後活動時間
+        只記錄到 activity_buffer，由背景執行緒合併後批次寫入，不再每次 save() 整列資料
+        """
         try:
             self.last_activity = datetime.datetime.now()
-            self.save()
+            from activity_buffer import record_activity
+            record_activity(self.id, self.last_activity)
         except Exception as e:
             logger.error(f"❌ 更新活動時間失敗: {e}")
     
     def increment_question_count(self):
-        """增加提問數"""
+        """增加提問數（單一原子 UPDATE，同時更新活動時間）"""
         try:
+            now = datetime.datetime.now()
+            Student.update(
+                total_questions=Student.total_questions + 1,
+                last_activity=now
+            ).where(Student.id == self.id).execute()
             self.total_questions += 1
-            self.update_activity()
-            self.save()
+            self.last_activity = now
             logger.debug(f"學生 {self.name} 總提問數: {self.total_questions}")
         except Exception as e:
             logger.error(f"❌ 更新提問數失敗: {e}")
@@ -310,13 +515,19 @@ class Student(BaseModel):
     
     @classmethod
     def cleanup_incomplete_registrations(cls, days_old=7):
-        """清理過舊的未完成註冊"""
+        """
+        清理過舊的未完成註冊
+        app.py 的註冊流程以 registration_step 1-3 表示進行中、0 表示已完成，
+        只清理仍在註冊步驟中且超過期限沒有活動的非演示學生
+        """
         try:
             cutoff_date = datetime.datetime.now() - datetime.timedelta(days=days_old)
             
             incomplete_students = cls.select().where(
-                cls.registration_step < 3,
-                cls.created_at < cutoff_date
+                cls.registration_step > 0,
+                cls.is_demo == False,
+                cls.created_at < cutoff_date,
+                cls.last_activity.is_null() | (cls.last_activity < cutoff_date)
             )
             
             deleted_count = 0
@@ -337,20 +548,12 @@ class Student(BaseModel):
     @classmethod
     def get_real_students(cls):
         """取得所有真實學生（排除演示學生）"""
-        return cls.select().where(
-            (~cls.name.startswith('[DEMO]')) &
-            (~cls.line_user_id.startswith('demo_')) &
-            (~cls.name.startswith('學生_'))
-        )
+        return cls.select().where(cls.is_demo == False)
     
     @classmethod
     def get_demo_students(cls):
         """取得所有演示學生"""
-        return cls.select().where(
-            (cls.name.startswith('[DEMO]')) |
-            (cls.line_user_id.startswith('demo_')) |
-            (cls.name.startswith('學生_'))
-        )
+        return cls.select().where(cls.is_demo == True)
     
     @classmethod
     def cleanup_demo_students(cls):
@@ -375,6 +578,9 @@ class Student(BaseModel):
                     ConversationSession.student == student
                 ).execute()
                 
+                # 清理對話記憶
+                StudentMemory.delete().where(StudentMemory.student == student).execute()
+                
                 # 刪除學生
                 student.delete_instance()
                 deleted_count += 1
@@ -435,12 +641,16 @@ class ConversationSession(BaseModel):
     message_count = IntegerField(default=0, verbose_name="訊息數量")
     created_at = DateTimeField(default=datetime.datetime.now, verbose_name="建立時間")
     
+    # ✨ 新增：最後訊息時間（寫入訊息時更新，非活躍會話以此批次結束）
+    last_message_at = DateTimeField(null=True, default=datetime.datetime.now, verbose_name="最後訊息時間")
+    
     class Meta:
         table_name = 'conversation_sessions'
         indexes = (
             (('student', 'session_start'), False),
             (('session_start',), False),
             (('session_end',), False),
+            (('session_end', 'last_message_at'), False),
         )
     
     def __str__(self):
@@ -468,9 +678,11 @@ class ConversationSession(BaseModel):
             if topic_summary:
                 self.topic_summary = topic_summary
             
-            # 更新訊息計數
-            self.update_message_count()
-            self.save()
+            # 只寫入結束欄位；訊息數與最後訊息時間由 Message.create 維護，不以舊值覆蓋
+            ConversationSession.update(
+                session_end=self.session_end,
+                topic_summary=self.topic_summary
+            ).where(ConversationSession.id == self.id).execute()
             
             logger.info(f"✅ 結束會話 (ID: {self.id})，持續 {self.get_duration_minutes():.1f} 分鐘")
         except Exception as e:
@@ -536,16 +748,8 @@ class ConversationSession(BaseModel):
         return time_since_start.total_seconds() > (timeout_minutes * 60)
     
     def get_last_message_time(self):
-        """取得最後一則訊息的時間"""
-        try:
-            last_message = Message.select().where(
-                Message.session == self
-            ).order_by(Message.timestamp.desc()).first()
-            
-            return last_message.timestamp if last_message else self.session_start
-        except Exception as e:
-            logger.error(f"❌ 取得最後訊息時間失敗: {e}")
-            return self.session_start
+        """取得最後一則訊息的時間（Message.create 維護的欄位）"""
+        return self.last_message_at or self.session_start
     
     def should_auto_end_by_inactivity(self, timeout_minutes=30):
         """檢查是否應該基於非活躍狀態自動結束會話"""
@@ -606,22 +810,27 @@ class ConversationSession(BaseModel):
             return 0
     
     @classmethod
-    def auto_end_inactive_sessions(cls, timeout_minutes=30):
-        """自動結束非活躍的會話"""
+    def auto_end_inactive_sessions(cls, timeout_minutes=30, batch_size=SESSION_EXPIRY_BATCH_SIZE):
+        """
+        自動結束非活躍的會話：以最後訊息時間判斷，
+        每批最多 batch_size 個會話、各自一個短交易的 UPDATE，不逐一讀取會話
+        """
         try:
-            cutoff_time = datetime.datetime.now() - datetime.timedelta(minutes=timeout_minutes)
-            
-            inactive_sessions = cls.select().where(
-                cls.session_end.is_null(),
-                cls.session_start < cutoff_time
-            )
+            now = datetime.datetime.now()
+            cutoff_time = now - datetime.timedelta(minutes=timeout_minutes)
+            inactive = (cls.session_end.is_null()) & (cls.last_message_at < cutoff_time)
             
             ended_count = 0
-            for session in inactive_sessions:
-                # 檢查最後訊息時間，而不只是會話開始時間
-                if session.should_auto_end_by_inactivity(timeout_minutes):
-                    session.end_session("自動結束（非活躍）")
-                    ended_count += 1
+            while True:
+                batch = cls.select(cls.id).where(inactive).order_by(cls.id).limit(batch_size)
+                with db.atomic():
+                    ended = cls.update(
+                        session_end=now,
+                        topic_summary="自動結束（非活躍）"
+                    ).where(cls.id.in_(batch) & inactive).execute()
+                ended_count += ended
+                if ended < batch_size:
+                    break
             
             if ended_count > 0:
                 logger.info(f"✅ 自動結束了 {ended_count} 個非活躍會話")
@@ -715,20 +924,12 @@ class Message(BaseModel):
     @classmethod
     def get_real_messages(cls):
         """取得所有真實訊息"""
-        return cls.select().join(Student).where(
-            (~Student.name.startswith('[DEMO]')) &
-            (~Student.line_user_id.startswith('demo_')) &
-            (~Student.name.startswith('學生_'))
-        )
+        return cls.select().join(Student).where(Student.is_demo == False)
     
     @classmethod
     def get_demo_messages(cls):
         """取得所有演示訊息"""
-        return cls.select().join(Student).where(
-            (Student.name.startswith('[DEMO]')) |
-            (Student.line_user_id.startswith('demo_')) |
-            (Student.name.startswith('學生_'))
-        )
+        return cls.select().join(Student).where(Student.is_demo == True)
     
     @classmethod
     def cleanup_demo_messages(cls):
@@ -747,6 +948,7 @@ class Message(BaseModel):
             for message in demo_messages:
                 message.delete_instance()
                 deleted_count += 1
+            DataVersion.bump('messages')
             
             logger.info(f"成功清理 {deleted_count} 則演示訊息")
             
@@ -768,22 +970,53 @@ class Message(BaseModel):
     
     @classmethod
     def create(cls, **data):
-        """創建訊息（覆寫以添加會話管理和統計更新）"""
+        """
+        創建訊息（覆寫以添加會話管理和統計更新）
+        INSERT 與統計更新在同一個交易中完成：學生只執行一次
+        UPDATE ... SET total_questions = total_questions + 1, last_activity = ?，
+        會話訊息數直接遞增而不重新計數
+        """
         try:
-            # 創建基本訊息記錄
-            message = super().create(**data)
-            
-            # 如果有會話，更新會話統計
-            if message.session:
-                message.session.update_session_stats()
+            now = datetime.datetime.now()
             
-            # 更新學生活動統計
-            if message.student:
-                message.student.update_activity()
-                if message.source_type in ['line', 'student']:
-                    message.student.increment_question_count()
-            
-            logger.debug(f"✅ 創建訊息: {message}")
+            with db.atomic():
+                # 創建基本訊息記錄
+                message = super().create(**data)
+                counts_as_question = message.source_type in ['line', 'student']
+                
+                # 如果有會話，遞增會話訊息數並記錄最後訊息時間
+                if message.session_id:
+                    ConversationSession.update(
+                        message_count=ConversationSession.message_count + 1,
+                        last_message_at=message.timestamp
+                    ).where(ConversationSession.id == message.session_id).execute()
+                
+                # 更新學生活動統計與訊息計數
+                if message.student_id:
+                    student_updates = {
+                        Student.last_activity: now,
+                        Student.message_count: Student.message_count + 1,
+                        Student.last_message_at: message.timestamp
+                    }
+                    if counts_as_question:
+                        student_updates[Student.total_questions] = Student.total_questions + 1
+                    Student.update(student_updates).where(Student.id == message.student_id).execute()
+            
+            # 同步呼叫端傳入的模型實例，避免之後的 save() 寫回舊值
+            session = data.get('session')
+            if isinstance(session, ConversationSession):
+                session.message_count = (session.message_count or 0) + 1
+                session.last_message_at = message.timestamp
+            
+            student = data.get('student')
+            if isinstance(student, Student):
+                student.last_activity = now
+                student.message_count = (student.message_count or 0) + 1
+                student.last_message_at = message.timestamp
+                if counts_as_question:
+                    student.total_questions = (student.total_questions or 0) + 1
+            
+            logger.debug(f"✅ 創建訊息: {message.id}")
             return message
             
         except Exception as e:
@@ -791,23 +1024,18 @@ class Message(BaseModel):
             raise
     
     def add_topic_tags(self, tags):
-        """新增主題標籤"""
+        """新增主題標籤（寫入主題索引表，topic_tags 保留為顯示用字串）"""
         try:
-            if isinstance(tags, list):
-                tags_str = ', '.join(tags)
-            else:
-                tags_str = str(tags)
+            if not isinstance(tags, list):
+                tags = str(tags).split(',')
             
-            if self.topic_tags:
-                # 合併現有標籤
-                existing_tags = [tag.strip() for tag in self.topic_tags.split(',')]
-                new_tags = [tag.strip() for tag in tags_str.split(',')]
-                combined_tags = list(set(existing_tags + new_tags))
-                self.topic_tags = ', '.join(combined_tags)
-            else:
-                self.topic_tags = tags_str
+            new_tags = MessageTopic.link({self.id: tags}).get(self.id, [])
+            existing_tags = [tag.strip() for tag in (self.topic_tags or '').split(',') if tag.strip()]
+            combined_tags = existing_tags + [tag for tag in new_tags if tag not in existing_tags]
             
-            self.save()
+            if combined_tags != existing_tags:
+                self.topic_tags = ', '.join(combined_tags)
+                Message.update(topic_tags=self.topic_tags).where(Message.id == self.id).execute()
             logger.debug(f"更新訊息主題標籤: {self.topic_tags}")
             
         except Exception as e:
@@ -843,11 +1071,13 @@ class Message(BaseModel):
     
     @classmethod
     def get_messages_with_topic(cls, topic):
-        """取得包含特定主題的訊息"""
+        """取得包含特定主題的訊息（經由主題索引表）"""
         try:
-            return list(cls.select().where(
-                cls.topic_tags.contains(topic)
-            ).order_by(cls.timestamp.desc()))
+            return list(cls.select()
+                        .join(MessageTopic)
+                        .join(Topic)
+                        .where(Topic.name == Topic.normalize_name(topic))
+                        .order_by(cls.timestamp.desc()))
         except Exception as e:
             logger.error(f"❌ 取得主題相關訊息失敗: {e}")
             return []
@@ -942,23 +1172,18 @@ class Message(BaseModel):
             raise
     
     def add_topic_tags(self, tags):
-        """新增主題標籤"""
+        """新增主題標籤（寫入主題索引表，topic_tags 保留為顯示用字串）"""
         try:
-            if isinstance(tags, list):
-                tags_str = ', '.join(tags)
-            else:
-                tags_str = str(tags)
+            if not isinstance(tags, list):
+                tags = str(tags).split(',')
             
-            if self.topic_tags:
-                # 合併現有標籤
-                existing_tags = [tag.strip() for tag in self.topic_tags.split(',')]
-                new_tags = [tag.strip() for tag in tags_str.split(',')]
-                combined_tags = list(set(existing_tags + new_tags))
-                self.topic_tags = ', '.join(combined_tags)
-            else:
-                self.topic_tags = tags_str
+            new_tags = MessageTopic.link({self.id: tags}).get(self.id, [])
+            existing_tags = [tag.strip() for tag in (self.topic_tags or '').split(',') if tag.strip()]
+            combined_tags = existing_tags + [tag for tag in new_tags if tag not in existing_tags]
             
-            self.save()
+            if combined_tags != existing_tags:
+                self.topic_tags = ', '.join(combined_tags)
+                Message.update(topic_tags=self.topic_tags).where(Message.id == self.id).execute()
             logger.debug(f"更新訊息主題標籤: {self.topic_tags}")
             
         except Exception as e:
@@ -970,7 +1195,8 @@ class Message(BaseModel):
     def get_conversation_context(cls, student, limit=5):
         """
         取得對話上下文 - 優化版
-        主要修改：使用AI動態生成主題標籤，取代固定的關鍵詞字典
+        主要修改：讀取回覆後由背景標記器（topic_tagger.py）寫入的主題標籤，
+        尚未標記的訊息才使用關鍵詞備用方法，建立上下文時不再呼叫 AI
         """
         try:
             # 取得最近的對話記錄
@@ -987,7 +1213,7 @@ class Message(BaseModel):
             
             # 建立對話流程
             conversation_flow = []
-            all_content = []
+            recent_topics = []
             
             for msg in reversed(recent_messages):  # 按時間順序排列
                 flow_item = {
@@ -1000,12 +1226,20 @@ class Message(BaseModel):
                     flow_item['ai_response'] = msg.ai_response
                 
                 conversation_flow.append(flow_item)
-                all_content.append(msg.content)
-                if msg.ai_response:
-                    all_content.append(msg.ai_response)
+                
+                # 🔧 **關鍵優化：使用已儲存的主題標籤，未標記的訊息用備用方法**
+                if msg.topic_tags:
+                    topics = [tag.strip() for tag in msg.topic_tags.split(',') if tag.strip()]
+                else:
+                    topics = cls._extract_topics_fallback(f"{msg.content or ''} {msg.ai_response or ''}")
+                
+                for topic in topics:
+                    if topic in recent_topics:
+                        recent_topics.remove(topic)
+                    recent_topics.append(topic)
             
-            # 🔧 **關鍵優化：使用AI動態生成主題標籤**
-            recent_topics = cls._generate_topics_with_ai(all_content)
+            # 最多保留最近的5個主題
+            recent_topics = recent_topics[-5:]
             
             # 建立上下文摘要
             context_summary = cls._build_context_summary(conversation_flow, recent_topics)
@@ -1044,17 +1278,13 @@ class Message(BaseModel):
             
             # 使用簡單的AI提示詞來提取主題
             try:
-                import google.generativeai as genai
+                from model_router import background_router
                 
-                # 設定API金鑰（從環境變數）
-                api_key = os.environ.get('GEMINI_API_KEY')
-                if not api_key:
-                    logger.warning("⚠️ 沒有Gemini API金鑰，使用預設主題提取")
+                # 使用背景工作的模型路由器（尚未設定時從環境變數讀取API金鑰），不影響回覆路徑的斷路器
+                if not background_router.is_configured() and not background_router.configure():
+                    logger.warning("⚠️ 沒有可用的Gemini模型，使用預設主題提取")
                     return cls._extract_topics_fallback(combined_content)
                 
-                genai.configure(api_key=api_key)
-                model = genai.GenerativeModel('gemini-1.5-flash')
-                
                 prompt = f"""Based on the following conversation content, extract 3-5 relevant topic keywords in Traditional Chinese. 
 Return only the keywords separated by commas, no explanations.
 
@@ -1062,11 +1292,11 @@ Content: {combined_content[:500]}
 
 Keywords:"""
                 
-                response = model.generate_content(prompt)
+                response_text, _ = background_router.generate(prompt)
                 
-                if response and response.text:
+                if response_text:
                     # 清理和格式化主題標籤
-                    topics = [topic.strip() for topic in response.text.split(',')]
+                    topics = [topic.strip() for topic in response_text.split(',')]
                     topics = [topic for topic in topics if len(topic) > 1 and len(topic) < 20]
                     
                     logger.debug(f"AI生成主題標籤: {topics}")
@@ -1179,11 +1409,13 @@ Keywords:"""
     
     @classmethod
     def get_messages_with_topic(cls, topic):
-        """取得包含特定主題的訊息"""
+        """取得包含特定主題的訊息（經由主題索引表）"""
         try:
-            return list(cls.select().where(
-                cls.topic_tags.contains(topic)
-            ).order_by(cls.timestamp.desc()))
+            return list(cls.select()
+                        .join(MessageTopic)
+                        .join(Topic)
+                        .where(Topic.name == Topic.normalize_name(topic))
+                        .order_by(cls.timestamp.desc()))
         except Exception as e:
             logger.error(f"❌ 取得主題相關訊息失敗: {e}")
             return []
@@ -1386,6 +1618,640 @@ class LearningProgress(BaseModel):
             logger.error(f"❌ 取得學習摘要失敗: {e}")
             return {}
 
+# =================== Webhook 工作佇列模型 ===================
+
+class WebhookJob(BaseModel):
+    """LINE Webhook 事件佇列 - /callback 先寫入，再由背景工作執行緒處理"""
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    id = AutoField(primary_key=True)
+    event_id = CharField(max_length=100, null=True, verbose_name="LINE事件ID")
+    line_user_id = CharField(max_length=100, null=True, verbose_name="LINE用戶ID")
+    event_type = CharField(max_length=30, default='', verbose_name="事件類型")
+    payload = TextField(verbose_name="原始事件JSON")
+    status = CharField(max_length=20, default=STATUS_PENDING, verbose_name="處理狀態")
+    attempts = IntegerField(default=0, verbose_name="嘗試次數")
+    last_error = TextField(null=True, verbose_name="最後錯誤")
+    enqueued_at = DateTimeField(default=datetime.datetime.now, verbose_name="入列時間")
+    claimed_at = DateTimeField(null=True, verbose_name="認領時間")
+    started_at = DateTimeField(null=True, verbose_name="開始處理時間")
+    finished_at = DateTimeField(null=True, verbose_name="完成時間")
+
+    class Meta:
+        table_name = 'webhook_jobs'
+        indexes = (
+            (('status', 'id'), False),
+            (('line_user_id',), False),
+            (('finished_at',), False),
+        )
+
+    def __str__(self):
+        return f"WebhookJob({self.id}, {self.event_type}, {self.status})"
+
+    @classmethod
+    def get_status_counts(cls):
+        """取得各狀態的工作數量"""
+        try:
+            counts = {cls.STATUS_PENDING: 0, cls.STATUS_PROCESSING: 0, cls.STATUS_DONE: 0, cls.STATUS_FAILED: 0}
+            query = cls.select(cls.status, fn.COUNT(cls.id).alias('total')).group_by(cls.status)
+            for row in query:
+                counts[row.status] = row.total
+            return counts
+        except Exception as e:
+            logger.error(f"❌ 取得佇列狀態統計失敗: {e}")
+            return {}
+
+    @classmethod
+    def requeue_stale_jobs(cls, stale_seconds=300, max_attempts=3):
+        """
+        把卡在處理中太久的工作（例如 worker 異常終止）放回佇列；
+        開始處理時已遞增嘗試次數，達到上限的工作（可能是會讓 worker 當掉的事件）改標記為失敗，不再重試
+        """
+        try:
+            now = datetime.datetime.now()
+            cutoff = now - datetime.timedelta(seconds=stale_seconds)
+            # 已開始但執行過久，或已認領但一直沒有開始（認領的行程已結束）
+            stale = (cls.status == cls.STATUS_PROCESSING) & (
+                (cls.started_at < cutoff) |
+                (cls.started_at.is_null() & (cls.claimed_at < cutoff))
+            )
+
+            failed = cls.update(
+                status=cls.STATUS_FAILED,
+                finished_at=now,
+                last_error='處理逾時（worker 可能異常終止），已達重試上限'
+            ).where(stale & (cls.attempts >= max_attempts)).execute()
+
+            requeued = cls.update(status=cls.STATUS_PENDING).where(
+                stale & (cls.attempts < max_attempts)
+            ).execute()
+
+            if failed > 0:
+                logger.error(f"❌ {failed} 個逾時的 Webhook 工作已達重試上限，標記為失敗")
+            if requeued > 0:
+                logger.warning(f"⚠️ 重新排入 {requeued} 個逾時的 Webhook 工作")
+
+            return requeued
+        except Exception as e:
+            logger.error(f"❌ 重新排入逾時工作失敗: {e}")
+            return 0
+
+    @classmethod
+    def cleanup_finished_jobs(cls, hours_old=24):
+        """清理已完成或已放棄的舊工作"""
+        try:
+            cutoff = datetime.datetime.now() - datetime.timedelta(hours=hours_old)
+            deleted_count = cls.delete().where(
+                cls.status.in_([cls.STATUS_DONE, cls.STATUS_FAILED]),
+                cls.finished_at < cutoff
+            ).execute()
+
+            if deleted_count > 0:
+                logger.info(f"✅ 清理了 {deleted_count} 個已完成的 Webhook 工作")
+
+            return deleted_count
+        except Exception as e:
+            logger.error(f"❌ 清理 Webhook 工作失敗: {e}")
+            return 0
+
+# =================== Webhook 事件去重模型 ===================
+
+class ProcessedEvent(BaseModel):
+    """已接收的 LINE webhookEventId，用來丟棄 LINE 重送的重複事件"""
+
+    id = AutoField(primary_key=True)
+    event_id = CharField(max_length=100, unique=True, verbose_name="LINE事件ID")
+    is_redelivery = BooleanField(default=False, verbose_name="是否為重送")
+    received_at = DateTimeField(default=datetime.datetime.now, verbose_name="接收時間")
+
+    class Meta:
+        table_name = 'processed_events'
+        indexes = (
+            (('received_at',), False),
+        )
+
+    def __str__(self):
+        return f"ProcessedEvent({self.event_id})"
+
+    @classmethod
+    def cleanup_expired(cls, hours_old=24):
+        """清理超過保留期限的事件ID"""
+        try:
+            cutoff = datetime.datetime.now() - datetime.timedelta(hours=hours_old)
+            deleted_count = cls.delete().where(cls.received_at < cutoff).execute()
+
+            if deleted_count > 0:
+                logger.info(f"✅ 清理了 {deleted_count} 筆過期的事件ID")
+
+            return deleted_count
+        except Exception as e:
+            logger.error(f"❌ 清理過期事件ID失敗: {e}")
+            return 0
+
+# =================== 課程問答快取模型 ===================
+
+class CachedAnswer(BaseModel):
+    """正規化問題的 AI 回答快取，所有 gunicorn worker 共用"""
+
+    id = AutoField(primary_key=True)
+    question_key = CharField(max_length=64, unique=True, verbose_name="正規化問題雜湊")
+    question = TextField(verbose_name="正規化問題")
+    answer = TextField(verbose_name="AI回答")
+    model_name = CharField(max_length=50, null=True, verbose_name="產生回答的模型")
+    hits = IntegerField(default=0, verbose_name="命中次數")
+    created_at = DateTimeField(default=datetime.datetime.now, verbose_name="建立時間")
+    last_hit_at = DateTimeField(null=True, verbose_name="最後命中時間")
+    expires_at = DateTimeField(verbose_name="到期時間")
+
+    class Meta:
+        table_name = 'cached_answers'
+        indexes = (
+            (('expires_at',), False),
+        )
+
+    def __str__(self):
+        return f"CachedAnswer({self.question[:30]}, hits={self.hits})"
+
+    @classmethod
+    def cleanup_expired(cls):
+        """清理已到期的快取回答"""
+        try:
+            deleted_count = cls.delete().where(cls.expires_at < datetime.datetime.now()).execute()
+
+            if deleted_count > 0:
+                logger.info(f"✅ 清理了 {deleted_count} 筆過期的快取回答")
+
+            return deleted_count
+        except Exception as e:
+            logger.error(f"❌ 清理快取回答失敗: {e}")
+            return 0
+
+# =================== 學生對話記憶模型 ===================
+
+class StudentMemory(BaseModel):
+    """每位學生一列的滾動對話記憶：摘要、最近幾輪對話與主題集合，每次對話後增量更新"""
+
+    id = AutoField(primary_key=True)
+    student = ForeignKeyField(Student, backref='memory', unique=True, on_delete='CASCADE', verbose_name="學生")
+    summary = TextField(default='', verbose_name="滾動摘要")
+    recent_turns = TextField(default='[]', verbose_name="最近對話（JSON）")
+    topics = TextField(default='[]', verbose_name="主題集合（JSON）")
+    turn_count = IntegerField(default=0, verbose_name="累計對話輪數")
+    summarized_turns = IntegerField(default=0, verbose_name="已納入摘要的輪數")
+    last_message_at = DateTimeField(null=True, verbose_name="最後對話時間")
+    updated_at = DateTimeField(default=datetime.datetime.now, verbose_name="更新時間")
+
+    class Meta:
+        table_name = 'student_memories'
+
+    def __str__(self):
+        return f"StudentMemory({self.student_id}, turns={self.turn_count})"
+
+    def get_recent_turns(self):
+        """取得最近對話（舊到新）"""
+        try:
+            return json.loads(self.recent_turns or '[]')
+        except (TypeError, ValueError):
+            return []
+
+    def get_topics(self):
+        """取得主題集合（舊到新）"""
+        try:
+            return json.loads(self.topics or '[]')
+        except (TypeError, ValueError):
+            return []
+
+# =================== 背景維護租約模型 ===================
+
+class MaintenanceLease(BaseModel):
+    """背景維護任務的執行租約：每個任務一列，各 worker 以條件式 UPDATE 競爭，每次只有一個 worker 執行"""
+
+    task = CharField(max_length=50, primary_key=True, verbose_name="任務名稱")
+    owner = CharField(max_length=100, default='', verbose_name="執行者（主機:PID）")
+    lease_until = DateTimeField(null=True, verbose_name="租約到期時間")
+    last_started_at = DateTimeField(null=True, verbose_name="最後開始時間")
+    last_finished_at = DateTimeField(null=True, verbose_name="最後完成時間")
+    last_duration_ms = FloatField(null=True, verbose_name="最後執行時間（毫秒）")
+    last_error = TextField(null=True, verbose_name="最後錯誤")
+
+    class Meta:
+        table_name = 'maintenance_leases'
+
+    def __str__(self):
+        return f"MaintenanceLease({self.task}, owner={self.owner})"
+
+    @classmethod
+    def ensure(cls, tasks):
+        """建立尚不存在的任務列"""
+        cls.insert_many([{'task': task} for task in tasks]).on_conflict_ignore().execute()
+
+    @classmethod
+    def claim(cls, task, owner, min_interval, lease_seconds):
+        """
+        租約已釋放（或逾時）且距上次開始已超過 min_interval 秒時取得執行權；
+        單一條件式 UPDATE，多個 worker 同時嘗試也只有一個成功
+        """
+        now = datetime.datetime.now()
+        claimed = cls.update(
+            owner=owner,
+            last_started_at=now,
+            lease_until=now + datetime.timedelta(seconds=lease_seconds)
+        ).where(
+            (cls.task == task) &
+            (cls.lease_until.is_null() | (cls.lease_until < now)) &
+            (cls.last_started_at.is_null() |
+             (cls.last_started_at <= now - datetime.timedelta(seconds=min_interval)))
+        ).execute()
+        return claimed == 1
+
+    @classmethod
+    def release(cls, task, owner, duration_ms, error=None):
+        """釋放租約並記錄本次執行結果"""
+        cls.update(
+            lease_until=None,
+            last_finished_at=datetime.datetime.now(),
+            last_duration_ms=duration_ms,
+            last_error=error
+        ).where((cls.task == task) & (cls.owner == owner)).execute()
+
+# =================== 資料版本模型 ===================
+
+class DataVersion(BaseModel):
+    """
+    資料變更計數：每類資料一列，修改時遞增。新訊息由最大訊息ID反映，
+    這裡記錄其他變更（學生資料、刪除訊息、背景維護），與最大訊息ID合成資料水位
+    """
+
+    name = CharField(max_length=50, primary_key=True, verbose_name="資料類別")
+    version = BigIntegerField(default=0, verbose_name="版本")
+    updated_at = DateTimeField(default=datetime.datetime.now, verbose_name="最後變更時間")
+
+    class Meta:
+        table_name = 'data_versions'
+
+    def __str__(self):
+        return f"DataVersion({self.name}, {self.version})"
+
+    @classmethod
+    def bump(cls, name):
+        """遞增指定類別的版本（單一 UPDATE，第一次使用時建立該列）"""
+        try:
+            now = datetime.datetime.now()
+            updated = cls.update(version=cls.version + 1, updated_at=now).where(cls.name == name).execute()
+            if not updated:
+                cls.insert(name=name, version=1, updated_at=now).on_conflict_ignore().execute()
+        except Exception as e:
+            logger.error(f"❌ 遞增資料版本失敗 ({name}): {e}")
+
+def get_data_watermark():
+    """
+    取得資料水位（單一查詢）：(最大訊息ID, 版本總和, 最後變更時間)
+    在 read_replica() 內呼叫時讀取副本，與頁面資料來自同一個資料庫
+    """
+    database = Message._meta.database
+    query = Select(columns=[
+        Message.select(fn.MAX(Message.id)),
+        Message.select(Message.timestamp).order_by(Message.id.desc()).limit(1),
+        DataVersion.select(fn.COALESCE(fn.SUM(DataVersion.version), 0)),
+        DataVersion.select(fn.MAX(DataVersion.updated_at))
+    ]).bind(database)
+    max_message_id, last_message_at, version, version_updated_at = query.tuples().execute()[0]
+
+    # 子查詢的結果不經過欄位轉換（SQLite 回傳字串）
+    changed = [Message.timestamp.python_value(last_message_at),
+               DataVersion.updated_at.python_value(version_updated_at)]
+    changed = [value for value in changed if value]
+    return max_message_id or 0, int(version or 0), max(changed) if changed else None
+
+class StudentCacheVersion(BaseModel):
+    """
+    每位學生的快取版本：學生資料或對話記憶修改後遞增，
+    各主機的 student_cache 定期讀取最近變更的列，讓其他主機快取的這位學生失效
+    （不計入資料水位；同一主機的 worker 另有 mmap 版本檔即時失效）
+    """
+
+    student_id = IntegerField(primary_key=True, verbose_name="學生ID")
+    version = BigIntegerField(default=0, verbose_name="版本")
+    updated_at = DateTimeField(default=datetime.datetime.now, index=True, verbose_name="最後變更時間")
+
+    class Meta:
+        table_name = 'student_cache_versions'
+
+    def __str__(self):
+        return f"StudentCacheVersion({self.student_id}, {self.version})"
+
+    @classmethod
+    def bump(cls, student_id):
+        """遞增學生的快取版本並回傳新版本（同一交易內讀回，不會讀到其他寫入者的版本）"""
+        now = datetime.datetime.now()
+        increment = cls.update(version=cls.version + 1, updated_at=now).where(cls.student_id == student_id)
+        with cls._meta.database.atomic():
+            if not increment.execute():
+                # 第一次使用時建立該列（其他寫入者可能同時建立），再遞增
+                cls.insert(student_id=student_id, version=0, updated_at=now).on_conflict_ignore().execute()
+                increment.execute()
+            return cls.get_by_id(student_id).version
+
+    @classmethod
+    def changed_since(cls, since):
+        """取得 since 之後變更過的學生版本 {學生ID: 版本}"""
+        query = cls.select(cls.student_id, cls.version).where(cls.updated_at >= since)
+        return {student_id: version for student_id, version in query.tuples()}
+
+# =================== 主題索引模型 ===================
+
+class Topic(BaseModel):
+    """去重的主題字典，每個主題名稱一列"""
+
+    id = AutoField(primary_key=True)
+    name = CharField(max_length=50, unique=True, verbose_name="主題名稱")
+    created_at = DateTimeField(default=datetime.datetime.now, verbose_name="建立時間")
+
+    class Meta:
+        table_name = 'topics'
+
+    def __str__(self):
+        return f"Topic({self.name})"
+
+    @staticmethod
+    def normalize_name(name):
+        """去除空白並限制長度，與儲存時的主題名稱一致"""
+        return str(name or '').strip()[:50]
+
+    @classmethod
+    def get_ids(cls, names):
+        """取得主題ID（不存在的主題先建立），回傳 {名稱: ID}"""
+        names = list(dict.fromkeys(cls.normalize_name(name) for name in names if cls.normalize_name(name)))
+        if not names:
+            return {}
+        cls.insert_many([{'name': name} for name in names]).on_conflict_ignore().execute()
+        return {topic.name: topic.id for topic in cls.select(cls.id, cls.name).where(cls.name.in_(names))}
+
+    @classmethod
+    def get_topic_counts(cls, limit=20):
+        """各主題的訊息數（依數量排序），回傳 [(主題, 訊息數)]"""
+        try:
+            message_count = fn.COUNT(MessageTopic.message)
+            query = (cls
+                     .select(cls.name, message_count.alias('message_count'))
+                     .join(MessageTopic)
+                     .group_by(cls.id, cls.name)
+                     .order_by(message_count.desc())
+                     .limit(limit))
+            return [(topic.name, topic.message_count) for topic in query]
+        except Exception as e:
+            logger.error(f"❌ 取得主題統計失敗: {e}")
+            return []
+
+class MessageTopic(BaseModel):
+    """訊息與主題的對應表；主鍵 (message, topic) 支援依訊息查詢，(topic, message) 索引支援依主題查詢與計數"""
+
+    message = ForeignKeyField(Message, backref='topic_links', on_delete='CASCADE', verbose_name="訊息")
+    topic = ForeignKeyField(Topic, backref='message_links', on_delete='CASCADE', verbose_name="主題")
+
+    class Meta:
+        table_name = 'message_topics'
+        primary_key = CompositeKey('message', 'topic')
+        indexes = (
+            (('topic', 'message'), False),
+        )
+
+    # 每個 INSERT 陳述式包含的對應列數
+    LINK_CHUNK_SIZE = 500
+
+    @classmethod
+    def link(cls, topics_by_message):
+        """
+        建立 {訊息ID: [主題, ...]} 的對應（已存在的對應略過），
+        回傳正規化後的 {訊息ID: [主題, ...]}
+        """
+        normalized = {}
+        for message_id, topics in topics_by_message.items():
+            names = [Topic.normalize_name(topic) for topic in topics or []]
+            names = list(dict.fromkeys(name for name in names if name))
+            if names:
+                normalized[message_id] = names
+        if not normalized:
+            return {}
+
+        with db.atomic():
+            topic_ids = Topic.get_ids(name for names in normalized.values() for name in names)
+            rows = [
+                {'message': message_id, 'topic': topic_ids[name]}
+                for message_id, names in normalized.items()
+                for name in names if name in topic_ids
+            ]
+            for start in range(0, len(rows), cls.LINK_CHUNK_SIZE):
+                cls.insert_many(rows[start:start + cls.LINK_CHUNK_SIZE]).on_conflict_ignore().execute()
+
+        return normalized
+
+    @classmethod
+    def cleanup_orphans(cls):
+        """清理訊息已刪除的對應（SQLite 未啟用外鍵時不會連帶刪除）"""
+        try:
+            deleted_count = cls.delete().where(
+                cls.message.not_in(Message.select(Message.id))
+            ).execute()
+
+            if deleted_count > 0:
+                logger.info(f"✅ 清理了 {deleted_count} 筆孤立的主題對應")
+
+            return deleted_count
+        except Exception as e:
+            logger.error(f"❌ 清理主題對應失敗: {e}")
+            return 0
+
+# 所有資料表模型（建立表格與副本路由使用）
+ALL_MODELS = [
+    Student,
+    ConversationSession,
+    Message,
+    LearningProgress,
+    WebhookJob,
+    ProcessedEvent,
+    CachedAnswer,
+    StudentMemory,
+    Topic,
+    MessageTopic,
+    MaintenanceLease,
+    DataVersion,
+    StudentCacheVersion
+]
+
+# =================== 結構遷移與計數修復 ===================
+
+# 既有資料表需要補上的欄位：(模型, 欄位名稱)
+SCHEMA_ADDITIONS = [
+    (Student, 'message_count'),
+    (Student, 'last_message_at'),
+    (Student, 'is_demo'),
+    (ConversationSession, 'last_message_at'),
+    (WebhookJob, 'claimed_at'),
+]
+
+def migrate_schema():
+    """
+    為既有資料表補上新欄位（create_tables 不會修改已存在的表），回傳新增的欄位；
+    須在 create_tables 之前執行，新欄位上的索引才能由 create_tables 建立
+    """
+    from playhouse.migrate import SchemaMigrator, migrate
+    
+    added = []
+    try:
+        migrator = SchemaMigrator.from_database(db)
+        for model, field_name in SCHEMA_ADDITIONS:
+            table = model._meta.table_name
+            if not db.table_exists(table):
+                continue
+            existing = {column.name for column in db.get_columns(table)}
+            field = model._meta.fields[field_name]
+            if field.column_name in existing:
+                continue
+            with db.atomic():
+                migrate(migrator.add_column(table, field.column_name, field))
+            added.append(f"{table}.{field.column_name}")
+        
+        if added:
+            logger.info(f"✅ 資料表欄位遷移完成: {added}")
+        return added
+    
+    except Exception as e:
+        logger.error(f"❌ 資料表欄位遷移失敗: {e}")
+        return added
+
+# 最近這段時間（秒）內有新訊息的學生不修正計數：子查詢的快照可能看不到
+# 同時進行中的 Message.create，覆寫會把剛遞增的計數倒退
+RECONCILE_QUIET_SECONDS = int(os.environ.get('RECONCILE_QUIET_SECONDS', 120))
+
+def reconcile_student_counters():
+    """
+    以訊息表重新計算每位學生的 message_count、total_questions、last_message_at
+    （訊息被清理或計數漂移後修復），回傳修正的學生數
+    只處理最近 RECONCILE_QUIET_SECONDS 秒內沒有新訊息的學生；修正後遞增學生資料版本並使學生快取失效
+    """
+    try:
+        MessageAlias = Message.alias()
+        quiet_cutoff = datetime.datetime.now() - datetime.timedelta(seconds=RECONCILE_QUIET_SECONDS)
+        
+        message_count = (MessageAlias
+                         .select(fn.COUNT(MessageAlias.id))
+                         .where(MessageAlias.student == Student.id))
+        question_count = (MessageAlias
+                          .select(fn.COUNT(MessageAlias.id))
+                          .where((MessageAlias.student == Student.id) &
+                                 (MessageAlias.source_type.in_(['line', 'student']))))
+        last_message_at = (MessageAlias
+                           .select(fn.MAX(MessageAlias.timestamp))
+                           .where(MessageAlias.student == Student.id))
+        
+        recent_message = (MessageAlias
+                          .select(MessageAlias.id)
+                          .where((MessageAlias.student == Student.id) &
+                                 (MessageAlias.timestamp >= quiet_cutoff)))
+        
+        # 只處理數值不一致的學生（以 created_at 代替 NULL，讓有無訊息的差異也能比較）；
+        # 學生列本身的 last_message_at 條件在並行更新提交後會以新值重新檢查
+        mismatched = (
+            ((Student.message_count != message_count) |
+             (Student.total_questions != question_count) |
+             (fn.COALESCE(Student.last_message_at, Student.created_at) !=
+              fn.COALESCE(last_message_at, Student.created_at))) &
+            (Student.last_message_at.is_null() | (Student.last_message_at < quiet_cutoff)) &
+            ~fn.EXISTS(recent_message)
+        )
+        
+        student_ids = [row.id for row in Student.select(Student.id).where(mismatched)]
+        if not student_ids:
+            return 0
+        
+        fixed = Student.update(
+            message_count=message_count,
+            total_questions=question_count,
+            last_message_at=last_message_at
+        ).where(Student.id.in_(student_ids) & mismatched).execute()
+        
+        if fixed > 0:
+            # 批次 UPDATE 不經過 Student.save，自行讓快取的頁面與學生資料失效
+            DataVersion.bump('students')
+            for student_id in student_ids:
+                _invalidate_cached_student(student_id)
+            logger.info(f"✅ 修正了 {fixed} 位學生的訊息計數")
+        
+        return fixed
+    except Exception as e:
+        logger.error(f"❌ 修正學生訊息計數失敗: {e}")
+        return 0
+
+def backfill_demo_flags():
+    """依 is_demo_identity 的規則回填 Student.is_demo（新增欄位後執行一次），回傳修正的學生數"""
+    try:
+        is_demo = Student.line_user_id.startswith(DEMO_LINE_USER_PREFIX)
+        for prefix in DEMO_NAME_PREFIXES:
+            is_demo |= Student.name.startswith(prefix)
+        with db.atomic():
+            fixed = Student.update(is_demo=True).where(is_demo & (Student.is_demo == False)).execute()
+            fixed += Student.update(is_demo=False).where(~is_demo & (Student.is_demo == True)).execute()
+        
+        if fixed > 0:
+            logger.info(f"✅ 回填了 {fixed} 位學生的演示標記")
+        
+        return fixed
+    except Exception as e:
+        logger.error(f"❌ 回填演示標記失敗: {e}")
+        return 0
+
+def backfill_session_activity():
+    """以訊息表回填會話的 last_message_at（沒有訊息的會話使用開始時間），回傳更新的會話數"""
+    try:
+        last_message_at = (Message
+                           .select(fn.MAX(Message.timestamp))
+                           .where(Message.session == ConversationSession.id))
+        with db.atomic():
+            updated = ConversationSession.update(last_message_at=last_message_at).where(
+                ConversationSession.last_message_at.is_null()
+            ).execute()
+            ConversationSession.update(last_message_at=ConversationSession.session_start).where(
+                ConversationSession.last_message_at.is_null()
+            ).execute()
+        
+        if updated > 0:
+            logger.info(f"✅ 回填了 {updated} 個會話的最後訊息時間")
+        
+        return updated
+    except Exception as e:
+        logger.error(f"❌ 回填會話最後訊息時間失敗: {e}")
+        return 0
+
+def backfill_message_topics(batch_size=1000):
+    """把既有訊息的 topic_tags 字串寫入主題索引表（依訊息ID分頁），回傳處理的訊息數"""
+    processed = 0
+    last_id = 0
+    try:
+        while True:
+            rows = list(Message
+                        .select(Message.id, Message.topic_tags)
+                        .where((Message.id > last_id) & (Message.topic_tags != ''))
+                        .order_by(Message.id)
+                        .limit(batch_size))
+            if not rows:
+                break
+            MessageTopic.link({row.id: row.topic_tags.split(',') for row in rows if row.topic_tags})
+            processed += len(rows)
+            last_id = rows[-1].id
+        
+        if processed > 0:
+            logger.info(f"✅ 將 {processed} 則訊息的主題標籤寫入主題索引表")
+        
+        return processed
+    except Exception as e:
+        logger.error(f"❌ 回填主題索引表失敗: {e}")
+        return processed
+
 # =================== 資料庫初始化和管理 ===================
 
 def initialize_database():
@@ -1393,13 +2259,20 @@ def initialize_database():
     try:
         logger.info("🔧 開始初始化資料庫...")
         
-        # 建立所有表格
-        db.create_tables([
-            Student, 
-            ConversationSession, 
-            Message, 
-            LearningProgress
-        ], safe=True)
+        # 既有資料表先補上新欄位，再建立所有表格與索引
+        added_columns = migrate_schema()
+        topic_index_exists = db.table_exists(MessageTopic._meta.table_name)
+        db.create_tables(ALL_MODELS, safe=True)
+        
+        # 回填新欄位的內容
+        if 'students.message_count' in added_columns or 'students.last_message_at' in added_columns:
+            reconcile_student_counters()
+        if 'students.is_demo' in added_columns:
+            backfill_demo_flags()
+        if 'conversation_sessions.last_message_at' in added_columns:
+            backfill_session_activity()
+        if not topic_index_exists:
+            backfill_message_topics()
         
         logger.info("✅ 資料庫初始化完成")
         
@@ -1528,10 +2401,151 @@ def get_database_stats():
         logger.error(f"❌ 取得資料庫統計失敗: {e}")
         return {}
 
+# =================== 連線管理（gunicorn 分叉與請求範圍） ===================
+
+def prepare_database_for_fork():
+    """master 分叉前呼叫：關閉所有連線，避免 worker 繼承同一個 socket"""
+    for database in (db, read_db):
+        if database is None:
+            continue
+        try:
+            if not database.is_closed():
+                database.close()
+            if hasattr(database, 'close_all'):
+                database.close_all()
+        except Exception as e:
+            logger.error(f"❌ 分叉前關閉資料庫連線失敗: {e}")
+
+def reset_database_after_fork():
+    """
+    worker 分叉後呼叫：丟棄從 master 繼承的連線狀態
+    不關閉繼承的 socket（那會中斷 master 的連線），之後第一次查詢時才建立本行程的連線
+    """
+    for database in (db, read_db):
+        if database is None:
+            continue
+        try:
+            if hasattr(database, '_in_use'):
+                database._connections = []
+                database._in_use = {}
+            database._state.reset()
+        except Exception as e:
+            logger.error(f"❌ 重設資料庫連線狀態失敗: {e}")
+
+# =================== 唯讀副本路由 ===================
+
+_replica_local = threading.local()
+_replica_status = {
+    'checked_at': 0.0,
+    'lag_seconds': None,
+    'in_recovery': None,
+    'error': None,
+    'routed_reads': 0,
+    'primary_fallbacks': 0
+}
+
+def get_replica_lag(max_age=DB_REPLICA_LAG_CHECK_INTERVAL):
+    """查詢副本延遲（秒），max_age 秒內重複呼叫使用上次的結果"""
+    if read_db is None:
+        return {'configured': False}
+    
+    if time.time() - _replica_status['checked_at'] >= max_age:
+        try:
+            with read_db.connection_context():
+                in_recovery, lag = read_db.execute_sql(
+                    "SELECT pg_is_in_recovery(), "
+                    "CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+                    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+                ).fetchone()
+            _replica_status.update({
+                'lag_seconds': float(lag) if lag is not None else None,
+                'in_recovery': in_recovery,
+                'error': None
+            })
+        except Exception as e:
+            _replica_status.update({'lag_seconds': None, 'error': str(e)})
+            logger.warning(f"⚠️ 副本延遲查詢失敗，讀取改用主資料庫: {e}")
+        _replica_status['checked_at'] = time.time()
+    
+    lag = _replica_status['lag_seconds']
+    return {
+        'configured': True,
+        'healthy': lag is not None and lag <= DB_REPLICA_MAX_LAG,
+        'lag_seconds': round(lag, 2) if lag is not None else None,
+        'max_lag_seconds': DB_REPLICA_MAX_LAG,
+        'in_recovery': _replica_status['in_recovery'],
+        'error': _replica_status['error'],
+        'routed_reads': _replica_status['routed_reads'],
+        'primary_fallbacks': _replica_status['primary_fallbacks']
+    }
+
+@contextmanager
+def read_replica():
+    """
+    在此區塊內（僅限目前執行緒）所有模型查詢改讀副本；也可當裝飾器使用：@read_replica()
+    沒有設定副本、主資料庫交易進行中、副本延遲過大或無法連線時，照常使用主資料庫
+    只能包住唯讀的程式碼
+    """
+    if getattr(_replica_local, 'active', False):
+        yield
+        return
+    
+    if read_db is None:
+        yield
+        return
+    
+    if db.in_transaction() or not get_replica_lag()['healthy']:
+        _replica_status['primary_fallbacks'] += 1
+        yield
+        return
+    
+    try:
+        read_db.connect(reuse_if_open=True)
+    except Exception as e:
+        _replica_status['primary_fallbacks'] += 1
+        logger.warning(f"⚠️ 無法連線副本，讀取改用主資料庫: {e}")
+        yield
+        return
+    
+    _replica_local.active = True
+    _replica_status['routed_reads'] += 1
+    try:
+        with read_db.bind_ctx(ALL_MODELS):
+            yield
+    finally:
+        _replica_local.active = False
+        if not read_db.is_closed():
+            read_db.close()
+
+def get_database_pool_stats():
+    """取得本行程的連線池使用情形"""
+    try:
+        if not hasattr(db, '_in_use'):
+            stats = {'pooled': False, 'connected': not db.is_closed()}
+            stats.update(getattr(db, 'writer_stats', {}))
+            return stats
+        
+        stats = {
+            'pooled': True,
+            'max_connections': db._max_connections,
+            'stale_timeout': db._stale_timeout,
+            'in_use': len(db._in_use),
+            'idle': len(db._connections)
+        }
+        stats.update(getattr(db, 'pool_stats', {}))
+        return stats
+    except Exception as e:
+        logger.error(f"❌ 取得連線池狀態失敗: {e}")
+        return {}
+
 # =================== 自動維護任務 ===================
 
 def run_maintenance_tasks():
-    """執行自動維護任務"""
+    """
+    執行自動維護任務
+    學生計數的修正（reconcile_student_counters）是整表 UPDATE，只由背景維護排程的 counter_rollup 任務執行
+    """
     try:
         logger.info("🔧 開始執行維護任務...")
         
@@ -1541,11 +2555,27 @@ def run_maintenance_tasks():
         # 清理未完成的註冊（超過7天）
         incomplete_cleanup = Student.cleanup_incomplete_registrations(days_old=7)
         
-        logger.info(f"✅ 維護任務完成 - 結束會話: {ended_sessions}, 清理註冊: {incomplete_cleanup}")
+        # 清理已處理完畢的 Webhook 工作（超過24小時）
+        webhook_jobs_cleanup = WebhookJob.cleanup_finished_jobs(hours_old=24)
+        
+        # 清理過期的事件去重紀錄（超過24小時）
+        expired_events_cleanup = ProcessedEvent.cleanup_expired(hours_old=24)
+        
+        # 清理已到期的快取回答
+        cached_answers_cleanup = CachedAnswer.cleanup_expired()
+        
+        # 清理訊息已刪除的主題對應
+        topic_links_cleanup = MessageTopic.cleanup_orphans()
+        
+        logger.info(f"✅ 維護任務完成 - 結束會話: {ended_sessions}, 清理註冊: {incomplete_cleanup}, 清理工作: {webhook_jobs_cleanup}, 清理事件ID: {expired_events_cleanup}, 清理快取回答: {cached_answers_cleanup}, 清理主題對應: {topic_links_cleanup}")
         
         return {
             'ended_sessions': ended_sessions,
-            'incomplete_cleanup': incomplete_cleanup
+            'incomplete_cleanup': incomplete_cleanup,
+            'webhook_jobs_cleanup': webhook_jobs_cleanup,
+            'expired_events_cleanup': expired_events_cleanup,
+            'cached_answers_cleanup': cached_answers_cleanup,
+            'topic_links_cleanup': topic_links_cleanup
         }
         
     except Exception as e:
@@ -1561,11 +2591,33 @@ __all__ = [
     'ConversationSession', 
     'Message', 
     'LearningProgress',
+    'WebhookJob',
+    'ProcessedEvent',
+    'CachedAnswer',
+    'StudentMemory',
+    'Topic',
+    'MessageTopic',
+    'MaintenanceLease',
+    'DataVersion',
+    'get_data_watermark',
+    'StudentCacheVersion',
     'initialize_database',
     'create_demo_data',
     'cleanup_database',
     'get_database_stats',
-    'run_maintenance_tasks'
+    'read_db',
+    'read_replica',
+    'get_replica_lag',
+    'prepare_database_for_fork',
+    'reset_database_after_fork',
+    'get_database_pool_stats',
+    'run_maintenance_tasks',
+    'migrate_schema',
+    'reconcile_student_counters',
+    'backfill_demo_flags',
+    'backfill_message_topics',
+    'backfill_session_activity',
+    'is_demo_identity'
 ]
 
 # =================== models.py 修正版 - 第4段結束 ===================
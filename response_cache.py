@@ -0,0 +1,193 @@
+# =================== response_cache.py ===================
+# EMI智能教學助理系統 - 依資料水位快取管理頁面與 API 回應
+# 首頁、/api/stats、/health、學生列表與學生詳細頁面每次瀏覽都重新計算所有統計，
+# 即使期間沒有任何新訊息。這裡以資料水位（最大訊息ID＋資料版本總和，見 models.get_data_watermark）
+# 作為快取鍵：新訊息寫入或學生資料變更後水位改變，快取自動失效，不需要在寫入路徑逐一清除
+#
+# 回應附上 ETag（水位＋內容雜湊）與 Last-Modified（最後資料變更時間），
+# 條件式 GET（If-None-Match / If-Modified-Since）未變更時回傳 304。
+# 快取在每個 gunicorn worker 內各自保存；ETag 只依內容計算，各 worker 之間一致
+
+import os
+import zlib
+import time
+import logging
+import datetime
+import threading
+import functools
+from collections import OrderedDict
+
+from flask import request, make_response
+
+from models import get_data_watermark
+
+logger = logging.getLogger(__name__)
+
+# =================== 快取配置 ===================
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() != 'false'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+
+# 即使水位沒變，超過此時間（秒）也重新產生（頁面上有「今日」統計等隨時間變化的內容）
+RESPONSE_CACHE_MAX_AGE = int(os.getenv('RESPONSE_CACHE_MAX_AGE', 300))
+
+# 含有行程內即時指標（佇列深度、斷路器狀態等）的頁面使用較短的時間
+RUNTIME_METRICS_MAX_AGE = int(os.getenv('RESPONSE_CACHE_RUNTIME_MAX_AGE', 10))
+
+# 重新產生回應時不保留的標頭
+_SKIPPED_HEADERS = {'content-length', 'date', 'etag', 'last-modified', 'cache-control'}
+
+# =================== 回應快取 ===================
+
+class ResponseCache:
+    """以請求路徑（含查詢字串）為鍵的 LRU 回應快取，項目只在資料水位相同時有效"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, enabled=RESPONSE_CACHE_ENABLED):
+        self.max_entries = max(1, max_entries)
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._not_modified = 0
+        self._watermark_errors = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _render(self, key, watermark, changed_at, view, args, kwargs):
+        """執行頁面函數並保存成功的回應；非 200 的回應不快取，回傳 (回應, 快取項目或 None)"""
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.direct_passthrough:
+            return response, None
+
+        body = response.get_data()
+        etag = f"{watermark}-{zlib.crc32(body):08x}"
+
+        # 水位沒變但內容不同（即時指標、時間相關的統計）時，以重新產生的時間作為最後修改時間
+        previous = self._get(key)
+        last_modified = changed_at
+        if previous is not None and previous['watermark'] == watermark and previous['etag'] != etag:
+            last_modified = datetime.datetime.now()
+
+        entry = {
+            'watermark': watermark,
+            'etag': etag,
+            'last_modified': last_modified,
+            'created_at': time.time(),
+            'body': body,
+            'status': response.status_code,
+            'headers': [(name, value) for name, value in response.headers
+                        if name.lower() not in _SKIPPED_HEADERS]
+        }
+        self._put(key, entry)
+        return response, entry
+
+    def cached(self, max_age=None):
+        """
+        裝飾器：GET 請求依資料水位快取回應，附上 ETag / Last-Modified 並處理條件式請求
+        與 read_replica() 一起使用時放在其下方，水位才會從同一個資料庫讀取
+        """
+        max_age = RESPONSE_CACHE_MAX_AGE if max_age is None else max_age
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method != 'GET':
+                    return view(*args, **kwargs)
+
+                try:
+                    max_message_id, version, changed_at = get_data_watermark()
+                except Exception as e:
+                    # 資料庫尚未就緒等情況：不快取，交給頁面自己處理
+                    self._watermark_errors += 1
+                    logger.warning(f"⚠️ 無法取得資料水位，略過回應快取: {e}")
+                    return view(*args, **kwargs)
+
+                watermark = f"{max_message_id}.{version}"
+                key = request.full_path
+                entry = self._get(key)
+
+                if (entry is not None and entry['watermark'] == watermark and
+                        time.time() - entry['created_at'] < max_age):
+                    self._hits += 1
+                    response = make_response(entry['body'], entry['status'], entry['headers'])
+                else:
+                    self._misses += 1
+                    response, entry = self._render(key, watermark, changed_at, view, args, kwargs)
+                    if entry is None:
+                        return response
+
+                response.set_etag(entry['etag'])
+                if entry['last_modified']:
+                    # 資料庫的時間為本地時間
+                    response.last_modified = entry['last_modified'].astimezone(datetime.timezone.utc)
+                # 瀏覽器可保存回應，但每次使用前都要重新驗證
+                response.headers['Cache-Control'] = 'private, no-cache'
+
+                response.make_conditional(request)
+                if response.status_code == 304:
+                    self._not_modified += 1
+                return response
+
+            return wrapper
+        return decorator
+
+    def clear(self):
+        """清除本行程的所有快取項目"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_metrics(self):
+        """取得本行程的回應快取統計"""
+        with self._lock:
+            entries = len(self._entries)
+            size_bytes = sum(len(entry['body']) for entry in self._entries.values())
+        lookups = self._hits + self._misses
+        return {
+            'enabled': self.enabled,
+            'entries': entries,
+            'size_bytes': size_bytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': round(self._hits / lookups * 100, 1) if lookups else 0,
+            'not_modified': self._not_modified,
+            'watermark_errors': self._watermark_errors
+        }
+
+# =================== 模組層級實例 ===================
+
+response_cache = ResponseCache()
+
+def cached_response(max_age=None):
+    """依資料水位快取頁面回應的裝飾器：@cached_response()"""
+    return response_cache.cached(max_age=max_age)
+
+def clear_response_cache():
+    """清除本行程的回應快取"""
+    response_cache.clear()
+
+def get_response_cache_metrics():
+    """取得回應快取統計"""
+    return response_cache.get_metrics()
+
+__all__ = [
+    'ResponseCache',
+    'response_cache',
+    'cached_response',
+    'clear_response_cache',
+    'get_response_cache_metrics',
+    'RUNTIME_METRICS_MAX_AGE'
+]
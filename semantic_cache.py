@@ -0,0 +1,489 @@
+# =================== semantic_cache.py ===================
+# EMI智能教學助理系統 - 本地語意相似問答快取
+# 精確比對的問答快取（answer_cache.py）抓不到換句話說的問題，
+# 這裡以雜湊 n-gram TF-IDF 向量（僅用 NumPy，不需要 GPU 或網路）找出
+# 餘弦相似度超過門檻的已快取回答，命中時不必呼叫 Gemini
+#
+# 磁碟格式（SEMANTIC_CACHE_DIR）：
+#   vectors.f32   只能附加的原始 TF 向量（float32，每列 SEMANTIC_CACHE_DIM 維），以 memmap 讀取
+#   entries.jsonl 每列一筆問題/回答，row 對應 vectors.f32 的列號
+#   index.lock    跨行程檔案鎖：附加與壓縮取得獨佔鎖，讀取同步取得共享鎖
+
+import os
+import re
+import json
+import time
+import zlib
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:  # 沒有 NumPy 時停用語意快取
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台只做行程內鎖定
+    fcntl = None
+
+from answer_cache import normalize_question, is_cacheable_question, ANSWER_CACHE_TTL_HOURS
+
+logger = logging.getLogger(__name__)
+
+# =================== 語意快取配置 ===================
+
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() != 'false'
+SEMANTIC_CACHE_DIR = os.getenv('SEMANTIC_CACHE_DIR', 'semantic_cache')
+SEMANTIC_CACHE_DIM = int(os.getenv('SEMANTIC_CACHE_DIM', 2048))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.86))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 5000))
+SEMANTIC_CACHE_TTL_HOURS = int(os.getenv('SEMANTIC_CACHE_TTL_HOURS', ANSWER_CACHE_TTL_HOURS))
+
+# IDF 權重完整重算的間隔（秒）；期間新增的列以目前的 IDF 加權後直接附加到矩陣
+SEMANTIC_CACHE_REWEIGHT_SECONDS = int(os.getenv('SEMANTIC_CACHE_REWEIGHT_SECONDS', 600))
+# 自上次重算後資料量成長超過此比例時提前重算
+REWEIGHT_GROWTH = 0.25
+
+# 字元 n-gram 長度（同時涵蓋英文詞形變化與中文）
+CHAR_NGRAM = 3
+
+# 常見的疑問句虛詞，不影響問題主旨
+STOPWORDS = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'of', 'to', 'in', 'on', 'for',
+    'and', 'or', 'what', 'how', 'why', 'do', 'does', 'did', 'can', 'could', 'would',
+    'you', 'i', 'me', 'my', 'please', 'tell', 'explain', 'about', 'with'
+}
+
+# 否定詞：只差一個否定詞的問題向量幾乎相同，意思卻相反，兩邊的否定詞必須一致才算命中
+# （n't 縮寫正規化後成為單獨的 t）
+NEGATION_WORDS = {'not', 'no', 'non', 'never', 'without', 'cannot', 't'}
+NEGATION_PATTERN = re.compile(r"(不|沒有|沒|非|無)")
+
+# =================== 特徵雜湊 ===================
+
+def _hash_feature(feature, dim):
+    """以 crc32 雜湊特徵（跨行程穩定），高位元決定正負號以抵銷碰撞偏差"""
+    h = zlib.crc32(feature.encode('utf-8'))
+    return h % dim, (1.0 if (h >> 31) & 1 == 0 else -1.0)
+
+def extract_features(question):
+    """取出詞 unigram/bigram 與字元 n-gram 特徵"""
+    normalized = normalize_question(question)
+    # 去掉單一字元（what's → what s）與英文複數/第三人稱的 s，讓詞形變化對應到同一特徵
+    words = [w[:-1] if len(w) > 3 and w.endswith('s') and not w.endswith('ss') else w
+             for w in normalized.split() if len(w) > 1 and w not in STOPWORDS]
+
+    features = [f"w:{w}" for w in words]
+    features += [f"b:{a}_{b}" for a, b in zip(words, words[1:])]
+
+    compact = ''.join(words)
+    features += [f"c:{compact[i:i + CHAR_NGRAM]}" for i in range(max(0, len(compact) - CHAR_NGRAM + 1))]
+    return features
+
+def extract_negations(question):
+    """取出問題中的否定詞（英文詞與中文字）"""
+    normalized = normalize_question(question)
+    words = {w for w in normalized.split() if w in NEGATION_WORDS}
+    return words | set(NEGATION_PATTERN.findall(normalized))
+
+def embed_question(question, dim=SEMANTIC_CACHE_DIM):
+    """把問題轉成原始（未加 IDF 權重）的次線性 TF 向量"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in extract_features(question):
+        index, sign = _hash_feature(feature, dim)
+        vector[index] += sign
+    return np.sign(vector) * np.log1p(np.abs(vector))
+
+# =================== 語意索引 ===================
+
+class SemanticAnswerIndex:
+    """以 memmap 讀取的雜湊 TF-IDF 向量索引，多個 worker 透過同一組檔案共享"""
+
+    def __init__(self, directory=SEMANTIC_CACHE_DIR, dim=SEMANTIC_CACHE_DIM,
+                 threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl_hours=SEMANTIC_CACHE_TTL_HOURS, enabled=SEMANTIC_CACHE_ENABLED,
+                 reweight_seconds=SEMANTIC_CACHE_REWEIGHT_SECONDS):
+        self.directory = directory
+        self.dim = dim
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_hours * 3600
+        self.reweight_seconds = reweight_seconds
+        self.enabled = enabled and np is not None
+
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.entries_path = os.path.join(directory, 'entries.jsonl')
+        self.lock_path = os.path.join(directory, 'index.lock')
+
+        self._lock = threading.RLock()
+        self._loaded_pid = None
+        self._matrix = None
+        self._entries = []
+        self._entries_offset = 0
+        self._entries_inode = None
+        self._reset_weights()
+
+        # 統計資料（僅限本行程）
+        self._hits = 0
+        self._misses = 0
+        self._bypassed = 0
+        self._added = 0
+        self._reweighted = 0
+        self._last_score = None
+
+        if enabled and np is None:
+            logger.warning("⚠️ 未安裝 NumPy，語意快取停用")
+
+    # =================== 檔案鎖 ===================
+
+    @contextmanager
+    def _file_lock(self, exclusive):
+        """跨行程檔案鎖"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, 'a') as handle:
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    # =================== 載入與同步 ===================
+
+    def load(self):
+        """（重新）以 memmap 載入索引；gunicorn 分叉後每個 worker 呼叫一次"""
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            self._entries = []
+            self._entries_offset = 0
+            self._entries_inode = None
+            self._matrix = None
+            self._reset_weights()
+            self._loaded_pid = os.getpid()
+            self._sync()
+
+        logger.info(f"✅ 語意快取已載入: {len(self._entries)} 筆")
+        return True
+
+    def _sync(self):
+        """檔案有變動時讀入其他 worker 新增的資料；壓縮過（inode 改變）則完整重新載入"""
+        try:
+            stat = os.stat(self.entries_path)
+        except FileNotFoundError:
+            self._entries, self._matrix = [], None
+            self._entries_offset, self._entries_inode = 0, None
+            self._reset_weights()
+            return
+
+        rebuilt = stat.st_ino != self._entries_inode or stat.st_size < self._entries_offset
+        if not rebuilt and stat.st_size == self._entries_offset:
+            return
+
+        with self._file_lock(exclusive=False):
+            if rebuilt:
+                self._entries = []
+                self._entries_offset = 0
+                self._reset_weights()
+
+            with open(self.entries_path, 'rb') as f:
+                self._entries_inode = os.fstat(f.fileno()).st_ino
+                f.seek(self._entries_offset)
+                chunk = f.read()
+
+            # 只讀取完整的列，寫到一半的最後一列留待下次同步
+            complete = chunk[:chunk.rfind(b'\n') + 1]
+            self._entries_offset += len(complete)
+            for line in complete.splitlines():
+                try:
+                    self._entries.append(json.loads(line))
+                except ValueError:
+                    continue
+
+            rows = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                     shape=(rows, self.dim)) if rows else None
+
+        self._entries = [entry for entry in self._entries
+                         if self._matrix is not None and entry.get('row', -1) < self._matrix.shape[0]]
+
+    def _ensure_loaded(self):
+        if self._loaded_pid != os.getpid():
+            self.load()
+        else:
+            self._sync()
+
+    def _reset_weights(self):
+        """捨棄 IDF 加權矩陣，下次查詢時完整重算"""
+        self._weighted = None
+        self._weighted_count = 0
+        self._weighted_base = 0
+        self._weighted_at = 0.0
+        self._idf = None
+
+    def _weigh_rows(self, entries):
+        """以目前的 IDF 加權並正規化指定項目的原始向量"""
+        rows = np.array([entry['row'] for entry in entries], dtype=np.int64)
+        weighted = np.asarray(self._matrix[rows]) * self._idf
+        norms = np.linalg.norm(weighted, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return weighted / norms
+
+    def _weighted_matrix(self):
+        """
+        取得 IDF 加權並正規化的矩陣
+        其他 worker 新增的列以目前的 IDF 加權後附加（預留容量，不複製整個矩陣），
+        IDF 本身只在超過 reweight_seconds 或資料量明顯成長時才完整重算
+        """
+        count = len(self._entries)
+        if (self._weighted is None or count < self._weighted_count or
+                time.time() - self._weighted_at > self.reweight_seconds or
+                count > self._weighted_base * (1 + REWEIGHT_GROWTH)):
+            rows = np.array([entry['row'] for entry in self._entries], dtype=np.int64)
+            doc_freq = np.count_nonzero(np.asarray(self._matrix[rows]), axis=0)
+            self._idf = (np.log((1.0 + count) / (1.0 + doc_freq)) + 1.0).astype(np.float32)
+
+            capacity = max(count + 64, int(count * (1 + REWEIGHT_GROWTH)) + 1)
+            self._weighted = np.zeros((capacity, self.dim), dtype=np.float32)
+            self._weighted[:count] = self._weigh_rows(self._entries)
+            self._weighted_count = self._weighted_base = count
+            self._weighted_at = time.time()
+            self._reweighted += 1
+
+        elif count > self._weighted_count:
+            if count > self._weighted.shape[0]:
+                grown = np.zeros((count * 2, self.dim), dtype=np.float32)
+                grown[:self._weighted_count] = self._weighted[:self._weighted_count]
+                self._weighted = grown
+            self._weighted[self._weighted_count:count] = self._weigh_rows(self._entries[self._weighted_count:])
+            self._weighted_count = count
+
+        return self._weighted[:count], self._idf
+
+    # =================== 查詢 ===================
+
+    def search(self, question):
+        """找出最相似且未過期的快取回答，相似度低於門檻或否定詞不一致時回傳 None"""
+        if not self.enabled:
+            return None
+
+        if not is_cacheable_question(question):
+            self._bypassed += 1
+            return None
+
+        try:
+            with self._lock:
+                self._ensure_loaded()
+                if not self._entries:
+                    self._misses += 1
+                    return None
+
+                weighted, idf = self._weighted_matrix()
+                query = embed_question(question, self.dim) * idf
+                norm = np.linalg.norm(query)
+                if norm == 0:
+                    self._misses += 1
+                    return None
+
+                scores = weighted @ (query / norm)
+                cutoff = time.time() - self.ttl_seconds
+                expired = np.array([entry.get('created_at', 0) < cutoff for entry in self._entries])
+                scores[expired] = -1.0
+
+                best = int(np.argmax(scores))
+                self._last_score = round(float(scores[best]), 3)
+
+                # 依相似度由高到低，取第一個否定詞與問題一致的候選
+                negations = extract_negations(question)
+                candidates = np.flatnonzero(scores >= self.threshold)
+                entry = None
+                for index in candidates[np.argsort(-scores[candidates])]:
+                    if extract_negations(self._entries[index]['question']) == negations:
+                        entry, score = self._entries[index], float(scores[index])
+                        break
+
+                if entry is None:
+                    self._misses += 1
+                    return None
+
+            self._hits += 1
+            logger.info(f"🧭 語意快取命中 ({score:.2f}): {normalize_question(question)[:40]} ≈ {entry['question'][:40]}")
+            return entry['answer']
+
+        except Exception as e:
+            logger.error(f"❌ 語意快取查詢失敗: {e}")
+            return None
+
+    # =================== 寫入 ===================
+
+    def add(self, question, answer, model_name=None):
+        """附加以通用提示詞產生的問答到索引（依賴脈絡的問題不加入）"""
+        if not self.enabled or not answer or not is_cacheable_question(question):
+            return False
+
+        try:
+            vector = embed_question(question, self.dim)
+            if not np.any(vector):
+                return False
+
+            with self._lock:
+                with self._file_lock(exclusive=True):
+                    rows = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+                    with open(self.vectors_path, 'ab') as f:
+                        f.truncate(rows * self.dim * 4)  # 捨棄先前寫到一半的列
+                        f.write(vector.astype(np.float32).tobytes())
+
+                    entry = {
+                        'row': rows,
+                        'question': normalize_question(question),
+                        'answer': answer,
+                        'model_name': model_name,
+                        'created_at': time.time()
+                    }
+                    with open(self.entries_path, 'ab') as f:
+                        f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+
+                self._added += 1
+                self._ensure_loaded()
+
+                if len(self._entries) > self.max_entries * 1.2:
+                    self.compact()
+
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ 語意快取寫入失敗: {e}")
+            return False
+
+    # =================== 管理 ===================
+
+    def compact(self, drop_question=None, drop_all=False):
+        """
+        重寫索引檔：移除過期項目與指定問題，只保留最新的 max_entries 筆
+        以新檔案原子替換，其他 worker 偵測到 inode 改變後會重新載入
+        """
+        if not self.enabled:
+            return 0
+
+        dropped_key = normalize_question(drop_question) if drop_question else None
+        cutoff = time.time() - self.ttl_seconds
+
+        with self._lock:
+            with self._file_lock(exclusive=True):
+                self._sync_unlocked_full()
+
+                kept = [] if drop_all else [
+                    entry for entry in self._entries
+                    if entry.get('created_at', 0) >= cutoff and entry['question'] != dropped_key
+                ][-self.max_entries:]
+                removed = len(self._entries) - len(kept)
+
+                os.makedirs(self.directory, exist_ok=True)
+                vectors_tmp = f"{self.vectors_path}.{os.getpid()}.tmp"
+                entries_tmp = f"{self.entries_path}.{os.getpid()}.tmp"
+
+                with open(vectors_tmp, 'wb') as vf, open(entries_tmp, 'wb') as ef:
+                    for new_row, entry in enumerate(kept):
+                        vf.write(np.asarray(self._matrix[entry['row']], dtype=np.float32).tobytes())
+                        entry = dict(entry, row=new_row)
+                        ef.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+
+                os.replace(vectors_tmp, self.vectors_path)
+                os.replace(entries_tmp, self.entries_path)
+
+            self._entries_inode = None
+            self._sync()
+
+        if removed:
+            logger.info(f"🗜️ 語意快取壓縮完成，移除 {removed} 筆，保留 {len(kept)} 筆")
+        return removed
+
+    def _sync_unlocked_full(self):
+        """在已持有獨佔鎖時完整讀取索引檔"""
+        self._entries = []
+        self._entries_offset = 0
+        self._matrix = None
+        if not os.path.exists(self.entries_path):
+            return
+
+        with open(self.entries_path, 'rb') as f:
+            for line in f.read().splitlines():
+                try:
+                    self._entries.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        rows = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+        self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                 shape=(rows, self.dim)) if rows else None
+        self._entries = [entry for entry in self._entries if entry.get('row', -1) < rows]
+
+    def invalidate(self, question=None):
+        """使語意快取失效：指定問題時只移除該問題，否則清空全部"""
+        try:
+            return self.compact(drop_question=question, drop_all=question is None)
+        except Exception as e:
+            logger.error(f"❌ 語意快取失效操作失敗: {e}")
+            return 0
+
+    def get_metrics(self):
+        """取得語意快取統計"""
+        lookups = self._hits + self._misses
+        return {
+            'enabled': self.enabled,
+            'entries': len(self._entries),
+            'dim': self.dim,
+            'threshold': self.threshold,
+            'reweighted': self._reweighted,
+            'hits': self._hits,
+            'misses': self._misses,
+            'bypassed_context_dependent': self._bypassed,
+            'added': self._added,
+            'hit_rate': round(self._hits / lookups * 100, 1) if lookups else 0.0,
+            'last_best_score': self._last_score
+        }
+
+# =================== 模組層級實例 ===================
+
+semantic_index = SemanticAnswerIndex()
+
+def is_semantic_cache_enabled():
+    """語意快取是否啟用（未安裝 NumPy 時停用）"""
+    return semantic_index.enabled
+
+def load_semantic_cache():
+    """載入（memmap）語意快取索引"""
+    return semantic_index.load()
+
+def find_similar_answer(question):
+    """找出語意相近問題的快取回答"""
+    return semantic_index.search(question)
+
+def add_semantic_answer(question, answer, model_name=None):
+    """把以通用提示詞產生的問答加入語意快取"""
+    return semantic_index.add(question, answer, model_name)
+
+def invalidate_semantic_cache(question=None):
+    """使語意快取失效（不指定問題時清空全部）"""
+    return semantic_index.invalidate(question)
+
+def get_semantic_cache_metrics():
+    """取得語意快取統計"""
+    return semantic_index.get_metrics()
+
+__all__ = [
+    'SemanticAnswerIndex',
+    'semantic_index',
+    'embed_question',
+    'extract_negations',
+    'is_semantic_cache_enabled',
+    'load_semantic_cache',
+    'find_similar_answer',
+    'add_semantic_answer',
+    'invalidate_semantic_cache',
+    'get_semantic_cache_metrics'
+]
@@ -0,0 +1,201 @@
+# =================== sessionizer.py ===================
+# EMI智能教學助理系統 - 訊息串流的延遲會話切分
+# handle_message 寫入訊息時不再維護會話（session=None），會話分析只能以「訊息數 // 5」估算；
+# 這裡事後以 LAG(timestamp) 視窗函數取得每則未分配訊息在同一位學生中的前一則時間，
+# 間隔超過 SESSION_GAP_MINUTES 就切出新會話，再以批次 INSERT / CASE UPDATE 一次寫回，
+# 回覆熱路徑不需要任何會話記錄。由背景維護排程定期執行，也可在分析前針對單一學生執行
+#
+# 用法：
+#   python sessionizer.py                 # 切分所有學生的未分配訊息
+#   python sessionizer.py --student 12    # 只處理指定學生
+
+import os
+import json
+import logging
+import argparse
+import datetime
+
+from peewee import Case, fn
+
+from models import db, Student, ConversationSession, Message
+
+logger = logging.getLogger(__name__)
+
+# =================== 切分配置 ===================
+
+# 同一位學生兩則訊息間隔超過此時間（分鐘）視為不同會話，與自動結束會話的逾時一致
+SESSION_GAP_MINUTES = int(os.getenv('SESSION_GAP_MINUTES', os.getenv('SESSION_TIMEOUT_MINUTES', 30)))
+
+# 每一輪處理的學生數，以及每個 UPDATE 陳述式包含的列數
+SESSIONIZER_STUDENT_BATCH = int(os.getenv('SESSIONIZER_STUDENT_BATCH', 200))
+SESSIONIZER_CHUNK_SIZE = 500
+
+# =================== 會話切分 ===================
+
+class Sessionizer:
+    """依時間間隔把未分配會話的訊息切分成會話，整批寫入"""
+
+    def __init__(self, gap_minutes=SESSION_GAP_MINUTES, student_batch=SESSIONIZER_STUDENT_BATCH,
+                 chunk_size=SESSIONIZER_CHUNK_SIZE):
+        self.gap = datetime.timedelta(minutes=gap_minutes)
+        self.student_batch = max(1, student_batch)
+        self.chunk_size = max(1, chunk_size)
+
+    def run(self, student_ids=None):
+        """切分指定學生（預設為所有有未分配訊息的學生），回傳統計資料"""
+        stats = {'students': 0, 'messages': 0, 'sessions_created': 0, 'sessions_extended': 0}
+
+        if student_ids is None:
+            student_ids = [row.student_id for row in (Message
+                                                      .select(Message.student)
+                                                      .where(Message.session.is_null())
+                                                      .distinct())]
+        student_ids = sorted(set(student_ids))
+
+        for start in range(0, len(student_ids), self.student_batch):
+            batch = student_ids[start:start + self.student_batch]
+            with db.atomic():
+                created, extended, assigned = self._sessionize_batch(batch)
+            stats['students'] += len(batch)
+            stats['messages'] += assigned
+            stats['sessions_created'] += created
+            stats['sessions_extended'] += extended
+
+        if stats['messages']:
+            logger.info(f"✅ 會話切分完成: {stats}")
+        return stats
+
+    def _fetch_stream(self, student_ids):
+        """以 LAG 視窗函數取得每則未分配訊息在同一位學生中的前一則時間"""
+        previous = fn.LAG(Message.timestamp).over(
+            partition_by=[Message.student],
+            order_by=[Message.timestamp, Message.id]
+        )
+        query = (Message
+                 .select(Message.id, Message.student, Message.timestamp, previous.alias('previous_at'))
+                 .where(Message.session.is_null() & Message.student.in_(student_ids))
+                 .order_by(Message.student, Message.timestamp, Message.id)
+                 .tuples())
+        # 視窗函數的結果不經過欄位轉換（SQLite 回傳字串），以時間欄位的轉換器處理
+        return [
+            (message_id, student_id, timestamp, Message.timestamp.python_value(previous_at))
+            for message_id, student_id, timestamp, previous_at in query
+        ]
+
+    def _latest_sessions(self, student_ids):
+        """每位學生最近一個會話：{學生ID: (會話ID, 最後訊息時間)}"""
+        latest_ids = (ConversationSession
+                      .select(fn.MAX(ConversationSession.id))
+                      .where(ConversationSession.student.in_(student_ids))
+                      .group_by(ConversationSession.student))
+        return {
+            session.student_id: (session.id, session.last_message_at or session.session_start)
+            for session in ConversationSession
+            .select(ConversationSession.id, ConversationSession.student,
+                    ConversationSession.last_message_at, ConversationSession.session_start)
+            .where(ConversationSession.id.in_(latest_ids))
+        }
+
+    def _sessionize_batch(self, student_ids):
+        rows = self._fetch_stream(student_ids)
+        if not rows:
+            return 0, 0, 0
+
+        latest = self._latest_sessions(student_ids)
+
+        # 依間隔分組：每組是 [學生ID, 既有會話ID 或 None, [訊息ID...], 第一則時間, 最後一則時間]
+        groups = []
+        for message_id, student_id, timestamp, previous_at in rows:
+            if previous_at is None:
+                # 學生第一則未分配訊息：與最近的既有會話比較，間隔內就併入該會話
+                session_id, last_at = latest.get(student_id, (None, None))
+                if session_id is not None and last_at is not None and abs(timestamp - last_at) <= self.gap:
+                    groups.append([student_id, session_id, [], timestamp, max(timestamp, last_at)])
+                else:
+                    groups.append([student_id, None, [], timestamp, timestamp])
+            elif timestamp - previous_at > self.gap:
+                groups.append([student_id, None, [], timestamp, timestamp])
+            group = groups[-1]
+            group[2].append(message_id)
+            group[4] = max(group[4], timestamp)
+
+        now = datetime.datetime.now()
+        assignments = []
+        created = 0
+        extended = 0
+        new_sessions_by_student = {}
+
+        for student_id, session_id, message_ids, first_at, last_at in groups:
+            # 最後一則訊息仍在間隔內的會話保持進行中，交給自動結束任務處理
+            session_end = last_at if now - last_at > self.gap else None
+
+            if session_id is None:
+                session_id = ConversationSession.insert(
+                    student=student_id,
+                    session_start=first_at,
+                    session_end=session_end,
+                    message_count=len(message_ids),
+                    last_message_at=last_at,
+                    created_at=now
+                ).execute()
+                created += 1
+                new_sessions_by_student[student_id] = new_sessions_by_student.get(student_id, 0) + 1
+            else:
+                ConversationSession.update(
+                    message_count=ConversationSession.message_count + len(message_ids),
+                    last_message_at=last_at,
+                    session_end=session_end
+                ).where(ConversationSession.id == session_id).execute()
+                extended += 1
+
+            assignments.extend((message_id, session_id) for message_id in message_ids)
+
+        # 以 CASE 表達式分塊寫回訊息的會話
+        for start in range(0, len(assignments), self.chunk_size):
+            chunk = assignments[start:start + self.chunk_size]
+            Message.update(session=Case(Message.id, chunk)).where(
+                Message.id.in_([message_id for message_id, _ in chunk])
+            ).execute()
+
+        # 遞增學生的會話數
+        session_counts = list(new_sessions_by_student.items())
+        for start in range(0, len(session_counts), self.chunk_size):
+            chunk = session_counts[start:start + self.chunk_size]
+            Student.update(total_sessions=Student.total_sessions + Case(Student.id, chunk, 0)).where(
+                Student.id.in_([student_id for student_id, _ in chunk])
+            ).execute()
+
+        return created, extended, len(assignments)
+
+# =================== 便利函數 ===================
+
+sessionizer = Sessionizer()
+
+def sessionize_messages(student_ids=None):
+    """切分未分配會話的訊息，回傳統計資料"""
+    try:
+        return sessionizer.run(student_ids)
+    except Exception as e:
+        logger.error(f"❌ 會話切分失敗: {e}")
+        return {'students': 0, 'messages': 0, 'sessions_created': 0, 'sessions_extended': 0, 'error': str(e)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='以時間間隔把訊息切分成會話')
+    parser.add_argument('--student', type=int, action='append', help='只處理指定學生ID（可重複）')
+    parser.add_argument('--gap-minutes', type=int, default=SESSION_GAP_MINUTES, help='切分會話的間隔（分鐘）')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with db.connection_context():
+        stats = Sessionizer(gap_minutes=args.gap_minutes).run(args.student)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+__all__ = [
+    'Sessionizer',
+    'sessionizer',
+    'sessionize_messages'
+]
+
+if __name__ == '__main__':
+    main()
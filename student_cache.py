@@ -0,0 +1,391 @@
+# =================== student_cache.py ===================
+# EMI智能教學助理系統 - 行程內學生與對話上下文快取
+# 每則訊息原本都要 Student.get(line_user_id) 並讀取對話記憶；
+# 這裡在每個 gunicorn worker 內以有上限的 LRU 保存 Student 資料列與對話上下文，
+# 寫入成功後直接更新快取（write-through），穩定狀態下回覆路徑不需讀取資料庫
+#
+# 跨 worker 失效：共用的版本計數檔（VERSION_SLOTS 個 uint64，以 mmap 讀取）
+#   每位學生依ID對應一個槽位，任何 worker 修改學生資料或記憶時遞增該槽位；
+#   讀取快取時比對槽位版本，不一致就重新從資料庫載入。讀版本不需要系統呼叫，
+#   遞增時以 fcntl 檔案鎖保護。槽位碰撞只會造成多餘的重新載入
+# 跨主機失效：版本檔只在同一台主機內共用，修改時另外遞增資料庫 student_cache_versions
+#   中該學生的版本；每個 worker 每 STUDENT_CACHE_SYNC_SECONDS 秒讀取最近變更的列，
+#   丟棄其他主機修改過的學生（本行程自己的寫入已記下版本，不會丟棄）
+#
+# Student.save() / delete_instance() 會呼叫 invalidate()，Webhook 以外的修改（管理編輯、清理工作）也會生效
+
+import os
+import mmap
+import time
+import struct
+import logging
+import datetime
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台只做行程內版本計數
+    fcntl = None
+
+from models import Student, StudentCacheVersion
+
+logger = logging.getLogger(__name__)
+
+# =================== 快取配置 ===================
+
+STUDENT_CACHE_ENABLED = os.getenv('STUDENT_CACHE_ENABLED', 'true').lower() != 'false'
+STUDENT_CACHE_SIZE = int(os.getenv('STUDENT_CACHE_SIZE', 1000))
+
+# 即使版本沒變，超過此時間（秒）也重新載入，限制版本檔無法使用時的資料落差
+STUDENT_CACHE_TTL = int(os.getenv('STUDENT_CACHE_TTL', 600))
+
+STUDENT_CACHE_VERSION_FILE = os.getenv(
+    'STUDENT_CACHE_VERSION_FILE',
+    os.path.join(tempfile.gettempdir(), 'emi_student_cache_versions')
+)
+
+# 讀取資料庫版本表的間隔（秒）：其他主機的修改最晚在這段時間後生效
+STUDENT_CACHE_SYNC_SECONDS = float(os.getenv('STUDENT_CACHE_SYNC_SECONDS', 1.0))
+
+# 讀取最近變更時往前多看的秒數，涵蓋主機之間的時鐘誤差與較晚提交的交易
+STUDENT_CACHE_SYNC_MARGIN = float(os.getenv('STUDENT_CACHE_SYNC_MARGIN', 10.0))
+
+VERSION_SLOTS = 4096
+VERSION_FORMAT = '<Q'
+VERSION_SIZE = struct.calcsize(VERSION_FORMAT)
+
+# =================== 跨行程版本計數 ===================
+
+class VersionCounters:
+    """以 mmap 共用的學生版本計數；無法使用時退回行程內計數"""
+
+    def __init__(self, path=STUDENT_CACHE_VERSION_FILE, slots=VERSION_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._mm = None
+        self._fd = None
+        self._local = {}
+        self._lock = threading.Lock()
+        self._opened = False
+
+    def _open(self):
+        """延遲開啟版本檔（各 worker 共用同一個檔案）"""
+        if self._opened:
+            return self._mm
+        with self._lock:
+            if self._opened:
+                return self._mm
+            self._opened = True
+            if fcntl is None:
+                logger.warning("⚠️ 平台不支援檔案鎖，學生快取只在行程內失效")
+                return None
+            try:
+                size = self.slots * VERSION_SIZE
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size < size:
+                        os.ftruncate(fd, size)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._mm = mmap.mmap(fd, size)
+                self._fd = fd
+            except Exception as e:
+                logger.error(f"❌ 開啟學生快取版本檔失敗，只在行程內失效: {e}")
+                self._mm = None
+            return self._mm
+
+    def _offset(self, student_id):
+        return (student_id % self.slots) * VERSION_SIZE
+
+    def get(self, student_id):
+        mm = self._open()
+        if mm is None:
+            return self._local.get(student_id % self.slots, 0)
+        return struct.unpack_from(VERSION_FORMAT, mm, self._offset(student_id))[0]
+
+    def bump(self, student_id):
+        """遞增版本，回傳 (舊版本, 新版本)"""
+        mm = self._open()
+        if mm is None:
+            with self._lock:
+                slot = student_id % self.slots
+                old = self._local.get(slot, 0)
+                self._local[slot] = old + 1
+                return old, old + 1
+
+        offset = self._offset(student_id)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                old = struct.unpack_from(VERSION_FORMAT, mm, offset)[0]
+                struct.pack_into(VERSION_FORMAT, mm, offset, old + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return old, old + 1
+
+# =================== 學生快取 ===================
+
+class StudentCache:
+    """Student 資料列（以 line_user_id 為鍵）與對話上下文（以學生ID為鍵）的行程內 LRU"""
+
+    def __init__(self, max_size=STUDENT_CACHE_SIZE, ttl=STUDENT_CACHE_TTL,
+                 enabled=STUDENT_CACHE_ENABLED, versions=None,
+                 sync_seconds=STUDENT_CACHE_SYNC_SECONDS, sync_margin=STUDENT_CACHE_SYNC_MARGIN):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.enabled = enabled
+        self.versions = versions or VersionCounters()
+        self.sync_seconds = sync_seconds
+        self.sync_margin = sync_margin
+        self._students = OrderedDict()   # line_user_id -> (資料, 版本, 快取時間)
+        self._student_keys = {}          # 學生ID -> line_user_id
+        self._contexts = OrderedDict()   # 學生ID -> (上下文, 版本, 快取時間)
+        self._lock = threading.Lock()
+
+        # 資料庫版本同步：本行程已知的各學生版本，與下一次讀取的起點
+        self._db_versions = {}
+        self._synced_at = datetime.datetime.now()
+        self._next_sync = 0.0
+        self._sync_lock = threading.Lock()
+
+        # 統計資料（僅限本行程）
+        self._student_hits = 0
+        self._student_misses = 0
+        self._context_hits = 0
+        self._context_misses = 0
+        self._stale = 0
+        self._invalidations = 0
+        self._remote_invalidations = 0
+
+    def _lookup(self, store, key, student_id):
+        """取得仍然有效的項目；版本不符或逾時就移除"""
+        entry = store.get(key)
+        if entry is None:
+            return None
+        value, version, cached_at = entry
+        if version != self.versions.get(student_id) or time.time() - cached_at > self.ttl:
+            del store[key]
+            self._stale += 1
+            return None
+        store.move_to_end(key)
+        return value
+
+    def _drop(self, student_id):
+        """丟棄本行程快取的某位學生（呼叫端須持有 self._lock）"""
+        line_user_id = self._student_keys.pop(student_id, None)
+        self._students.pop(line_user_id, None)
+        self._contexts.pop(student_id, None)
+
+    def _store(self, store, key, value, version):
+        store[key] = (value, version, time.time())
+        store.move_to_end(key)
+        while len(store) > self.max_size:
+            _, (evicted, _, _) = store.popitem(last=False)
+            if store is self._students:
+                self._student_keys.pop(evicted['id'], None)
+
+    # =================== 跨主機同步 ===================
+
+    def sync(self, force=False):
+        """
+        讀取資料庫中最近變更的學生版本，丟棄其他行程（包括其他主機）修改過的學生；
+        每 sync_seconds 秒最多一次，同時只有一個執行緒讀取
+        """
+        now = time.time()
+        if not force and now < self._next_sync:
+            return
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            started = datetime.datetime.now()
+            changed = StudentCacheVersion.changed_since(
+                self._synced_at - datetime.timedelta(seconds=self.sync_margin)
+            )
+            with self._lock:
+                for student_id, version in changed.items():
+                    # 版本只會遞增：不大於已知版本的是本行程自己的寫入或已處理過的變更
+                    if version <= self._db_versions.get(student_id, 0):
+                        continue
+                    self._db_versions[student_id] = version
+                    if self._student_keys.get(student_id) is not None or student_id in self._contexts:
+                        self._drop(student_id)
+                        self._remote_invalidations += 1
+            self._synced_at = started
+        except Exception as e:
+            logger.error(f"❌ 讀取學生快取版本失敗: {e}")
+        finally:
+            self._next_sync = time.time() + self.sync_seconds
+            self._sync_lock.release()
+
+    def _publish(self, student_id):
+        """遞增資料庫中的學生版本並記下，讓其他主機失效而本行程不會因此丟棄"""
+        try:
+            version = StudentCacheVersion.bump(student_id)
+            with self._lock:
+                self._db_versions[student_id] = max(version, self._db_versions.get(student_id, 0))
+        except Exception as e:
+            logger.error(f"❌ 遞增學生快取版本失敗 (學生 {student_id}): {e}")
+
+    # =================== 學生資料 ===================
+
+    def get_student(self, line_user_id):
+        """
+        取得學生；與 Student.get 相同，找不到時拋出 Student.DoesNotExist
+        每次回傳新的模型實例，執行緒之間不共用可變物件
+        """
+        if not self.enabled:
+            return Student.get(Student.line_user_id == line_user_id)
+
+        self.sync()
+        with self._lock:
+            entry = self._students.get(line_user_id)
+            data = self._lookup(self._students, line_user_id, entry[0]['id']) if entry else None
+            if data is not None:
+                self._student_hits += 1
+                return self._build_student(data)
+
+        self._student_misses += 1
+        student = Student.get(Student.line_user_id == line_user_id)
+        with self._lock:
+            self._store(self._students, line_user_id, dict(student.__data__), self.versions.get(student.id))
+            self._student_keys[student.id] = line_user_id
+        return student
+
+    @staticmethod
+    def _build_student(data):
+        student = Student(**data)
+        student._dirty.clear()
+        return student
+
+    # =================== 對話上下文 ===================
+
+    def get_context(self, student_id):
+        """取得快取的對話上下文，沒有時回傳 None"""
+        if not self.enabled:
+            return None
+
+        self.sync()
+        with self._lock:
+            context = self._lookup(self._contexts, student_id, student_id)
+            if context is None:
+                self._context_misses += 1
+                return None
+            self._context_hits += 1
+            return self._copy_context(context)
+
+    def put_context(self, student_id, context):
+        """快取從資料庫讀到的上下文（不遞增版本）"""
+        if not self.enabled or context is None:
+            return
+        with self._lock:
+            self._store(self._contexts, student_id, self._copy_context(context), self.versions.get(student_id))
+
+    @staticmethod
+    def _copy_context(context):
+        copied = dict(context)
+        for key in ('conversation_flow', 'recent_topics'):
+            if key in copied:
+                copied[key] = list(copied[key])
+        return copied
+
+    # =================== 寫入與失效 ===================
+
+    def write_through(self, student=None, context=None, student_id=None):
+        """
+        資料庫寫入成功後更新快取並遞增版本，讓其他 worker 重新載入；
+        本行程其他未變動的項目若原本是最新版本，沿用到新版本
+        """
+        if not self.enabled:
+            return
+        student_id = student.id if student is not None else student_id
+
+        self._publish(student_id)
+        old_version, new_version = self.versions.bump(student_id)
+        with self._lock:
+            line_user_id = student.line_user_id if student is not None else self._student_keys.get(student_id)
+
+            if student is not None:
+                self._store(self._students, line_user_id, dict(student.__data__), new_version)
+                self._student_keys[student_id] = line_user_id
+            elif line_user_id in self._students:
+                self._restamp(self._students, line_user_id, old_version, new_version)
+
+            if context is not None:
+                self._store(self._contexts, student_id, self._copy_context(context), new_version)
+            elif student_id in self._contexts:
+                self._restamp(self._contexts, student_id, old_version, new_version)
+
+    @staticmethod
+    def _restamp(store, key, old_version, new_version):
+        value, version, cached_at = store[key]
+        if version == old_version:
+            store[key] = (value, new_version, cached_at)
+        else:
+            del store[key]
+
+    def invalidate(self, student_id, context_only=False):
+        """
+        使某位學生在所有 worker 的快取失效；
+        context_only 時本行程保留學生資料，只丟棄對話上下文（背景更新摘要或主題時使用）
+        """
+        if not self.enabled:
+            return
+        self._publish(student_id)
+        old_version, new_version = self.versions.bump(student_id)
+        with self._lock:
+            line_user_id = self._student_keys.get(student_id)
+            if context_only and line_user_id in self._students:
+                self._restamp(self._students, line_user_id, old_version, new_version)
+                self._contexts.pop(student_id, None)
+            else:
+                self._drop(student_id)
+        self._invalidations += 1
+
+    def get_metrics(self):
+        """取得命中率等統計"""
+        student_lookups = self._student_hits + self._student_misses
+        context_lookups = self._context_hits + self._context_misses
+        return {
+            'enabled': self.enabled,
+            'students': len(self._students),
+            'contexts': len(self._contexts),
+            'student_hit_rate': round(self._student_hits / student_lookups * 100, 1) if student_lookups else 0.0,
+            'context_hit_rate': round(self._context_hits / context_lookups * 100, 1) if context_lookups else 0.0,
+            'stale_reloads': self._stale,
+            'invalidations': self._invalidations,
+            'remote_invalidations': self._remote_invalidations,
+            'shared_versions': self.versions._mm is not None,
+            'max_size': self.max_size
+        }
+
+# =================== 模組層級實例 ===================
+
+student_cache = StudentCache()
+
+def get_cached_student(line_user_id):
+    """取得學生（快取優先），找不到時拋出 Student.DoesNotExist"""
+    return student_cache.get_student(line_user_id)
+
+def cache_student(student):
+    """學生資料寫入資料庫後更新快取"""
+    student_cache.write_through(student=student)
+
+def invalidate_student_cache(student_id, context_only=False):
+    """使學生快取失效"""
+    student_cache.invalidate(student_id, context_only=context_only)
+
+def get_student_cache_metrics():
+    """取得學生快取統計"""
+    return student_cache.get_metrics()
+
+__all__ = [
+    'StudentCache',
+    'student_cache',
+    'get_cached_student',
+    'cache_student',
+    'invalidate_student_cache',
+    'get_student_cache_metrics'
+]
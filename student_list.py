@@ -0,0 +1,179 @@
+# =================== student_list.py ===================
+# EMI智能教學助理系統 - 學生列表分頁查詢
+# /students 原本載入所有學生、每位學生各查一次訊息數，再串成一個巨大的表格；
+# 這裡每頁只執行一個查詢：訊息數等統計已是學生表上的欄位（Message.create 維護），
+# 以 (排序欄位, id) 做 keyset 分頁，支援任何欄位的伺服器端排序與姓名／學號搜尋，
+# 同一個函數供 HTML 頁面與 /api/students JSON 使用
+
+import json
+import base64
+import logging
+import datetime
+
+from peewee import Case, fn
+
+from models import Student
+
+logger = logging.getLogger(__name__)
+
+# =================== 分頁配置 ===================
+
+STUDENT_PAGE_SIZE = 50
+STUDENT_PAGE_SIZE_MAX = 200
+
+# 可為空的時間欄位排序時以此值代替 NULL，讓 keyset 比較有固定順序
+NULL_DATETIME = datetime.datetime(1970, 1, 1)
+
+# 排序鍵 -> (排序運算式, 值的型別)
+SORT_COLUMNS = {
+    'id': (Student.id, 'int'),
+    'name': (Student.name, 'str'),
+    'student_id': (Student.student_id, 'str'),
+    'status': (Student.registration_step, 'int'),
+    'messages': (Student.message_count, 'int'),
+    'questions': (Student.total_questions, 'int'),
+    'last_active': (Student.last_activity, 'datetime'),
+    'last_message': (fn.COALESCE(Student.last_message_at, NULL_DATETIME), 'datetime'),
+    'created': (Student.created_at, 'datetime'),
+}
+DEFAULT_SORT = 'created'
+DEFAULT_DIRECTION = 'desc'
+
+LIST_FIELDS = (
+    Student.id, Student.name, Student.student_id, Student.registration_step,
+    Student.message_count, Student.total_questions, Student.last_activity,
+    Student.last_message_at, Student.created_at, Student.is_demo
+)
+
+# =================== 分頁游標 ===================
+
+def encode_cursor(value, student_id):
+    """把最後一列的 (排序值, id) 編碼成 URL 安全的字串"""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, student_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, kind):
+    """解碼游標，格式錯誤時回傳 None（從第一頁開始）"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, student_id = json.loads(raw.decode('utf-8'))
+        if kind == 'datetime':
+            value = datetime.datetime.fromisoformat(value)
+        elif kind == 'int':
+            value = int(value)
+        else:
+            value = str(value)
+        return value, int(student_id)
+    except Exception:
+        logger.warning(f"⚠️ 無效的學生列表游標: {cursor[:40]}")
+        return None
+
+# =================== 查詢 ===================
+
+def normalize_sort(sort, direction):
+    """不支援的排序鍵與方向退回預設值"""
+    sort = sort if sort in SORT_COLUMNS else DEFAULT_SORT
+    direction = direction if direction in ('asc', 'desc') else DEFAULT_DIRECTION
+    return sort, direction
+
+def _search_filter(search):
+    search = (search or '').strip()
+    if not search:
+        return None
+    return Student.name.contains(search) | Student.student_id.contains(search)
+
+def get_student_page(sort=DEFAULT_SORT, direction=DEFAULT_DIRECTION, search=None,
+                     after=None, limit=STUDENT_PAGE_SIZE):
+    """
+    取得一頁學生（單一查詢），回傳：
+    {'students': [...], 'next_cursor': str 或 None, 'sort': ..., 'direction': ..., 'search': ...}
+    """
+    sort, direction = normalize_sort(sort, direction)
+    limit = max(1, min(int(limit or STUDENT_PAGE_SIZE), STUDENT_PAGE_SIZE_MAX))
+    column, kind = SORT_COLUMNS[sort]
+    descending = direction == 'desc'
+
+    query = Student.select(*LIST_FIELDS, column.alias('sort_value'))
+
+    conditions = []
+    search_filter = _search_filter(search)
+    if search_filter is not None:
+        conditions.append(search_filter)
+
+    cursor = decode_cursor(after, kind)
+    if cursor is not None:
+        value, last_id = cursor
+        if descending:
+            conditions.append((column < value) | ((column == value) & (Student.id < last_id)))
+        else:
+            conditions.append((column > value) | ((column == value) & (Student.id > last_id)))
+
+    if conditions:
+        query = query.where(*conditions)
+
+    if descending:
+        query = query.order_by(column.desc(), Student.id.desc())
+    else:
+        query = query.order_by(column.asc(), Student.id.asc())
+
+    # 多取一列判斷是否還有下一頁
+    rows = list(query.limit(limit + 1).dicts())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        sort_value = last['sort_value']
+        if kind == 'datetime' and isinstance(sort_value, str):
+            sort_value = Student.created_at.python_value(sort_value)
+        next_cursor = encode_cursor(sort_value, last['id'])
+
+    for row in rows:
+        row.pop('sort_value', None)
+
+    return {
+        'students': rows,
+        'next_cursor': next_cursor,
+        'sort': sort,
+        'direction': direction,
+        'search': (search or '').strip()
+    }
+
+def get_student_summary(search=None):
+    """學生總數與註冊狀態統計（單一彙總查詢）"""
+    query = Student.select(
+        fn.COUNT(Student.id).alias('total'),
+        fn.SUM(Case(None, [(Student.registration_step == 0, 1)], 0)).alias('registered'),
+        fn.SUM(Case(None, [(Student.registration_step > 0, 1)], 0)).alias('pending')
+    )
+    search_filter = _search_filter(search)
+    if search_filter is not None:
+        query = query.where(search_filter)
+
+    row = query.dicts().get()
+    return {
+        'total': row['total'] or 0,
+        'registered': row['registered'] or 0,
+        'pending': row['pending'] or 0
+    }
+
+def serialize_student_row(row):
+    """把查詢列轉成 JSON 可用的字典"""
+    return {
+        key: value.isoformat() if isinstance(value, datetime.datetime) else value
+        for key, value in row.items()
+    }
+
+__all__ = [
+    'SORT_COLUMNS',
+    'STUDENT_PAGE_SIZE',
+    'get_student_page',
+    'get_student_summary',
+    'serialize_student_row',
+    'normalize_sort'
+]
@@ -0,0 +1,90 @@
+# =================== student_mailbox.py ===================
+# EMI智能教學助理系統 - 依學生分區的事件執行器
+# 同一位學生（line_user_id）的事件依序執行，避免連續訊息在
+# registration_step 與對話上下文上互相競爭；不同學生則在有上限的執行緒池中平行處理
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 每次輪到某個信箱時最多連續處理的事件數，之後讓出執行緒給其他學生
+MAILBOX_BATCH_LIMIT = 10
+
+# =================== 學生信箱執行器 ===================
+
+class StudentMailboxExecutor:
+    """每位學生一個 FIFO 信箱；同一時間每個信箱最多只有一個執行緒在處理"""
+
+    def __init__(self, max_workers=4, thread_name_prefix='mailbox-worker', batch_limit=MAILBOX_BATCH_LIMIT):
+        self.max_workers = max(1, max_workers)
+        self.batch_limit = max(1, batch_limit)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=thread_name_prefix)
+        self._mailboxes = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def submit(self, key, fn, *args, **kwargs):
+        """把工作放入 key 對應的信箱；信箱原本閒置時才排程新的處理執行緒"""
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            schedule = mailbox is None
+            if schedule:
+                mailbox = deque()
+                self._mailboxes[key] = mailbox
+            mailbox.append((fn, args, kwargs))
+            self._pending += 1
+
+        if schedule:
+            self._pool.submit(self._drain, key)
+
+    def _drain(self, key):
+        """依序處理信箱中的工作，處理完或達到批次上限時讓出執行緒"""
+        while True:
+            for _ in range(self.batch_limit):
+                with self._lock:
+                    mailbox = self._mailboxes.get(key)
+                    if not mailbox:
+                        self._mailboxes.pop(key, None)
+                        return
+                    fn, args, kwargs = mailbox.popleft()
+                    self._pending -= 1
+
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e:
+                    logger.error(f"❌ 信箱 {key} 的工作執行失敗: {e}")
+
+            # 達到批次上限：信箱仍保留（維持順序），重新排到執行緒池尾端
+            with self._lock:
+                if not self._mailboxes.get(key):
+                    self._mailboxes.pop(key, None)
+                    return
+            try:
+                self._pool.submit(self._drain, key)
+                return
+            except RuntimeError:
+                # 執行緒池已在 shutdown：無法重新排程，留在目前的執行緒處理完剩下的工作
+                continue
+
+    def active_keys(self):
+        """取得目前有工作在排隊或執行中的 key"""
+        with self._lock:
+            return set(self._mailboxes.keys())
+
+    def shutdown(self, wait=True):
+        """停止執行緒池"""
+        self._pool.shutdown(wait=wait)
+
+    def get_metrics(self):
+        """取得信箱統計"""
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'active_mailboxes': len(self._mailboxes),
+                'queued_tasks': self._pending
+            }
+
+__all__ = ['StudentMailboxExecutor']
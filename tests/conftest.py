@@ -0,0 +1,25 @@
+# =================== tests/conftest.py ===================
+# 測試共用設定：讓測試可以直接 import 專案根目錄的模組，並提供暫存 SQLite 資料庫
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import db, ALL_MODELS  # noqa: E402
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """把共用的資料庫切換到暫存的 SQLite 檔案（測試結束後還原）"""
+    original = db.database
+    db.close()
+    db.init(str(tmp_path / 'test.db'))
+    db.connect()
+    db.create_tables(ALL_MODELS, safe=True)
+    try:
+        yield db
+    finally:
+        db.close()
+        db.init(original)
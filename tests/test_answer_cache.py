@@ -0,0 +1,28 @@
+# =================== tests/test_answer_cache.py ===================
+# 問答快取：依問題文字與學生最近的對話判斷是否可使用通用（可快取）的回答
+
+import datetime
+
+from answer_cache import is_cacheable_question, is_context_dependent, CONTEXT_WINDOW_MINUTES
+
+def _context(minutes_ago):
+    timestamp = datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)
+    return {'conversation_flow': [{'content': 'What is AI?', 'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S')}]}
+
+def test_standalone_question_without_recent_conversation_is_cacheable():
+    assert is_cacheable_question("What is supervised learning?")
+    assert is_cacheable_question("What is supervised learning?", {'conversation_flow': []})
+    assert is_cacheable_question("What is supervised learning?", _context(CONTEXT_WINDOW_MINUTES + 5))
+    assert is_cacheable_question("什麼是再生能源的應用方式")
+
+def test_recent_conversation_keeps_personalized_answer():
+    assert is_context_dependent("What is supervised learning?", _context(2))
+    assert not is_cacheable_question("What is supervised learning?", _context(2))
+
+def test_context_references_are_never_cacheable():
+    old_context = _context(CONTEXT_WINDOW_MINUTES + 5)
+    for question in ["Can you explain that again?", "再解釋一次", "還有呢", "ok"]:
+        assert not is_cacheable_question(question, old_context), question
+
+def test_overlong_question_is_not_cacheable():
+    assert not is_cacheable_question("what is " + "very " * 100 + "long")
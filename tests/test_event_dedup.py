@@ -0,0 +1,44 @@
+# =================== tests/test_event_dedup.py ===================
+# 事件去重：重複事件在外層交易中以 savepoint 認領，不會中斷交易；交易回滾時事件ID不會被記住
+
+from models import db, ProcessedEvent, WebhookJob
+from event_dedup import EventDeduplicator
+from webhook_queue import WebhookJobQueue
+
+def _event(event_id):
+    return {'webhookEventId': event_id, 'type': 'message', 'source': {'userId': 'U1'}}
+
+def test_duplicate_inside_transaction_keeps_transaction_usable(sqlite_db):
+    dedup = EventDeduplicator()
+    queue = WebhookJobQueue()
+
+    with db.atomic():
+        new_events = dedup.filter_new_events([_event('e1'), _event('e1'), _event('e2')])
+        queue.enqueue(new_events)
+    dedup.remember_events(new_events)
+
+    assert [event['webhookEventId'] for event in new_events] == ['e1', 'e2']
+    assert ProcessedEvent.select().count() == 2
+    assert WebhookJob.select().count() == 2
+
+    # 已接收過的事件（包括 LINE 重送）直接丟棄
+    assert dedup.filter_new_events([_event('e1')]) == []
+
+def test_rolled_back_events_are_accepted_again(sqlite_db):
+    dedup = EventDeduplicator()
+
+    try:
+        with db.atomic():
+            new_events = dedup.filter_new_events([_event('e1')])
+            assert len(new_events) == 1
+            raise RuntimeError('enqueue failed')
+    except RuntimeError:
+        pass
+
+    assert ProcessedEvent.select().count() == 0
+    assert len(dedup.filter_new_events([_event('e1')])) == 1
+
+def test_other_process_claim_is_detected_by_database(sqlite_db):
+    ProcessedEvent.create(event_id='e1')
+
+    assert EventDeduplicator().filter_new_events([_event('e1')]) == []
@@ -0,0 +1,55 @@
+# =================== tests/test_maintenance_scheduler.py ===================
+# 背景維護排程：預設任務在暫存 SQLite 資料庫上執行，不可刪除已完成註冊的學生
+
+import datetime
+
+from models import Student, Message, DataVersion
+from maintenance_scheduler import MaintenanceScheduler, build_default_tasks, count_changed_rows
+
+def _create_student(line_user_id, registration_step, days_ago, **fields):
+    created = datetime.datetime.now() - datetime.timedelta(days=days_ago)
+    return Student.create(line_user_id=line_user_id, name=fields.pop('name', line_user_id),
+                          student_id=fields.pop('student_id', 'A000001'), registration_step=registration_step,
+                          created_at=created, last_activity=created, **fields)
+
+def _run_default_tasks():
+    scheduler = MaintenanceScheduler(tasks=build_default_tasks(), enabled=False)
+    for task in scheduler.tasks:
+        assert scheduler.run_task(task), task.name
+        assert task.last_error is None, (task.name, task.last_error)
+    return scheduler
+
+def test_default_tasks_keep_registered_students(sqlite_db):
+    # registration_step == 0 代表註冊完成（見 app.py 註冊流程）
+    registered = _create_student('U_registered', 0, days_ago=30)
+    Message.create(student=registered, content='What is AI?', message_type='question', source_type='line')
+    pending = _create_student('U_pending', 1, days_ago=30, name='', student_id='')
+    recent_pending = _create_student('U_recent_pending', 2, days_ago=1, name='')
+    demo = _create_student('demo_student_009', 3, days_ago=30, name='[DEMO] 學生')
+
+    _run_default_tasks()
+
+    remaining = {student.id for student in Student.select()}
+    assert registered.id in remaining
+    assert Message.select().where(Message.student == registered.id).count() == 1
+    assert recent_pending.id in remaining
+    assert demo.id in remaining
+    assert pending.id not in remaining
+
+def test_noop_runs_do_not_bump_maintenance_version(sqlite_db):
+    scheduler = _run_default_tasks()
+    version = DataVersion.get_or_none(DataVersion.name == 'maintenance')
+    before = version.version if version else 0
+
+    # 沒有任何資料需要處理的第二輪不應讓快取頁面失效（租約的最短間隔未到，直接執行任務）
+    for task in scheduler.tasks:
+        scheduler._execute(task, scheduler.owner)
+        assert task.last_error is None, (task.name, task.last_error)
+    version = DataVersion.get_or_none(DataVersion.name == 'maintenance')
+    assert (version.version if version else 0) == before
+
+def test_count_changed_rows():
+    assert count_changed_rows(0) == 0
+    assert count_changed_rows(3) == 3
+    assert count_changed_rows({'students': 0, 'messages': 2, 'error': 'x'}) == 2
+    assert count_changed_rows(None) == 0
@@ -0,0 +1,116 @@
+# =================== tests/test_model_router.py ===================
+# 模型路由器斷路器：讀取狀態不改變斷路器，half_open 只放行一個試探呼叫，
+# 斷路器全部開啟時仍回報為已配置
+
+import threading
+
+import pytest
+
+from model_router import (
+    ModelRouter, AllModelsUnavailableError, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN, CIRCUIT_CLOSED
+)
+
+class _Registry:
+    def is_available(self, model_name):
+        return True
+
+    def record_result(self, model_name, success, latency_ms=None, error=None):
+        pass
+
+    def mark_unavailable(self, model_name, error=None):
+        pass
+
+class _Response:
+    def __init__(self, text):
+        self.text = text
+
+class _Client:
+    """以 Event 控制回應時間，用來讓試探呼叫停在進行中"""
+
+    def __init__(self, release=None, error=None):
+        self.release = release
+        self.error = error
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return _Response('ok')
+
+def _router(clients):
+    router = ModelRouter(list(clients), registry=_Registry())
+    router._configured = True
+    router._clients = dict(clients)
+    return router
+
+def _open_with_elapsed_cooldown(router, name):
+    health = router._health[name]
+    health.state = CIRCUIT_OPEN
+    health.opened_at = 0.0
+    return health
+
+def test_reading_state_does_not_transition_breaker():
+    router = _router({'m1': _Client()})
+    health = _open_with_elapsed_cooldown(router, 'm1')
+
+    assert router.is_configured()
+    assert router.primary_model_name() == 'm1'
+    router.get_backup_models()
+    stats = router.get_stats()
+
+    assert health.state == CIRCUIT_OPEN
+    assert stats['models']['m1']['state'] == CIRCUIT_HALF_OPEN
+
+def test_half_open_allows_a_single_concurrent_trial():
+    release = threading.Event()
+    client = _Client(release=release)
+    router = _router({'m1': client})
+    _open_with_elapsed_cooldown(router, 'm1')
+
+    results = []
+    def call():
+        try:
+            results.append(router.generate('q')[1])
+        except AllModelsUnavailableError:
+            results.append(None)
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    # 只有一個請求取得試探呼叫，其餘在呼叫模型前就被拒絕
+    for thread in threads:
+        thread.join(0.5)
+    assert client.calls == 1
+    assert router.get_routable_models() == []
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results.count('m1') == 1
+    assert results.count(None) == 4
+    assert router._health['m1'].state == CIRCUIT_CLOSED
+
+def test_all_circuits_open_is_reported_separately_from_configuration():
+    router = _router({'m1': _Client(), 'm2': _Client()})
+    for health in router._health.values():
+        health.state = CIRCUIT_OPEN
+        health.opened_at = 9e18
+
+    assert router.is_configured()
+    assert router.get_circuit_summary()['all_open']
+    with pytest.raises(AllModelsUnavailableError):
+        router.generate('q')
+
+def test_failed_trial_reopens_breaker():
+    router = _router({'m1': _Client(error=Exception('503 unavailable'))})
+    health = _open_with_elapsed_cooldown(router, 'm1')
+
+    with pytest.raises(AllModelsUnavailableError):
+        router.generate('q')
+
+    assert health.state == CIRCUIT_OPEN
+    assert not health.trial_in_progress
+    assert router.get_routable_models() == []
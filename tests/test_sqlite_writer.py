@@ -0,0 +1,37 @@
+# =================== tests/test_sqlite_writer.py ===================
+# SQLite 寫入鎖：多個執行緒同時以交易讀取後寫入，不會出現 "database is locked" 或遺失更新
+
+import threading
+
+from models import db, DataVersion
+
+def test_concurrent_read_modify_write_transactions_are_serialized(sqlite_db):
+    DataVersion.create(name='counter', version=0)
+    errors = []
+
+    def worker():
+        try:
+            with db.connection_context():
+                for _ in range(20):
+                    with db.atomic():
+                        current = DataVersion.get_by_id('counter').version
+                        DataVersion.update(version=current + 1).where(DataVersion.name == 'counter').execute()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert DataVersion.get_by_id('counter').version == 160
+
+def test_single_statement_writes_outside_transactions_take_writer_lock(sqlite_db):
+    writes = db.writer_stats['writes']
+
+    DataVersion.bump('single')
+
+    assert db.writer_stats['writes'] > writes
+    assert not db._writer_lock._is_owned()
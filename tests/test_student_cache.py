@@ -0,0 +1,47 @@
+# =================== tests/test_student_cache.py ===================
+# 學生快取跨主機失效：不同版本檔（模擬不同主機）的快取透過資料庫版本表失效
+
+import datetime
+
+from models import Student, StudentCacheVersion
+from student_cache import StudentCache, VersionCounters
+
+def _cache(tmp_path, host):
+    return StudentCache(versions=VersionCounters(path=str(tmp_path / f'versions-{host}')), sync_seconds=0)
+
+def _create_student():
+    student = Student.create(line_user_id='U_cache', name='Alice', student_id='A000001',
+                             registration_step=0, last_activity=datetime.datetime.now())
+    # Student.save 也會發布版本，測試從沒有版本列開始
+    StudentCacheVersion.delete().execute()
+    return student
+
+def test_write_on_other_host_invalidates_cached_student(sqlite_db, tmp_path):
+    student = _create_student()
+    host_a, host_b = _cache(tmp_path, 'a'), _cache(tmp_path, 'b')
+
+    assert host_a.get_student('U_cache').name == 'Alice'
+
+    Student.update(name='Bob').where(Student.id == student.id).execute()
+    host_b.write_through(student=Student.get_by_id(student.id))
+
+    assert host_a.get_student('U_cache').name == 'Bob'
+    assert host_a.get_metrics()['remote_invalidations'] == 1
+
+def test_own_writes_do_not_drop_local_entries(sqlite_db, tmp_path):
+    student = _create_student()
+    cache = _cache(tmp_path, 'a')
+
+    cache.get_student('U_cache')
+    cache.write_through(student=student, context={'conversation_flow': [], 'recent_topics': []})
+    cache.get_student('U_cache')
+
+    metrics = cache.get_metrics()
+    assert metrics['remote_invalidations'] == 0
+    assert metrics['student_hit_rate'] == 50.0
+    assert cache.get_context(student.id) is not None
+
+def test_student_cache_version_bump_is_monotonic(sqlite_db):
+    assert StudentCacheVersion.bump(42) == 1
+    assert StudentCacheVersion.bump(42) == 2
+    assert StudentCacheVersion.changed_since(datetime.datetime.now() - datetime.timedelta(minutes=1)) == {42: 2}
@@ -0,0 +1,41 @@
+# =================== tests/test_student_counters.py ===================
+# 學生計數修正：修復漂移的計數、遞增資料版本，並略過最近仍有新訊息的學生
+
+import datetime
+
+from models import Student, Message, DataVersion, reconcile_student_counters
+
+def _student_with_messages(line_user_id, count, minutes_ago):
+    student = Student.create(line_user_id=line_user_id, name=line_user_id, student_id='A000001',
+                             registration_step=0, last_activity=datetime.datetime.now())
+    timestamp = datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)
+    for i in range(count):
+        Message.create(student=student, content=f"q{i}", timestamp=timestamp,
+                       message_type='question', source_type='line')
+    return student
+
+def _students_version():
+    version = DataVersion.get_or_none(DataVersion.name == 'students')
+    return version.version if version else 0
+
+def test_reconcile_fixes_drifted_counters_and_bumps_version(sqlite_db):
+    student = _student_with_messages('U_drift', 3, minutes_ago=60)
+    Student.update(message_count=10, total_questions=0).where(Student.id == student.id).execute()
+    version = _students_version()
+
+    assert reconcile_student_counters() == 1
+
+    fixed = Student.get_by_id(student.id)
+    assert (fixed.message_count, fixed.total_questions) == (3, 3)
+    assert _students_version() > version
+    # 已一致時不再更新，也不遞增版本
+    version = _students_version()
+    assert reconcile_student_counters() == 0
+    assert _students_version() == version
+
+def test_reconcile_skips_students_with_recent_messages(sqlite_db):
+    student = _student_with_messages('U_active', 2, minutes_ago=0)
+    Student.update(message_count=10).where(Student.id == student.id).execute()
+
+    assert reconcile_student_counters() == 0
+    assert Student.get_by_id(student.id).message_count == 10
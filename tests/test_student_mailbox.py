@@ -0,0 +1,46 @@
+# =================== tests/test_student_mailbox.py ===================
+# 學生信箱：同一學生的工作依序且不重疊地執行，不同學生平行處理
+
+import time
+import threading
+
+from student_mailbox import StudentMailboxExecutor
+
+def test_tasks_run_in_order_without_overlap_per_key():
+    executor = StudentMailboxExecutor(max_workers=4, batch_limit=2)
+    results = {'a': [], 'b': []}
+    active = {'a': 0, 'b': 0}
+    overlaps = []
+    lock = threading.Lock()
+
+    def task(key, index):
+        with lock:
+            active[key] += 1
+            if active[key] > 1:
+                overlaps.append((key, index))
+        time.sleep(0.001)
+        results[key].append(index)
+        with lock:
+            active[key] -= 1
+
+    for index in range(20):
+        executor.submit('a', task, 'a', index)
+        executor.submit('b', task, 'b', index)
+    executor.shutdown(wait=True)
+
+    assert results == {'a': list(range(20)), 'b': list(range(20))}
+    assert overlaps == []
+
+def test_failing_task_does_not_block_mailbox():
+    executor = StudentMailboxExecutor(max_workers=2)
+    results = []
+
+    def fail():
+        raise RuntimeError('boom')
+
+    executor.submit('a', fail)
+    executor.submit('a', results.append, 'after')
+    executor.shutdown(wait=True)
+
+    assert results == ['after']
+    assert executor.get_metrics()['active_mailboxes'] == 0
@@ -0,0 +1,75 @@
+# =================== tests/test_topic_backfill.py ===================
+# 主題回填工作：以 SQLite 暫存資料庫與離線 stub 後端執行，涵蓋批次失敗後的續跑
+
+import datetime
+
+from models import Student, Message, MessageTopic, get_data_watermark
+from topic_backfill import TopicBackfillJob, StubTopicBackend
+
+class FlakyStubBackend(StubTopicBackend):
+    """第一次遇到指定訊息所在的批次時丟出例外，其餘批次交給 stub 後端"""
+
+    def __init__(self, failing_id):
+        self.failing_id = failing_id
+        self.failed = False
+
+    def tag_batch(self, messages):
+        if not self.failed and any(message_id == self.failing_id for message_id, _ in messages):
+            self.failed = True
+            raise RuntimeError("模擬的 API 錯誤")
+        return super().tag_batch(messages)
+
+def _create_messages(count):
+    student = Student.create(line_user_id='U_backfill', name='Backfill', student_id='A000001',
+                             registration_step=0, last_activity=datetime.datetime.now())
+    return [
+        Message.create(student=student, content=f"What is machine learning? #{i}",
+                       message_type='question', source_type='line').id
+        for i in range(count)
+    ]
+
+def _untagged_ids():
+    query = (Message.select(Message.id)
+             .where(Message.topic_tags.is_null() | (Message.topic_tags == ''))
+             .order_by(Message.id))
+    return [message.id for message in query]
+
+def test_stub_backfill_tags_all_messages(sqlite_db, tmp_path):
+    message_ids = _create_messages(5)
+    watermark = get_data_watermark()
+    job = TopicBackfillJob(StubTopicBackend(), batch_size=2, concurrency=1,
+                           checkpoint_path=str(tmp_path / 'checkpoint.json'))
+
+    stats = job.run()
+
+    assert stats['tagged'] == 5
+    assert stats['last_id'] == message_ids[-1]
+    assert job.load_checkpoint() == message_ids[-1]
+    assert _untagged_ids() == []
+    assert MessageTopic.select().where(MessageTopic.message.in_(message_ids)).count() == 5
+    # 主題變更不推進訊息ID，資料水位要靠版本遞增改變
+    assert get_data_watermark()[1] > watermark[1]
+
+def test_failed_batch_is_retried_on_resume(sqlite_db, tmp_path):
+    message_ids = _create_messages(6)
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+
+    # 批次為 [1,2] [3,4] [5,6]，中間的批次失敗
+    first = TopicBackfillJob(FlakyStubBackend(failing_id=message_ids[2]), batch_size=2,
+                             concurrency=2, checkpoint_path=checkpoint_path)
+    stats = first.run()
+
+    assert stats['failed_batches'] == 1
+    assert stats['tagged'] == 4
+    # 進度停在失敗批次之前，而不是掃描到的最後一則
+    assert first.load_checkpoint() == message_ids[1]
+    assert _untagged_ids() == message_ids[2:4]
+
+    resumed = TopicBackfillJob(StubTopicBackend(), batch_size=2, concurrency=2,
+                               checkpoint_path=checkpoint_path)
+    stats = resumed.run()
+
+    assert stats['scanned'] == 2
+    assert stats['tagged'] == 2
+    assert resumed.load_checkpoint() == message_ids[3]
+    assert _untagged_ids() == []
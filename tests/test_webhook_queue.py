@@ -0,0 +1,67 @@
+# =================== tests/test_webhook_queue.py ===================
+# Webhook 工作佇列：每位學生一次只認領最舊的工作，逾時工作重新排入或達上限後標記失敗
+
+import datetime
+
+from models import WebhookJob
+from webhook_queue import WebhookJobQueue
+
+def _event(event_id, user_id):
+    return {'webhookEventId': event_id, 'type': 'message', 'source': {'userId': user_id}}
+
+def _job(event_id):
+    return WebhookJob.get(WebhookJob.event_id == event_id)
+
+def test_claim_takes_oldest_pending_job_per_user(sqlite_db):
+    queue = WebhookJobQueue(num_workers=4)
+    queue.enqueue([_event('e1', 'U1'), _event('e2', 'U1'), _event('e3', 'U2')])
+
+    claimed = queue._claim_jobs(10)
+    assert [job.event_id for job in claimed] == ['e1', 'e3']
+    # U1 仍有處理中的工作，後面的工作不會被認領
+    assert queue._claim_jobs(10) == []
+
+    first = claimed[0]
+    assert queue._start_job(first)
+    queue._mark_done(first)
+
+    assert [job.event_id for job in queue._claim_jobs(10)] == ['e2']
+
+def test_failed_job_blocks_later_jobs_until_retried(sqlite_db):
+    queue = WebhookJobQueue(num_workers=4, max_attempts=2)
+    queue.enqueue([_event('e1', 'U1'), _event('e2', 'U1')])
+
+    job = queue._claim_jobs(10)[0]
+    queue._start_job(job)
+    queue._mark_failed(job, Exception('boom'))
+
+    # 失敗待重試的工作仍是最舊的一個，重新認領的是它而不是 e2
+    assert [job.event_id for job in queue._claim_jobs(10)] == ['e1']
+
+def test_requeue_stale_jobs_respects_max_attempts(sqlite_db):
+    queue = WebhookJobQueue(num_workers=4)
+    queue.enqueue([_event('e1', 'U1'), _event('e2', 'U2')])
+    first, second = queue._claim_jobs(10)
+    queue._start_job(second)
+
+    old = datetime.datetime.now() - datetime.timedelta(minutes=10)
+    # e1 已認領但一直沒有開始；e2 已開始且嘗試次數達上限
+    WebhookJob.update(claimed_at=old).where(WebhookJob.id == first.id).execute()
+    WebhookJob.update(started_at=old, attempts=3).where(WebhookJob.id == second.id).execute()
+
+    assert WebhookJob.requeue_stale_jobs(stale_seconds=300, max_attempts=3) == 1
+    assert _job('e1').status == WebhookJob.STATUS_PENDING
+    assert _job('e2').status == WebhookJob.STATUS_FAILED
+
+def test_requeued_job_is_not_started_by_the_old_claim(sqlite_db):
+    queue = WebhookJobQueue(num_workers=4)
+    queue.enqueue([_event('e1', 'U1')])
+    stale_claim = queue._claim_jobs(10)[0]
+
+    old = datetime.datetime.now() - datetime.timedelta(minutes=10)
+    WebhookJob.update(claimed_at=old).where(WebhookJob.id == stale_claim.id).execute()
+    WebhookJob.requeue_stale_jobs(stale_seconds=300)
+    fresh_claim = queue._claim_jobs(10)[0]
+
+    assert not queue._start_job(stale_claim)
+    assert queue._start_job(fresh_claim)
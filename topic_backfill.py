@@ -0,0 +1,304 @@
+# =================== topic_backfill.py ===================
+# EMI智能教學助理系統 - 歷史訊息主題標籤批次回填
+# 歷史 Message 大多沒有 topic_tags，逐則呼叫 AI 既慢又耗配額；
+# 這個工作把多則未標記訊息合併成一個結構化（JSON）Gemini 請求，
+# 解析每則訊息的標籤後分塊批次更新，並以訊息ID記錄進度，可中斷後續跑；
+# 進度只推進到第一個失敗批次之前，續跑時會重試失敗的訊息
+#
+# 用法：
+#   python topic_backfill.py                      # 使用 Gemini
+#   python topic_backfill.py --backend stub       # 離線（關鍵詞備用方法），測試用
+#   python topic_backfill.py --concurrency 4 --batch-size 30 --limit 1000
+#   python topic_backfill.py --restart            # 忽略進度檔，從頭掃描未標記訊息
+
+import os
+import re
+import json
+import time
+import logging
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from peewee import Case
+
+from models import db, Message, MessageTopic, DataVersion
+
+logger = logging.getLogger(__name__)
+
+# =================== 回填配置 ===================
+
+TOPIC_BACKFILL_BATCH_SIZE = int(os.getenv('TOPIC_BACKFILL_BATCH_SIZE', 20))
+TOPIC_BACKFILL_CONCURRENCY = int(os.getenv('TOPIC_BACKFILL_CONCURRENCY', 2))
+TOPIC_BACKFILL_CHUNK_SIZE = int(os.getenv('TOPIC_BACKFILL_CHUNK_SIZE', 200))
+TOPIC_BACKFILL_CHECKPOINT = os.getenv('TOPIC_BACKFILL_CHECKPOINT', 'topic_backfill_checkpoint.json')
+
+# 每則訊息送進提示詞的最大字元數
+MAX_MESSAGE_CHARS = 300
+MAX_TOPICS_PER_MESSAGE = 5
+
+# =================== 標記後端 ===================
+
+class GeminiTopicBackend:
+    """把一批訊息合併成單一 JSON 請求交給共用的模型路由器"""
+
+    name = 'gemini'
+
+    def __init__(self):
+        from model_router import background_router
+        self.router = background_router
+        if not self.router.is_configured() and not self.router.configure():
+            raise RuntimeError("GEMINI_API_KEY 未設定，無法使用 Gemini 後端")
+
+    def tag_batch(self, messages):
+        """回傳 {message_id: [topic, ...]}"""
+        import google.generativeai as genai
+
+        items = [
+            {'id': message_id, 'text': text[:MAX_MESSAGE_CHARS]}
+            for message_id, text in messages
+        ]
+        prompt = f"""For each conversation item below, extract 1-{MAX_TOPICS_PER_MESSAGE} topic keywords in Traditional Chinese.
+Return only a JSON object mapping each item id (as a string) to an array of keywords, no explanations.
+
+Items:
+{json.dumps(items, ensure_ascii=False)}"""
+
+        generation_config = genai.types.GenerationConfig(
+            temperature=0.2,
+            response_mime_type='application/json'
+        )
+        response_text, _ = self.router.generate(prompt, generation_config=generation_config)
+        return parse_batch_response(response_text, [message_id for message_id, _ in messages])
+
+class StubTopicBackend:
+    """離線後端：使用 Message._extract_topics_fallback，不需要網路或 API 金鑰"""
+
+    name = 'stub'
+
+    def tag_batch(self, messages):
+        return {
+            message_id: Message._extract_topics_fallback(text)
+            for message_id, text in messages
+        }
+
+def parse_batch_response(response_text, expected_ids):
+    """
+    解析批次回應：接受 {"id": [...]} 或 [{"id": ..., "topics": [...]}]，
+    容忍 ```json 程式碼區塊；不在這批中的ID與不合理的標籤都會被忽略
+    """
+    text = (response_text or '').strip()
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", '', text)
+
+    try:
+        data = json.loads(text)
+    except ValueError:
+        # 回應前後夾雜文字時，取出第一個 JSON 物件或陣列
+        match = re.search(r"(\{.*\}|\[.*\])", text, re.DOTALL)
+        if not match:
+            raise ValueError("回應中沒有 JSON")
+        data = json.loads(match.group(1))
+
+    if isinstance(data, list):
+        data = {str(item.get('id')): item.get('topics') or item.get('tags') or []
+                for item in data if isinstance(item, dict)}
+
+    expected = {str(message_id): message_id for message_id in expected_ids}
+    results = {}
+    for key, topics in (data or {}).items():
+        message_id = expected.get(str(key))
+        if message_id is None:
+            continue
+        if isinstance(topics, str):
+            topics = topics.split(',')
+        cleaned = []
+        for topic in topics or []:
+            topic = str(topic).strip()
+            if 1 < len(topic) < 20 and topic not in cleaned:
+                cleaned.append(topic)
+        results[message_id] = cleaned[:MAX_TOPICS_PER_MESSAGE]
+
+    return results
+
+# =================== 回填工作 ===================
+
+class TopicBackfillJob:
+    """分頁讀取未標記訊息 → 平行送出批次請求 → 分塊批次更新 → 寫入進度檔"""
+
+    def __init__(self, backend, batch_size=TOPIC_BACKFILL_BATCH_SIZE,
+                 concurrency=TOPIC_BACKFILL_CONCURRENCY, chunk_size=TOPIC_BACKFILL_CHUNK_SIZE,
+                 checkpoint_path=TOPIC_BACKFILL_CHECKPOINT, limit=None):
+        self.backend = backend
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.chunk_size = max(1, chunk_size)
+        self.checkpoint_path = checkpoint_path
+        self.limit = limit
+        self._stats_lock = threading.Lock()
+
+        self.stats = {
+            'scanned': 0,
+            'tagged': 0,
+            'empty': 0,
+            'failed_batches': 0,
+            'requests': 0
+        }
+
+    # =================== 進度檔 ===================
+
+    def load_checkpoint(self):
+        """讀取上次處理到的訊息ID"""
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('last_id', 0)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.warning(f"⚠️ 進度檔讀取失敗，從頭開始: {e}")
+            return 0
+
+    def save_checkpoint(self, last_id):
+        """以暫存檔加原子替換寫入進度"""
+        data = dict(self.stats, last_id=last_id, backend=self.backend.name,
+                    updated_at=datetime.datetime.now().isoformat())
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # =================== 執行 ===================
+
+    def _fetch_page(self, after_id, page_size):
+        """取得 ID 大於 after_id 的未標記訊息"""
+        query = (Message
+                 .select(Message.id, Message.content, Message.ai_response)
+                 .where(
+                     Message.id > after_id,
+                     (Message.topic_tags.is_null()) | (Message.topic_tags == '')
+                 )
+                 .order_by(Message.id)
+                 .limit(page_size))
+        return [
+            (row.id, f"{row.content or ''} {row.ai_response or ''}".strip())
+            for row in query
+        ]
+
+    def _tag_batch(self, batch):
+        """在工作執行緒中標記一批訊息；失敗時回傳 None，訊息保持未標記"""
+        try:
+            with self._stats_lock:
+                self.stats['requests'] += 1
+            return self.backend.tag_batch(batch)
+        except Exception as e:
+            with self._stats_lock:
+                self.stats['failed_batches'] += 1
+            logger.error(f"❌ 批次標記失敗 (ID {batch[0][0]}-{batch[-1][0]}): {e}")
+            return None
+
+    def _bulk_update(self, results):
+        """以 CASE 表達式分塊批次更新 topic_tags，並寫入主題索引表"""
+        rows = [(message_id, topics) for message_id, topics in results.items() if topics]
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = rows[start:start + self.chunk_size]
+            with db.atomic():
+                Message.update(
+                    topic_tags=Case(Message.id, [(message_id, ', '.join(topics)) for message_id, topics in chunk])
+                ).where(Message.id.in_([message_id for message_id, _ in chunk])).execute()
+                MessageTopic.link(dict(chunk))
+                # 主題變更不會推進訊息ID水位，遞增版本讓快取的頁面失效
+                DataVersion.bump('messages')
+        return len(rows)
+
+    def run(self, restart=False):
+        """
+        執行回填，回傳統計資料
+        掃描游標 last_id 持續往後推進；進度檔的 checkpoint_id 只推進到連續成功的批次為止，
+        一旦有批次失敗就停在該批次之前（之後成功標記的訊息續跑時會被未標記條件略過）
+        """
+        last_id = checkpoint_id = 0 if restart else self.load_checkpoint()
+        failed = False
+        page_size = self.batch_size * self.concurrency
+        started = time.time()
+
+        logger.info(f"🏷️ 主題回填開始 (後端: {self.backend.name}, 起始ID: {last_id}, "
+                    f"批次: {self.batch_size}, 並行: {self.concurrency})")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='topic-backfill') as pool:
+            while True:
+                if self.limit:
+                    remaining = self.limit - self.stats['scanned']
+                    if remaining <= 0:
+                        break
+                    page_size = min(page_size, remaining)
+
+                page = self._fetch_page(last_id, page_size)
+                if not page:
+                    break
+
+                batches = [page[i:i + self.batch_size] for i in range(0, len(page), self.batch_size)]
+                results = {}
+                for batch, batch_result in zip(batches, pool.map(self._tag_batch, batches)):
+                    if batch_result is None:
+                        failed = True
+                        continue
+                    results.update(batch_result)
+                    if not failed:
+                        checkpoint_id = batch[-1][0]
+
+                updated = self._bulk_update(results)
+                self.stats['scanned'] += len(page)
+                self.stats['tagged'] += updated
+                self.stats['empty'] += len(page) - updated
+
+                last_id = page[-1][0]
+                self.save_checkpoint(checkpoint_id)
+                logger.info(f"🏷️ 已處理到訊息 {last_id}（進度 {checkpoint_id}）：本頁標記 {updated}/{len(page)} 則")
+
+        self.stats['elapsed_seconds'] = round(time.time() - started, 1)
+        self.stats['last_id'] = checkpoint_id
+        logger.info(f"✅ 主題回填完成: {self.stats}")
+        return self.stats
+
+# =================== 便利函數 ===================
+
+def run_topic_backfill(backend='gemini', restart=False, **options):
+    """建立後端並執行回填"""
+    backend_instance = StubTopicBackend() if backend == 'stub' else GeminiTopicBackend()
+    with db.connection_context():
+        return TopicBackfillJob(backend_instance, **options).run(restart=restart)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批次回填歷史訊息的主題標籤')
+    parser.add_argument('--backend', choices=['gemini', 'stub'], default='gemini')
+    parser.add_argument('--batch-size', type=int, default=TOPIC_BACKFILL_BATCH_SIZE, help='每個 AI 請求包含的訊息數')
+    parser.add_argument('--concurrency', type=int, default=TOPIC_BACKFILL_CONCURRENCY, help='同時進行的請求數')
+    parser.add_argument('--chunk-size', type=int, default=TOPIC_BACKFILL_CHUNK_SIZE, help='每個更新交易的列數')
+    parser.add_argument('--checkpoint', default=TOPIC_BACKFILL_CHECKPOINT, help='進度檔路徑')
+    parser.add_argument('--limit', type=int, default=None, help='最多處理的訊息數')
+    parser.add_argument('--restart', action='store_true', help='忽略進度檔，從頭開始')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    stats = run_topic_backfill(
+        backend=args.backend,
+        restart=args.restart,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        chunk_size=args.chunk_size,
+        checkpoint_path=args.checkpoint,
+        limit=args.limit
+    )
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+__all__ = [
+    'TopicBackfillJob',
+    'GeminiTopicBackend',
+    'StubTopicBackend',
+    'parse_batch_response',
+    'run_topic_backfill'
+]
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# =================== topic_tagger.py ===================
+# EMI智能教學助理系統 - 回覆後的非同步主題標記
+# 原本每次 get_conversation_context 都呼叫 _generate_topics_with_ai，
+# 在產生回答之前多打一次 Gemini；改為回覆送出後由背景執行緒標記該則訊息，
+# 結果寫入 Message.topic_tags 與主題索引表（MessageTopic），建立上下文時直接讀取已儲存的標籤
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from models import db, Message, MessageTopic, DataVersion
+from conversation_memory import merge_memory_topics
+
+logger = logging.getLogger(__name__)
+
+# =================== 標記器配置 ===================
+
+TOPIC_TAGGER_WORKERS = int(os.getenv('TOPIC_TAGGER_WORKERS', 2))
+
+# =================== 主題標記器 ===================
+
+class TopicTagger:
+    """在背景執行緒中為新訊息產生主題標籤（每個 gunicorn worker 各自一組執行緒）"""
+
+    def __init__(self, max_workers=TOPIC_TAGGER_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        # 統計資料（僅限本行程）
+        self._pending = 0
+        self._tagged = 0
+        self._fallback = 0
+        self._failed = 0
+
+    def _get_executor(self):
+        """取得本行程的執行緒池（分叉後重新建立）"""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='topic-tagger'
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, message_id):
+        """排入一則訊息的主題標記工作"""
+        try:
+            with self._lock:
+                self._pending += 1
+            self._get_executor().submit(self._tag_message, message_id)
+            return True
+        except Exception as e:
+            with self._lock:
+                self._pending -= 1
+            logger.error(f"❌ 排入主題標記失敗: {e}")
+            return False
+
+    def _tag_message(self, message_id):
+        """產生並寫入單一訊息的主題標籤"""
+        try:
+            with db.connection_context():
+                message = Message.get_or_none(Message.id == message_id)
+                if message is None or message.topic_tags:
+                    return
+
+                content = [message.content or '']
+                if message.ai_response:
+                    content.append(message.ai_response)
+
+                topics = Message._generate_topics_with_ai(content)
+                if not topics:
+                    topics = Message._extract_topics_fallback(' '.join(content))
+                    self._fallback += 1
+
+                if topics:
+                    # 與 add_topic_tags 相同，併入交易內讀到的現有標籤而不是覆蓋，
+                    # 顯示用的 topic_tags 與只會新增對應的主題索引表保持一致
+                    with db.atomic():
+                        linked = MessageTopic.link({message_id: topics}).get(message_id, [])
+                        current = Message.select(Message.topic_tags).where(Message.id == message_id).scalar() or ''
+                        existing = [tag.strip() for tag in current.split(',') if tag.strip()]
+                        combined = existing + [tag for tag in linked if tag not in existing]
+                        if combined != existing:
+                            Message.update(topic_tags=', '.join(combined)).where(Message.id == message_id).execute()
+                            # 主題變更不會推進訊息ID水位，遞增版本讓快取的頁面失效
+                            DataVersion.bump('messages')
+                    merge_memory_topics(message.student_id, topics)
+                    logger.debug(f"🏷️ 訊息 {message_id} 主題標籤: {topics}")
+
+                self._tagged += 1
+
+        except Exception as e:
+            self._failed += 1
+            logger.error(f"❌ 訊息 {message_id} 主題標記失敗: {e}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def shutdown(self, wait=True):
+        """停止本行程的執行緒池"""
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+        if executor:
+            executor.shutdown(wait=wait)
+
+    def get_metrics(self):
+        """取得標記統計"""
+        return {
+            'workers': self.max_workers,
+            'pending': self._pending,
+            'tagged': self._tagged,
+            'fallback_used': self._fallback,
+            'failed': self._failed
+        }
+
+# =================== 模組層級實例 ===================
+
+topic_tagger = TopicTagger()
+
+def schedule_topic_tagging(message_id):
+    """回覆送出後排入主題標記"""
+    return topic_tagger.submit(message_id)
+
+def stop_topic_tagger(wait=True):
+    """停止主題標記執行緒"""
+    topic_tagger.shutdown(wait=wait)
+
+def get_topic_tagger_metrics():
+    """取得主題標記統計"""
+    return topic_tagger.get_metrics()
+
+__all__ = [
+    'TopicTagger',
+    'topic_tagger',
+    'schedule_topic_tagging',
+    'stop_topic_tagger',
+    'get_topic_tagger_metrics'
+]
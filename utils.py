@@ -11,6 +11,8 @@ from typing import Dict, List, Optional, Tuple, Any
 from collections import Counter
 import google.generativeai as genai
 
+from model_router import background_router, BACKGROUND_MODEL_PRIORITY
+
 # 設定日誌
 logger = logging.getLogger(__name__)
 
@@ -19,78 +21,35 @@ logger = logging.getLogger(__name__)
 # 取得 API 金鑰
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
-# 🔧 **修正：更新至2025年6月最新 Gemini 模型優先順序**
-# 基於Google官方2025年6月發布的模型資訊，按照性能、穩定性、成本效率排序
-AVAILABLE_MODELS = [
-    # === 2025年最新穩定版本（正式發布）===
-    "gemini-2.5-flash",              # 🥇 首選：2025年6月GA，最佳性價比，支援thinking
-    "gemini-2.5-pro",                # 🥇 高級：2025年6月GA，最智能模型，適合複雜任務
-    
-    # === 2025年預覽版本（功能測試）===
-    "gemini-2.5-flash-lite",         # 💰 經濟：2025年6月預覽，最經濟高效，高吞吐量
-    
-    # === 2.0系列（穩定可靠）===
-    "gemini-2.0-flash",              # 🔄 備用：2025年2月GA，多模態支援
-    "gemini-2.0-flash-lite",         # 🔄 輕量：成本優化版本
-    "gemini-2.0-pro-experimental",   # 🧪 實驗：最佳編碼性能（實驗版）
-    
-    # === 1.5系列（舊版，2025年4月後新專案不可用）===
-    "gemini-1.5-flash",              # 📦 舊版：僅限已有使用記錄的專案
-    "gemini-1.5-pro",                # 📦 舊版：僅限已有使用記錄的專案
-    
-    # === 最後備案 ===
-    "gemini-pro"                     # 📦 最後備案：舊版相容性
-]
+# 🔧 **修正：模型清單、用戶端與使用統計統一由 model_router 管理**
+# 工具函數（分析、摘要等）使用背景路由器，與 app.py 回覆學生的路由器分開統計延遲與斷路器；
+# 候選模型即原本的完整清單（gemini-2.5-pro、gemini-2.0-flash 等都保留）
+AVAILABLE_MODELS = BACKGROUND_MODEL_PRIORITY
 
-# 當前模型配置（預設使用最新穩定版）
-current_model_name = "gemini-2.5-flash"
-model = None
-
-# 模型使用統計（增強版）
-model_usage_stats = {
-    model_name: {
-        'calls': 0, 
-        'errors': 0, 
-        'last_used': None,
-        'success_rate': 0.0,
-        'status': 'available'  # 新增：模型狀態追蹤
-    } for model_name in AVAILABLE_MODELS
-}
+# 當前模型（僅供狀態顯示，實際呼叫時由路由器挑選）
+current_model_name = BACKGROUND_MODEL_PRIORITY[0]
 
 # 🔧 **修正：改進的AI模型初始化**
 def initialize_ai_model():
-    """初始化AI模型（修正版：更智能的模型選擇）"""
-    global model, current_model_name
+    """初始化AI模型（設定共用路由器，不在啟動時呼叫 generate_content 探測）"""
+    global current_model_name
     
     if not GEMINI_API_KEY:
         logger.warning("⚠️ GEMINI_API_KEY 未設定")
         return False
     
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
+        if not background_router.configure(GEMINI_API_KEY):
+            return False
         
-        # 依照優先順序嘗試初始化模型
-        for model_name in AVAILABLE_MODELS:
-            try:
-                logger.info(f"🔄 嘗試初始化模型: {model_name}")
-                test_model = genai.GenerativeModel(model_name)
-                
-                # 進行簡單測試
-                test_response = test_model.generate_content("Hello")
-                if test_response and test_response.text:
-                    model = test_model
-                    current_model_name = model_name
-                    model_usage_stats[model_name]['status'] = 'active'
-                    logger.info(f"✅ 成功初始化模型: {model_name}")
-                    return True
-                    
-            except Exception as e:
-                model_usage_stats[model_name]['status'] = 'unavailable'
-                logger.warning(f"⚠️ 模型 {model_name} 無法使用: {str(e)[:100]}")
-                continue
+        primary_model = background_router.primary_model_name()
+        if not primary_model:
+            logger.error("❌ 所有 Gemini 模型都無法使用")
+            return False
         
-        logger.error("❌ 所有 Gemini 模型都無法使用")
-        return False
+        current_model_name = primary_model
+        logger.info(f"✅ 成功初始化模型: {current_model_name}")
+        return True
         
     except Exception as e:
         logger.error(f"❌ AI模型初始化失敗: {e}")
@@ -206,7 +165,7 @@ def build_context_summary(context_messages, student):
 def generate_simple_ai_response(student_name, student_id, query):
     """生成簡化的AI回應（向後兼容函數，不與app.py衝突）"""
     try:
-        if not GEMINI_API_KEY or not model:
+        if not GEMINI_API_KEY or not background_router.is_configured():
             return get_fallback_response(query)
         
         # EMI課程專用提示詞（150字限制）
@@ -232,31 +191,20 @@ Respond with academic precision and brevity."""
             max_output_tokens=200
         )
         
-        # 調用AI
-        response = model.generate_content(prompt, generation_config=generation_config)
+        # 調用AI（路由器自動挑選最快的健康模型並記錄使用統計，全部失敗時拋出例外）
+        ai_response, model_name = background_router.generate(prompt, generation_config=generation_config)
         
-        if response and response.text:
-            ai_response = response.text.strip()
-            
-            # 記錄成功使用
-            record_model_usage(current_model_name, True)
-            
-            logger.info(f"✅ 簡化AI回應生成成功 - 學生: {student_name}")
-            
-            # 基本長度檢查
-            if len(ai_response) < 10:
-                logger.warning("⚠️ AI 回應過短，使用備用回應")
-                return get_fallback_response(query)
-            
-            return ai_response
-        else:
-            logger.error("❌ AI 回應為空")
-            record_model_usage(current_model_name, False)
+        logger.info(f"✅ 簡化AI回應生成成功 - 學生: {student_name} ({model_name})")
+        
+        # 基本長度檢查
+        if len(ai_response) < 10:
+            logger.warning("⚠️ AI 回應過短，使用備用回應")
             return get_fallback_response(query)
+        
+        return ai_response
             
     except Exception as e:
         logger.error(f"❌ 簡化AI回應生成錯誤: {e}")
-        record_model_usage(current_model_name, False)
         
         # 智慧錯誤處理
         error_msg = str(e).lower()
@@ -394,98 +342,6 @@ def get_fallback_suggestion(student, conversation_count):
 
 **Tip**: With our memory feature, you can now build on previous discussions and explore topics in greater depth!"""
 
-# =================== 模型管理（增強版） ===================
-
-def record_model_usage(model_name: str, success: bool = True):
-    """記錄模型使用統計"""
-    if model_name in model_usage_stats:
-        stats = model_usage_stats[model_name]
-        stats['calls'] += 1
-        stats['last_used'] = time.time()
-        if not success:
-            stats['errors'] += 1
-        
-        # 計算成功率
-        if stats['calls'] > 0:
-            stats['success_rate'] = ((stats['calls'] - stats['errors']) / stats['calls']) * 100
-
-def switch_to_available_model():
-    """切換到可用模型（增強版）"""
-    global model, current_model_name
-    
-    if not GEMINI_API_KEY:
-        return False
-    
-    # 嘗試切換到下一個可用模型
-    current_index = AVAILABLE_MODELS.index(current_model_name) if current_model_name in AVAILABLE_MODELS else 0
-    
-    for i in range(1, len(AVAILABLE_MODELS)):
-        next_index = (current_index + i) % len(AVAILABLE_MODELS)
-        next_model_name = AVAILABLE_MODELS[next_index]
-        
-        try:
-            logger.info(f"🔄 嘗試切換到模型: {next_model_name}")
-            new_model = genai.GenerativeModel(next_model_name)
-            
-            # 簡單測試
-            test_response = new_model.generate_content("Test")
-            if test_response and test_response.text:
-                model = new_model
-                current_model_name = next_model_name
-                model_usage_stats[next_model_name]['status'] = 'active'
-                logger.info(f"✅ 成功切換到模型: {current_model_name}")
-                return True
-                
-        except Exception as e:
-            model_usage_stats[next_model_name]['status'] = 'unavailable'
-            logger.warning(f"⚠️ 模型 {next_model_name} 切換失敗: {e}")
-            continue
-    
-    logger.error("❌ 所有模型都無法使用")
-    return False
-
-def test_ai_connection():
-    """測試AI連接（增強版）"""
-    try:
-        if not GEMINI_API_KEY:
-            return False, "API 金鑰未設定"
-        
-        if not model:
-            return False, "AI 模型未初始化"
-        
-        # 簡單連接測試
-        test_response = model.generate_content("Hello")
-        if test_response and test_response.text:
-            return True, f"連接正常 - 當前模型: {current_model_name}"
-        else:
-            return False, "AI 回應測試失敗"
-            
-    except Exception as e:
-        return False, f"連接錯誤: {str(e)[:50]}..."
-
-def get_quota_status():
-    """取得配額狀態（增強版）"""
-    status = {
-        'current_model': current_model_name,
-        'models': {},
-        'total_calls': 0,
-        'total_errors': 0,
-        'ai_initialized': ai_initialized
-    }
-    
-    for model_name, stats in model_usage_stats.items():
-        status['models'][model_name] = {
-            'calls': stats['calls'],
-            'errors': stats['errors'],
-            'success_rate': round(stats['success_rate'], 1),
-            'status': stats.get('status', 'unknown'),
-            'health': '正常' if stats['success_rate'] > 50 or stats['calls'] == 0 else '可能有問題'
-        }
-        status['total_calls'] += stats['calls']
-        status['total_errors'] += stats['errors']
-    
-    return status
-
 # =================== utils.py 修正版 - 第1段結束 ===================
 
 # =================== utils.py 修正版 - 第2段開始 ===================
@@ -523,57 +379,27 @@ def get_ai_response(message_text, student_name="Student", student_id="Unknown"):
 # =================== 模型管理（修正版）===================
 
 def record_model_usage(model_name: str, success: bool = True):
-    """記錄模型使用統計（修正版）"""
-    if model_name in model_usage_stats:
-        stats = model_usage_stats[model_name]
-        stats['calls'] += 1
-        stats['last_used'] = time.time()
-        if not success:
-            stats['errors'] += 1
-        
-        # 計算成功率
-        if stats['calls'] > 0:
-            stats['success_rate'] = ((stats['calls'] - stats['errors']) / stats['calls']) * 100
+    """記錄模型使用統計（修正版：統計由路由器在每次呼叫時自動記錄，保留供相容）"""
+    logger.debug(f"模型使用紀錄由路由器管理: {model_name} ({'成功' if success else '失敗'})")
 
 def switch_to_available_model():
-    """切換到可用模型（修正版）"""
-    global model, current_model_name, ai_initialized
+    """切換到可用模型（修正版：由路由器依斷路器狀態挑選，不再呼叫 generate_content 探測）"""
+    global current_model_name, ai_initialized
     
     if not GEMINI_API_KEY:
         logger.warning("⚠️ 無法切換模型：API金鑰未設定")
         return False
     
-    # 嘗試切換到下一個可用模型
-    try:
-        current_index = AVAILABLE_MODELS.index(current_model_name) if current_model_name in AVAILABLE_MODELS else 0
-    except ValueError:
-        current_index = 0
-    
-    for i in range(1, len(AVAILABLE_MODELS)):
-        next_index = (current_index + i) % len(AVAILABLE_MODELS)
-        next_model_name = AVAILABLE_MODELS[next_index]
-        
-        try:
-            logger.info(f"🔄 嘗試切換到模型: {next_model_name}")
-            genai.configure(api_key=GEMINI_API_KEY)
-            new_model = genai.GenerativeModel(next_model_name)
-            
-            # 簡單測試
-            test_response = new_model.generate_content("Test")
-            if test_response and test_response.text:
-                model = new_model
-                current_model_name = next_model_name
-                ai_initialized = True
-                logger.info(f"✅ 成功切換到模型: {current_model_name}")
-                return True
-                
-        except Exception as e:
-            logger.warning(f"⚠️ 模型 {next_model_name} 切換失敗: {e}")
-            continue
+    backup_models = background_router.get_backup_models()
+    if not backup_models:
+        logger.error("❌ 所有模型都無法使用")
+        ai_initialized = False
+        return False
     
-    logger.error("❌ 所有模型都無法使用")
-    ai_initialized = False
-    return False
+    current_model_name = backup_models[0]
+    ai_initialized = True
+    logger.info(f"✅ 下一個可用模型: {current_model_name}")
+    return True
 
 def test_ai_connection():
     """測試AI連接（修正版）"""
@@ -581,7 +407,7 @@ def test_ai_connection():
         if not GEMINI_API_KEY:
             return False, "API 金鑰未設定"
         
-        if not model or not ai_initialized:
+        if not background_router.is_configured() or not ai_initialized:
             # 嘗試重新初始化
             if initialize_ai_model():
                 return True, f"重新初始化成功 - 當前模型: {current_model_name}"
@@ -589,37 +415,37 @@ def test_ai_connection():
                 return False, "重新初始化失敗"
         
         # 簡單連接測試
-        test_response = model.generate_content("Hello")
-        if test_response and test_response.text:
-            return True, f"連接正常 - 當前模型: {current_model_name}"
-        else:
-            return False, "AI 回應測試失敗"
+        _, model_name = background_router.generate("Hello", max_attempts=1)
+        return True, f"連接正常 - 當前模型: {model_name}"
             
     except Exception as e:
         error_msg = str(e)[:50] + "..." if len(str(e)) > 50 else str(e)
         return False, f"連接錯誤: {error_msg}"
 
 def get_quota_status():
-    """取得配額狀態（修正版）"""
+    """取得配額狀態（修正版：來自路由器的延遲、錯誤率與斷路器狀態）"""
+    router_stats = background_router.get_stats()
     status = {
-        'current_model': current_model_name,
+        'current_model': router_stats['primary_model'] or current_model_name,
         'ai_initialized': ai_initialized,
         'models': {},
-        'total_calls': 0,
-        'total_errors': 0,
+        'total_calls': router_stats['total_calls'],
+        'total_errors': router_stats['total_errors'],
         'api_key_configured': bool(GEMINI_API_KEY)
     }
     
-    for model_name, stats in model_usage_stats.items():
+    for model_name, stats in router_stats['models'].items():
+        success_rate = 100.0 - stats['error_rate']
         status['models'][model_name] = {
             'calls': stats['calls'],
             'errors': stats['errors'],
-            'success_rate': round(stats['success_rate'], 1),
-            'status': '正常' if stats['success_rate'] > 50 or stats['calls'] == 0 else '可能有問題',
+            'success_rate': round(success_rate, 1),
+            'status': '正常' if stats['state'] == 'closed' and (success_rate > 50 or stats['calls'] == 0) else '可能有問題',
+            'circuit': stats['state'],
+            'p50_ms': stats['p50_ms'],
+            'p95_ms': stats['p95_ms'],
             'last_used': stats['last_used']
         }
-        status['total_calls'] += stats['calls']
-        status['total_errors'] += stats['errors']
     
     return status
 
@@ -718,6 +544,10 @@ def analyze_conversation_sessions(student_id):
         if not student:
             return {'error': '學生不存在'}
         
+        # 先把尚未分配會話的訊息切分成會話（背景排程也會定期執行）
+        from sessionizer import sessionize_messages
+        sessionize_messages([student.id])
+        
         # 取得學生的所有會話
         try:
             sessions = list(ConversationSession.select().where(
@@ -744,11 +574,8 @@ def analyze_conversation_sessions(student_id):
             # 實際會話統計
             total_sessions = len(sessions)
             
-            # 計算每個會話的訊息數
-            session_message_counts = []
-            for session in sessions:
-                msg_count = Message.select().where(Message.session == session).count()
-                session_message_counts.append(msg_count)
+            # 每個會話的訊息數（寫入訊息與會話切分時維護）
+            session_message_counts = [session.message_count for session in sessions]
             
             avg_messages = sum(session_message_counts) / len(session_message_counts) if session_message_counts else 0
             
@@ -2011,7 +1838,7 @@ def validate_student_data():
 def cleanup_old_messages(days_old=30):
     """清理舊訊息（可選功能，修正版）"""
     try:
-        from models import Message
+        from models import Message, DataVersion
         
         cutoff_date = datetime.datetime.now() - datetime.timedelta(days=days_old)
         
@@ -2032,6 +1859,7 @@ def cleanup_old_messages(days_old=30):
         deleted_count = Message.delete().where(
             Message.timestamp < cutoff_date
         ).execute()
+        DataVersion.bump('messages')
         
         logger.info(f"✅ 清理完成：刪除 {deleted_count} 條超過 {days_old} 天的舊訊息")
         
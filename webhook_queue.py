@@ -0,0 +1,384 @@
+# =================== webhook_queue.py ===================
+# EMI智能教學助理系統 - LINE Webhook 持久化工作佇列
+# /callback 驗證簽名後只把原始事件寫入 webhook_jobs 表並立即回應 200，
+# 由行程內的工作執行緒取出事件、呼叫訊息處理函數並以 reply/push 回覆學生；
+# 事件依 line_user_id 放入學生信箱，同一學生依序處理、不同學生平行處理；
+# 每位學生一次只認領最舊的一個待處理工作，前一個工作完成（或放棄）前不會認領後面的工作
+
+import os
+import json
+import time
+import datetime
+import logging
+import zlib
+import threading
+from collections import deque
+
+from peewee import PostgresqlDatabase, fn
+
+from models import db, WebhookJob
+from student_mailbox import StudentMailboxExecutor
+from event_dedup import cleanup_expired_events
+
+logger = logging.getLogger(__name__)
+
+# =================== 佇列配置 ===================
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 20))
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 1.0))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 3))
+WEBHOOK_STALE_SECONDS = int(os.getenv('WEBHOOK_STALE_SECONDS', 300))
+
+# 維護週期（秒）：重新排入逾時工作、清理舊工作
+STALE_CHECK_INTERVAL = 60
+CLEANUP_INTERVAL = 3600
+
+# =================== 工作佇列 ===================
+
+class WebhookJobQueue:
+    """以資料庫為後盾的 Webhook 工作佇列，每個 gunicorn worker 各自啟動一組執行緒"""
+
+    def __init__(self, num_workers=WEBHOOK_WORKERS, batch_size=WEBHOOK_BATCH_SIZE,
+                 poll_interval=WEBHOOK_POLL_INTERVAL, max_attempts=WEBHOOK_MAX_ATTEMPTS):
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+        self.poll_interval = poll_interval
+        self.max_attempts = max(1, max_attempts)
+
+        self._dispatch = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._dispatcher = None
+        self._executor = None
+
+        # 統計資料（僅限本行程）
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._retried = 0
+        self._wait_times = deque(maxlen=500)
+        self._run_times = deque(maxlen=500)
+        self._last_stale_check = 0.0
+        self._last_cleanup = 0.0
+
+    # =================== 入列 ===================
+
+    def enqueue(self, events):
+        """把 LINE 事件逐一寫入佇列，回傳入列數量"""
+        if not events:
+            return 0
+
+        now = datetime.datetime.now()
+        rows = []
+        for event in events:
+            source = event.get('source') or {}
+            rows.append({
+                'event_id': event.get('webhookEventId'),
+                'line_user_id': source.get('userId'),
+                'event_type': event.get('type', ''),
+                'payload': json.dumps(event, ensure_ascii=False),
+                'status': WebhookJob.STATUS_PENDING,
+                'enqueued_at': now
+            })
+
+        with db.atomic():
+            WebhookJob.insert_many(rows).execute()
+
+        self._wakeup.set()
+        logger.debug(f"📥 已入列 {len(rows)} 個 LINE 事件")
+        return len(rows)
+
+    # =================== 啟動與停止 ===================
+
+    def start(self, dispatch):
+        """啟動工作執行緒（分叉後的子行程會重新啟動自己的執行緒）"""
+        with self._lock:
+            if self._pid == os.getpid() and self._dispatcher and self._dispatcher.is_alive():
+                return False
+
+            self._dispatch = dispatch
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._in_flight = 0
+            self._executor = StudentMailboxExecutor(
+                max_workers=self.num_workers,
+                thread_name_prefix='webhook-worker'
+            )
+            self._dispatcher = threading.Thread(
+                target=self._run, name='webhook-dispatcher', daemon=True
+            )
+            self._dispatcher.start()
+
+        logger.info(f"🚀 Webhook 工作佇列已啟動 (PID: {self._pid}, Workers: {self.num_workers})")
+        return True
+
+    def is_running(self):
+        """檢查本行程的工作執行緒是否在運作"""
+        return (
+            self._pid == os.getpid() and
+            self._dispatcher is not None and
+            self._dispatcher.is_alive()
+        )
+
+    def stop(self, timeout=10):
+        """停止工作執行緒，等待進行中的工作完成"""
+        if not self.is_running():
+            return
+
+        self._stop.set()
+        self._wakeup.set()
+        self._dispatcher.join(timeout)
+        self._executor.shutdown(wait=True)
+        logger.info("🛑 Webhook 工作佇列已停止")
+
+    # =================== 派送迴圈 ===================
+
+    def _run(self):
+        """派送執行緒：依空閒 worker 數量認領工作並放入對應學生的信箱"""
+        while not self._stop.is_set():
+            try:
+                # 每一輪各自借用連線並在等待前歸還，派送執行緒不會長期佔用連線池的連線
+                with db.connection_context():
+                    self._run_periodic_maintenance()
+
+                    # 只認領空閒 worker 能立即執行的數量，認領的工作不會在信箱中等到逾時被重新排入
+                    free_slots = min(self.batch_size, self.num_workers - self._in_flight)
+                    jobs = self._claim_jobs(free_slots) if free_slots > 0 else []
+
+                for job in jobs:
+                    with self._lock:
+                        self._in_flight += 1
+                    # 沒有 userId 的事件（群組等）各自獨立，不需排序
+                    mailbox_key = job.line_user_id or f"job-{job.id}"
+                    self._executor.submit(mailbox_key, self._process_job, job)
+
+                if not jobs:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+
+            except Exception as e:
+                logger.error(f"❌ Webhook 派送迴圈錯誤: {e}")
+                time.sleep(self.poll_interval)
+
+    def _claim_jobs(self, limit):
+        """
+        認領待處理工作：每位學生只取最舊的待處理工作，且該學生沒有處理中的工作
+        （失敗待重試的工作仍是最舊的一個，會擋住同一學生後面的工作）；
+        條件寫在認領的 UPDATE 裡，多個行程同時認領時同一學生最多一個成功
+        """
+        oldest_per_user = (WebhookJob
+                           .select(fn.MIN(WebhookJob.id))
+                           .where(WebhookJob.status == WebhookJob.STATUS_PENDING,
+                                  WebhookJob.line_user_id.is_null(False))
+                           .group_by(WebhookJob.line_user_id))
+        busy_users = WebhookJob.select(WebhookJob.line_user_id).where(
+            WebhookJob.status == WebhookJob.STATUS_PROCESSING,
+            WebhookJob.line_user_id.is_null(False)
+        )
+
+        candidates = list(
+            WebhookJob.select()
+            .where(
+                WebhookJob.status == WebhookJob.STATUS_PENDING,
+                WebhookJob.line_user_id.is_null() | (
+                    WebhookJob.id.in_(oldest_per_user) & WebhookJob.line_user_id.not_in(busy_users)
+                )
+            )
+            .order_by(WebhookJob.id)
+            .limit(limit)
+        )
+
+        claimed = []
+        for job in candidates:
+            claimed_at = datetime.datetime.now()
+            if self._claim_job(job, claimed_at):
+                job.status = WebhookJob.STATUS_PROCESSING
+                job.claimed_at = claimed_at
+                job.started_at = None
+                claimed.append(job)
+
+        return claimed
+
+    def _claim_job(self, job, claimed_at):
+        """以單一條件式 UPDATE 認領工作，回傳是否成功"""
+        conditions = [WebhookJob.id == job.id, WebhookJob.status == WebhookJob.STATUS_PENDING]
+
+        if job.line_user_id:
+            other = WebhookJob.alias()
+            blocking = other.select(other.id).where(
+                (other.line_user_id == job.line_user_id) &
+                ((other.status == WebhookJob.STATUS_PROCESSING) |
+                 ((other.status == WebhookJob.STATUS_PENDING) & (other.id < job.id)))
+            )
+            conditions.append(~fn.EXISTS(blocking))
+
+        with db.atomic():
+            # PostgreSQL：同一學生的認領以交易範圍的 advisory lock 互斥
+            if job.line_user_id and isinstance(db, PostgresqlDatabase):
+                key = zlib.crc32(f"emi-webhook-user:{job.line_user_id}".encode('utf-8'))
+                if not db.execute_sql('SELECT pg_try_advisory_xact_lock(%s)', (key,)).fetchone()[0]:
+                    return False
+
+            updated = WebhookJob.update(
+                status=WebhookJob.STATUS_PROCESSING,
+                claimed_at=claimed_at,
+                started_at=None
+            ).where(*conditions).execute()
+
+        return updated == 1
+
+    def _start_job(self, job):
+        """工作實際開始執行時記錄開始時間並遞增嘗試次數；工作已被逾時重新排入時回傳 False"""
+        started_at = datetime.datetime.now()
+        updated = WebhookJob.update(
+            started_at=started_at,
+            attempts=WebhookJob.attempts + 1
+        ).where(
+            WebhookJob.id == job.id,
+            WebhookJob.status == WebhookJob.STATUS_PROCESSING,
+            WebhookJob.claimed_at == job.claimed_at,
+            WebhookJob.started_at.is_null()
+        ).execute()
+
+        if updated != 1:
+            return False
+
+        job.started_at = started_at
+        job.attempts += 1
+        return True
+
+    def _process_job(self, job):
+        """在 worker 執行緒中處理單一工作"""
+        started = time.time()
+        try:
+            with db.connection_context():
+                if not self._start_job(job):
+                    logger.warning(f"⚠️ Webhook 工作 {job.id} 已被重新排入，略過")
+                    return
+
+                if job.enqueued_at:
+                    self._wait_times.append((job.started_at - job.enqueued_at).total_seconds())
+
+                try:
+                    self._dispatch(json.loads(job.payload))
+                    self._mark_done(job)
+                    self._processed += 1
+                except Exception as e:
+                    logger.error(f"❌ Webhook 工作 {job.id} 處理失敗 (第 {job.attempts} 次): {e}")
+                    self._mark_failed(job, e)
+
+        except Exception as e:
+            logger.error(f"❌ Webhook 工作 {job.id} 狀態更新失敗: {e}")
+        finally:
+            self._run_times.append(time.time() - started)
+            with self._lock:
+                self._in_flight -= 1
+            self._wakeup.set()
+
+    def _mark_done(self, job):
+        """標記工作完成"""
+        WebhookJob.update(
+            status=WebhookJob.STATUS_DONE,
+            finished_at=datetime.datetime.now(),
+            last_error=None
+        ).where(WebhookJob.id == job.id).execute()
+
+    def _mark_failed(self, job, error):
+        """處理失敗：未達上限則放回佇列，否則標記為失敗"""
+        if job.attempts < self.max_attempts:
+            status = WebhookJob.STATUS_PENDING
+            finished_at = None
+            self._retried += 1
+        else:
+            status = WebhookJob.STATUS_FAILED
+            finished_at = datetime.datetime.now()
+            self._failed += 1
+
+        WebhookJob.update(
+            status=status,
+            finished_at=finished_at,
+            last_error=str(error)[:1000]
+        ).where(WebhookJob.id == job.id).execute()
+
+    def _run_periodic_maintenance(self):
+        """定期重新排入逾時工作並清理舊工作"""
+        now = time.time()
+
+        if now - self._last_stale_check >= STALE_CHECK_INTERVAL:
+            self._last_stale_check = now
+            WebhookJob.requeue_stale_jobs(stale_seconds=WEBHOOK_STALE_SECONDS, max_attempts=self.max_attempts)
+
+        if now - self._last_cleanup >= CLEANUP_INTERVAL:
+            self._last_cleanup = now
+            WebhookJob.cleanup_finished_jobs(hours_old=24)
+            cleanup_expired_events()
+
+    # =================== 監控指標 ===================
+
+    def get_metrics(self):
+        """取得佇列深度與等待時間等監控指標"""
+        try:
+            counts = WebhookJob.get_status_counts()
+
+            oldest_pending = WebhookJob.select(WebhookJob.enqueued_at).where(
+                WebhookJob.status == WebhookJob.STATUS_PENDING
+            ).order_by(WebhookJob.id).first()
+
+            oldest_pending_age = 0.0
+            if oldest_pending:
+                oldest_pending_age = (datetime.datetime.now() - oldest_pending.enqueued_at).total_seconds()
+
+            wait_times = sorted(self._wait_times)
+            run_times = list(self._run_times)
+
+            return {
+                'running': self.is_running(),
+                'workers': self.num_workers,
+                'in_flight': self._in_flight,
+                'mailboxes': self._executor.get_metrics() if self._executor else {},
+                'queue_depth': counts.get(WebhookJob.STATUS_PENDING, 0),
+                'processing': counts.get(WebhookJob.STATUS_PROCESSING, 0),
+                'failed_total': counts.get(WebhookJob.STATUS_FAILED, 0),
+                'oldest_pending_seconds': round(oldest_pending_age, 2),
+                'processed': self._processed,
+                'failed': self._failed,
+                'retried': self._retried,
+                'avg_wait_seconds': round(sum(wait_times) / len(wait_times), 3) if wait_times else 0.0,
+                'p95_wait_seconds': round(wait_times[int(len(wait_times) * 0.95) - 1], 3) if wait_times else 0.0,
+                'avg_run_seconds': round(sum(run_times) / len(run_times), 3) if run_times else 0.0
+            }
+        except Exception as e:
+            logger.error(f"❌ 取得佇列指標失敗: {e}")
+            return {'running': self.is_running(), 'error': str(e)}
+
+# =================== 模組層級實例 ===================
+
+webhook_queue = WebhookJobQueue()
+
+def enqueue_webhook_events(events):
+    """入列 Webhook 事件"""
+    return webhook_queue.enqueue(events)
+
+def start_webhook_workers(dispatch):
+    """啟動本行程的 Webhook 工作執行緒"""
+    return webhook_queue.start(dispatch)
+
+def stop_webhook_workers(timeout=10):
+    """停止本行程的 Webhook 工作執行緒"""
+    webhook_queue.stop(timeout)
+
+def get_webhook_queue_metrics():
+    """取得 Webhook 佇列監控指標"""
+    return webhook_queue.get_metrics()
+
+__all__ = [
+    'WebhookJobQueue',
+    'webhook_queue',
+    'enqueue_webhook_events',
+    'start_webhook_workers',
+    'stop_webhook_workers',
+    'get_webhook_queue_metrics'
+]